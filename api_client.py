@@ -1,8 +1,50 @@
+import asyncio
+import httpx
 import requests
 import time
 from typing import Dict, Any, Optional
 from config.settings import Settings
+from utils.deadline import Deadline, DeadlineExceeded
 from utils.logger import logger
+from utils.resilience import backoff_delay, get_circuit_breaker, get_retry_budget, is_retryable
+
+FORTUNE_ENDPOINT = 'index.php/v1/Bazi/cesuan'
+HEALTH_ENDPOINT = 'index.php/v1/Bazi/jingsuan'
+
+# 同步、异步客户端共用的熔断器和重试预算名称
+UPSTREAM_NAME = 'yuanfenju'
+
+
+def build_fortune_params(api_key: str, user_info: Dict[str, Any]) -> Dict[str, Any]:
+    """构建运势预测接口的请求参数"""
+    # 根据缘分居API的实际参数格式
+    return {
+        'api_key': api_key,
+        'name': user_info.get('name', '用户'),
+        'sex': '0' if user_info.get('gender') == '女' else '1',
+        'type': '1',  # 公历类型
+        'year': str(user_info.get('birth_year', 1990)),
+        'month': str(user_info.get('birth_month', 1)),
+        'day': str(user_info.get('birth_day', 1)),
+        'hours': str(user_info.get('birth_hour', 12)),
+        'minute': str(user_info.get('birth_minute', 0)),
+        'zhen': '1',
+        'province': user_info.get('birth_province', ''),
+        'city': user_info.get('birth_city', '')
+    }
+
+
+def _attempt_timeout(deadline: Optional[Deadline], cap: float) -> float:
+    """单次尝试的超时：不超过请求整体的剩余时间，预算耗尽时抛出DeadlineExceeded"""
+    return deadline.timeout(cap) if deadline is not None else cap
+
+
+def _ensure_retry_time(deadline: Optional[Deadline], delay: float, endpoint: str, error: Exception):
+    """剩余时间不足以完成退避等待时放弃重试"""
+    if deadline is not None and deadline.remaining() <= delay:
+        logger.warning(f"请求剩余时间不足，放弃重试: 缘分居API-{endpoint}")
+        raise DeadlineExceeded(f"请求超时：缘分居API在{deadline.budget:g}秒的时间预算内未能成功返回") from error
+
 
 class YuanFenJuAPIClient:
     """缘分居国学API客户端"""
@@ -12,17 +54,27 @@ class YuanFenJuAPIClient:
         self.base_url = self.settings.YUANFENJU_API_URL
         self.api_key = self.settings.YUANFENJU_API_KEY
         self.session = requests.Session()
+        self.circuit_breaker = get_circuit_breaker(UPSTREAM_NAME, self.settings)
+        self.retry_budget = get_retry_budget(UPSTREAM_NAME, self.settings)
         
         # 设置默认headers
         self.session.headers.update({
             'User-Agent': 'AIBZ/1.0'
         })
     
-    def _make_request(self, endpoint: str, data: Dict[str, Any], method: str = 'POST') -> Dict[str, Any]:
-        """发送API请求"""
+    def _make_request(self, endpoint: str, data: Dict[str, Any], method: str = 'POST',
+                      deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """发送API请求
+        
+        传入deadline时，每次尝试的超时不超过剩余时间，剩余时间不足以退避重试时直接放弃。
+        """
         url = f"{self.base_url.rstrip('/')}/{endpoint.lstrip('/')}"
+        self.retry_budget.record_request()
         
         for attempt in range(self.settings.MAX_RETRIES + 1):
+            request_timeout = _attempt_timeout(deadline, self.settings.REQUEST_TIMEOUT)
+            # 熔断时快速失败
+            self.circuit_breaker.before_call()
             try:
                 logger.debug(f"发送API请求: {method} {url}")
                 
@@ -30,17 +82,18 @@ class YuanFenJuAPIClient:
                     response = self.session.post(
                         url,
                         data=data,
-                        timeout=self.settings.REQUEST_TIMEOUT
+                        timeout=request_timeout
                     )
                 else:
                     response = self.session.get(
                         url,
                         params=data,
-                        timeout=self.settings.REQUEST_TIMEOUT
+                        timeout=request_timeout
                     )
                 
                 response.raise_for_status()
                 result = response.json()
+                self.circuit_breaker.record_success()
                 
                 logger.log_api_request(
                     api_name=f"缘分居API-{endpoint}",
@@ -54,7 +107,14 @@ class YuanFenJuAPIClient:
                 error_msg = f"API请求失败 (尝试 {attempt + 1}/{self.settings.MAX_RETRIES + 1}): {str(e)}"
                 logger.warning(error_msg)
                 
-                if attempt == self.settings.MAX_RETRIES:
+                # 只有超时、连接错误、限流和5xx计入熔断并重试，4xx等错误直接返回，不影响熔断状态
+                retryable = is_retryable(e)
+                if retryable:
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_ignored()
+                
+                if not retryable or attempt == self.settings.MAX_RETRIES or not self.retry_budget.try_acquire_retry():
                     logger.log_api_request(
                         api_name=f"缘分居API-{endpoint}",
                         request_data=data,
@@ -62,32 +122,21 @@ class YuanFenJuAPIClient:
                     )
                     raise Exception(f"API请求最终失败: {str(e)}")
                 
-                # 等待后重试
-                time.sleep(self.settings.RETRY_DELAY * (attempt + 1))
+                # 指数退避加随机抖动后重试
+                delay = backoff_delay(attempt, self.settings.RETRY_DELAY, self.settings.RETRY_MAX_DELAY)
+                _ensure_retry_time(deadline, delay, endpoint, e)
+                time.sleep(delay)
     
 
     
-    def get_fortune_prediction(self, user_info: Dict[str, Any], prediction_type: str = 'general') -> Dict[str, Any]:
+    def get_fortune_prediction(self, user_info: Dict[str, Any], prediction_type: str = 'general',
+                               deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """获取运势预测"""
-        # 根据缘分居API的实际参数格式
-        api_data = {
-            'api_key': self.api_key,
-            'name': user_info.get('name', '用户'),
-            'sex': '0' if user_info.get('gender') == '女' else '1',
-            'type': '1',  # 公历类型
-            'year': str(user_info.get('birth_year', 1990)),
-            'month': str(user_info.get('birth_month', 1)),
-            'day': str(user_info.get('birth_day', 1)),
-            'hours': str(user_info.get('birth_hour', 12)),
-            'minute': str(user_info.get('birth_minute', 0)),
-            'zhen': '1',
-            'province': user_info.get('birth_province', ''),
-            'city': user_info.get('birth_city', '')
-        }
+        api_data = build_fortune_params(self.api_key, user_info)
         
         logger.info(f"请求运势预测: {prediction_type}")
         
-        result = self._make_request('index.php/v1/Bazi/cesuan', api_data)
+        result = self._make_request(FORTUNE_ENDPOINT, api_data, deadline=deadline)
         return result
 
 
@@ -98,8 +147,135 @@ class YuanFenJuAPIClient:
         """测试API连接"""
         try:
             test_data = {'api_key': self.api_key}
-            result = self._make_request('index.php/v1/Bazi/jingsuan', test_data, 'GET')
+            result = self._make_request(HEALTH_ENDPOINT, test_data, 'GET')
+            return result.get('errcode') == 0
+        except Exception as e:
+            logger.error(f"API连接测试失败: {str(e)}")
+            return False
+
+
+class AsyncYuanFenJuAPIClient:
+    """缘分居国学API异步客户端
+    
+    基于httpx.AsyncClient的连接池复用长连接，重试等待不阻塞事件循环，
+    单个工作进程即可同时保持大量进行中的上游请求。
+    """
+    
+    def __init__(self, max_connections: Optional[int] = None, max_keepalive_connections: Optional[int] = None,
+                 keepalive_expiry: Optional[float] = None, timeout: Optional[float] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.settings = Settings()
+        self.base_url = self.settings.YUANFENJU_API_URL
+        self.api_key = self.settings.YUANFENJU_API_KEY
+        self.timeout = timeout if timeout is not None else self.settings.REQUEST_TIMEOUT
+        self.limits = httpx.Limits(
+            max_connections=max_connections or self.settings.ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=max_keepalive_connections or self.settings.ASYNC_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=keepalive_expiry if keepalive_expiry is not None else self.settings.ASYNC_KEEPALIVE_EXPIRY
+        )
+        self._transport = transport
+        self.circuit_breaker = get_circuit_breaker(UPSTREAM_NAME, self.settings)
+        self.retry_budget = get_retry_budget(UPSTREAM_NAME, self.settings)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """获取当前事件循环的连接池（事件循环变化时重新创建）"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={'User-Agent': 'AIBZ/1.0'},
+                limits=self.limits,
+                timeout=self.timeout,
+                transport=self._transport
+            )
+            self._loop = loop
+        return self._client
+    
+    async def _make_request(self, endpoint: str, data: Dict[str, Any], method: str = 'POST',
+                            timeout: Optional[float] = None, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """发送异步API请求"""
+        client = self._get_client()
+        url = f"/{endpoint.lstrip('/')}"
+        self.retry_budget.record_request()
+        
+        for attempt in range(self.settings.MAX_RETRIES + 1):
+            request_timeout = _attempt_timeout(deadline, timeout if timeout is not None else self.timeout)
+            # 熔断时快速失败
+            self.circuit_breaker.before_call()
+            try:
+                logger.debug(f"发送异步API请求: {method} {url}")
+                
+                if method.upper() == 'POST':
+                    response = await client.post(url, data=data, timeout=request_timeout)
+                else:
+                    response = await client.get(url, params=data, timeout=request_timeout)
+                
+                response.raise_for_status()
+                result = response.json()
+                self.circuit_breaker.record_success()
+                
+                logger.log_api_request(
+                    api_name=f"缘分居API-{endpoint}",
+                    request_data=data,
+                    response_data=result
+                )
+                
+                return result
+                
+            except (httpx.HTTPError, ValueError) as e:
+                error_msg = f"异步API请求失败 (尝试 {attempt + 1}/{self.settings.MAX_RETRIES + 1}): {str(e)}"
+                logger.warning(error_msg)
+                
+                # 只有超时、连接错误、限流和5xx计入熔断并重试，4xx等错误直接返回，不影响熔断状态
+                retryable = is_retryable(e)
+                if retryable:
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_ignored()
+                
+                if not retryable or attempt == self.settings.MAX_RETRIES or not self.retry_budget.try_acquire_retry():
+                    logger.log_api_request(
+                        api_name=f"缘分居API-{endpoint}",
+                        request_data=data,
+                        error=error_msg
+                    )
+                    raise Exception(f"API请求最终失败: {str(e)}")
+                
+                # 指数退避加随机抖动后重试（不阻塞事件循环）
+                delay = backoff_delay(attempt, self.settings.RETRY_DELAY, self.settings.RETRY_MAX_DELAY)
+                _ensure_retry_time(deadline, delay, endpoint, e)
+                await asyncio.sleep(delay)
+    
+    async def get_fortune_prediction(self, user_info: Dict[str, Any], prediction_type: str = 'general',
+                                     timeout: Optional[float] = None,
+                                     deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """获取运势预测"""
+        api_data = build_fortune_params(self.api_key, user_info)
+        
+        logger.info(f"异步请求运势预测: {prediction_type}")
+        
+        return await self._make_request(FORTUNE_ENDPOINT, api_data, timeout=timeout, deadline=deadline)
+    
+    async def test_connection(self) -> bool:
+        """测试API连接"""
+        try:
+            test_data = {'api_key': self.api_key}
+            result = await self._make_request(HEALTH_ENDPOINT, test_data, 'GET')
             return result.get('errcode') == 0
         except Exception as e:
             logger.error(f"API连接测试失败: {str(e)}")
-            return False
\ No newline at end of file
+            return False
+    
+    async def aclose(self):
+        """关闭连接池"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+    
+    async def __aenter__(self) -> 'AsyncYuanFenJuAPIClient':
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
\ No newline at end of file
@@ -1,13 +1,15 @@
 import streamlit as st
 import os
+import itertools
 import json
 from datetime import datetime
 from typing import Optional
 from models.user_info import UserInfo
-from services.prediction_service import PredictionService
+from services.service_provider import get_prediction_service, get_province_data
 from config.settings import Settings
 from utils.logger import logger
 from utils.data_validator import DataValidator
+from utils.deadline import Deadline, DeadlineExceeded
 
 # 页面配置
 st.set_page_config(
@@ -85,9 +87,17 @@ st.markdown("""
 class AIBaziApp:
     """玄学AI智能体应用"""
     
+    # 侧边栏预测类型与预测服务类型的对应关系
+    PREDICTION_TYPE_KEYS = {
+        "综合运势": "comprehensive",
+        "事业发展": "career",
+        "感情婚姻": "relationship"
+    }
+    
     def __init__(self):
         self.settings = Settings()
-        self.prediction_service = PredictionService()
+        # 服务实例在进程内共享，脚本重新运行时不会重建客户端和缓存
+        self.prediction_service = get_prediction_service()
         self.validator = DataValidator()
         
         # 加载省市数据
@@ -108,8 +118,7 @@ class AIBaziApp:
     def load_province_data(self):
          """加载省市数据"""
          try:
-             with open('province.json', 'r', encoding='utf-8') as f:
-                 self.province_data = json.load(f)
+             self.province_data = get_province_data()
          except FileNotFoundError:
              st.error("省市数据文件未找到，请确保 province.json 文件存在")
              self.province_data = {}
@@ -182,6 +191,7 @@ class AIBaziApp:
                         if st.button(f"📖 查看完整报告", key=f"view_full_{i}"):
                             if record.get('result_object'):
                                 st.session_state.prediction_result = record['result_object']
+                                st.session_state.current_user = record.get('user_info')
                                 st.session_state.show_result = True
                                 st.rerun()
                     with col2:
@@ -285,7 +295,22 @@ class AIBaziApp:
                 birth_province = ""
                 birth_city = ""
             
-            st.markdown("#### 📅 出生时间（请填写公历/阳历时间）")
+            st.markdown("#### 📅 出生时间（公历、农历均可）")
+            
+            # 历法：农历日期在本地换算为公历后排盘
+            calendar_col1, calendar_col2 = st.columns(2)
+            with calendar_col1:
+                calendar_label = st.radio(
+                    "历法",
+                    ["公历", "农历"],
+                    horizontal=True,
+                    help="选择农历时，下方年月日按农历填写"
+                )
+            with calendar_col2:
+                is_leap_month = st.checkbox(
+                    "闰月（仅农历）",
+                    help="农历出生月份为闰月时勾选"
+                )
             
             # 出生日期
             date_col1, date_col2, date_col3 = st.columns(3)
@@ -357,6 +382,8 @@ class AIBaziApp:
                     'birth_year': birth_year,
                     'birth_month': birth_month,
                     'birth_day': birth_day,
+                    'calendar_type': 'lunar' if calendar_label == "农历" else 'solar',
+                    'is_leap_month': is_leap_month and calendar_label == "农历",
                     'birth_hour': birth_hour,
                     'birth_minute': birth_minute,
                     'birth_province': birth_province,
@@ -381,38 +408,62 @@ class AIBaziApp:
             # 创建用户信息对象
             user_info = UserInfo(**form_data)
             st.session_state.current_user = user_info
+            if user_info.lunar_birth_date:
+                st.info(f"📅 {user_info.lunar_birth_date} 对应公历 "
+                        f"{user_info.birth_year}年{user_info.birth_month}月{user_info.birth_day}日")
             
             # 记录用户操作
             logger.log_user_action("表单提交", form_data)
             
-            # 显示加载状态
+            # 根据选择的预测类型进行预测
+            prediction_type = st.session_state.get('prediction_type', '综合运势')
+            service_type = self.PREDICTION_TYPE_KEYS.get(prediction_type, 'comprehensive')
+            
+            report_label = self.prediction_service.PREDICTION_TYPES[service_type]['label']
+            st.markdown(f"### 🎯 {user_info.name} 的 {report_label} 分析报告")
+            
+            # 整个请求（排盘接口和大模型生成）共用一个时间预算
+            deadline = Deadline(self.settings.REQUEST_DEADLINE)
+            
+            # 显示加载状态，直到首段内容生成
             with st.spinner("正在分析您的命理信息，请稍候..."):
-                # 根据选择的预测类型进行预测
-                prediction_type = st.session_state.get('prediction_type', '综合运势')
-                
-                if prediction_type == "事业发展":
-                    result = self.prediction_service.get_career_prediction(user_info)
-                elif prediction_type == "感情婚姻":
-                    result = self.prediction_service.get_relationship_prediction(user_info)
-                else:
-                    result = self.prediction_service.get_comprehensive_prediction(user_info)
-                
-                st.session_state.prediction_result = result
-                st.session_state.show_result = True
-                
-                # 添加到历史记录
-                st.session_state.prediction_history.append({
-                    'name': user_info.name,
-                    'type': prediction_type,
-                    'time': result.get_formatted_time(),
-                    'bazi_summary': result.bazi_summary,
-                    'prediction_content': result.prediction_content,
-                    'suggestions': result.suggestions,
-                    'result_object': result  # 保存完整的结果对象
-                })
+                fortune_data = self.prediction_service.bazi_service.get_fortune_analysis(
+                    user_info, service_type, deadline=deadline
+                )
+                chunks = self.prediction_service.stream_prediction(
+                    user_info, service_type, fortune_data=fortune_data, deadline=deadline
+                )
+                first_chunk = next(chunks, "")
+            
+            # 流式展示生成内容
+            prediction_content = st.write_stream(itertools.chain([first_chunk], chunks))
+            if not isinstance(prediction_content, str):
+                prediction_content = "".join(str(part) for part in prediction_content)
+            
+            result = self.prediction_service.create_prediction_result(
+                user_info, service_type, prediction_content, data_stale=getattr(fortune_data, 'is_stale', False)
+            )
+            st.session_state.prediction_result = result
+            st.session_state.conversation = self.prediction_service.start_conversation(result)
+            st.session_state.show_result = True
+            
+            # 添加到历史记录
+            st.session_state.prediction_history.append({
+                'name': user_info.name,
+                'type': prediction_type,
+                'time': result.get_formatted_time(),
+                'bazi_summary': result.bazi_summary,
+                'prediction_content': result.prediction_content,
+                'suggestions': result.suggestions,
+                'result_object': result,  # 保存完整的结果对象
+                'user_info': user_info  # 查看历史报告时用于追问
+            })
             
             st.rerun()
             
+        except DeadlineExceeded as e:
+            st.error("命理分析服务响应较慢，本次请求已超时，请稍后重试。")
+            logger.error(f"预测超时: {str(e)}")
         except Exception as e:
             st.error(f"预测过程中发生错误：{str(e)}")
             logger.error(f"预测失败: {str(e)}")
@@ -428,6 +479,9 @@ class AIBaziApp:
         
         st.markdown(f"### 🎯 {result.user_name} 的 {result.prediction_type} 分析报告")
         
+        if result.data_stale:
+            st.info("命理数据服务暂时繁忙，本次分析使用了之前缓存的命盘数据。")
+        
         # 预测内容
         st.markdown('<div class="prediction-content">', unsafe_allow_html=True)
         st.write(result.prediction_content)
@@ -454,12 +508,53 @@ class AIBaziApp:
                 st.session_state.current_user = None
                 st.rerun()
         
+        # 追问对话
+        self.render_followup_chat(result)
+        
         # 免责声明
         st.markdown("---")
         st.markdown(f"**免责声明：** {result.disclaimer}")
         st.markdown(f"**数据来源：** {result.data_source}")
         st.markdown(f"**预测时间：** {result.get_formatted_time()}")
     
+    def render_followup_chat(self, result):
+        """渲染追问对话面板"""
+        user_info = st.session_state.current_user
+        # 无法确定报告对应的用户信息时不提供追问，避免用其他用户的命盘回答
+        if user_info is None or user_info.name != result.user_name:
+            return
+        
+        conversation = st.session_state.get('conversation')
+        if conversation is None or conversation.report != result.prediction_content:
+            conversation = self.prediction_service.start_conversation(result)
+            st.session_state.conversation = conversation
+        
+        st.markdown("---")
+        st.markdown("#### 💬 继续咨询")
+        if conversation.summary:
+            st.caption(f"较早的{conversation.turn_count - len(conversation.turns)}轮对话已整理为摘要")
+        
+        for turn in conversation.turns:
+            with st.chat_message("user"):
+                st.write(turn.question)
+            with st.chat_message("assistant"):
+                st.write(turn.answer)
+        
+        question = st.chat_input("针对报告继续提问，例如：2027年的运势如何？")
+        if not question:
+            return
+        
+        question = self.validator.sanitize_input(question)
+        with st.chat_message("user"):
+            st.write(question)
+        
+        try:
+            with st.chat_message("assistant"):
+                st.write_stream(self.prediction_service.stream_followup(user_info, conversation, question))
+        except Exception as e:
+            st.error(f"追问过程中发生错误：{str(e)}")
+            logger.error(f"追问失败: {str(e)}")
+    
     def export_report(self, result):
         """导出预测报告"""
         try:
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量预测脚本
+
+从JSONL或CSV文件流式读取用户信息，批量生成预测结果并写出JSONL。
+
+使用方法：
+    python batch_predict.py users.jsonl results.jsonl
+    python batch_predict.py users.csv results.jsonl --type career --llm-concurrency 8
+    python batch_predict.py users.jsonl results.jsonl --resume
+
+输入字段与表单一致：name, gender, birth_year, birth_month, birth_day,
+birth_hour, birth_minute, birth_province, birth_city, question，
+可选 id（原样写入结果）和 prediction_type（覆盖 --type）；
+农历出生日期另设 calendar_type=lunar，闰月设 is_leap_month=true。
+"""
+
+import argparse
+import sys
+
+from config.settings import Settings
+
+
+def parse_args():
+    """解析命令行参数"""
+    settings = Settings()
+    parser = argparse.ArgumentParser(description="玄学AI智能体 - 批量预测")
+    parser.add_argument("input", help="输入文件路径（.jsonl 或 .csv）")
+    parser.add_argument("output", help="输出JSONL文件路径")
+    parser.add_argument("--type", default="comprehensive", choices=["comprehensive", "career", "relationship"],
+                        help="默认预测类型")
+    parser.add_argument("--workers", type=int, default=settings.BATCH_WORKERS, help="工作线程数")
+    parser.add_argument("--fetch-concurrency", type=int, default=settings.BATCH_FETCH_CONCURRENCY,
+                        help="缘分居API最大并发数")
+    parser.add_argument("--llm-concurrency", type=int, default=settings.BATCH_LLM_CONCURRENCY,
+                        help="大模型生成最大并发数")
+    parser.add_argument("--checkpoint-every", type=int, default=settings.BATCH_CHECKPOINT_EVERY,
+                        help="每处理多少条记录写入一次检查点")
+    parser.add_argument("--resume", action="store_true", help="从检查点继续上次中断的任务")
+    parser.add_argument("--no-cache", action="store_true", help="跳过大模型响应缓存，重新生成")
+    return parser.parse_args()
+
+
+def main():
+    """主函数"""
+    args = parse_args()
+
+    from services.batch_service import BatchPredictionRunner
+    from services.service_provider import get_prediction_service
+
+    runner = BatchPredictionRunner(
+        prediction_service=get_prediction_service(),
+        workers=args.workers,
+        fetch_concurrency=args.fetch_concurrency,
+        llm_concurrency=args.llm_concurrency,
+        checkpoint_every=args.checkpoint_every,
+        use_cache=not args.no_cache
+    )
+
+    try:
+        stats = runner.run(args.input, args.output, prediction_type=args.type, resume=args.resume)
+    except KeyboardInterrupt:
+        print("\n⏹️  已中断，可使用 --resume 从检查点继续")
+        sys.exit(130)
+
+    print(f"✅ 批量预测完成: 共{stats['processed']}条，成功{stats['ok']}条，"
+          f"无效{stats['invalid']}条，失败{stats['error']}条")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+历法表生成脚本
+
+计算指定年份范围内的24节气时刻和农历月，写入定宽二进制文件，
+供本地排盘引擎内存映射加载（utils/calendar_tables.py）。
+
+使用方法：
+    python build_calendar_tables.py
+    python build_calendar_tables.py --start 1900 --end 2100 --output data/calendar_tables.bin
+"""
+
+import argparse
+import os
+import time
+
+from config.settings import Settings
+from utils.calendar_tables import build_lunar_months, build_term_table, write_tables
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="玄学AI智能体 - 历法表生成")
+    parser.add_argument("--start", type=int, default=1900, help="起始年份")
+    parser.add_argument("--end", type=int, default=2100, help="结束年份（含）")
+    parser.add_argument("--output", default=Settings.CALENDAR_TABLES_PATH, help="输出文件路径")
+    return parser.parse_args()
+
+
+def main():
+    """主函数"""
+    args = parse_args()
+    if args.start > args.end:
+        print("❌ 起始年份不能大于结束年份")
+        return 1
+
+    started = time.time()
+    terms = build_term_table(args.start, args.end)
+    months = build_lunar_months(args.start, args.end)
+    write_tables(args.output, args.start, args.end, {"terms": terms, "months": months})
+
+    print(f"✅ 历法表已生成: {args.output}")
+    print(f"   年份范围: {args.start}-{args.end}，节气 {terms.size} 个，农历月 {len(months) - 1} 个")
+    print(f"   文件大小: {os.path.getsize(args.output)} 字节，耗时 {time.time() - started:.1f} 秒")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -29,7 +29,41 @@ class Settings:
     # API限制
     REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
     MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
-    RETRY_DELAY = int(os.getenv("RETRY_DELAY", "1"))
+    RETRY_DELAY = float(os.getenv("RETRY_DELAY", "1"))  # 指数退避的基准等待时间（秒）
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))  # 单次重试的最大等待时间（秒）
+    REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "90"))  # 单次预测请求的整体时间预算（秒）
+    
+    # 重试预算（滑动窗口内重试次数不超过请求数的比例，进程内共享）
+    RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+    RETRY_BUDGET_MIN_RETRIES = int(os.getenv("RETRY_BUDGET_MIN_RETRIES", "3"))
+    RETRY_BUDGET_WINDOW = float(os.getenv("RETRY_BUDGET_WINDOW", "10"))
+    
+    # 熔断器配置（窗口内错误率达到阈值后快速失败，到期后半开探测）
+    CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+    CIRCUIT_MIN_REQUESTS = int(os.getenv("CIRCUIT_MIN_REQUESTS", "10"))
+    CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "30"))
+    CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+    CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_MAX_CALLS", "1"))
+    
+    # 命盘来源（upstream: 缘分居接口；local: 本地排盘，不发起网络请求；hybrid: 本地排盘为准，上游补充分析内容）
+    CHART_SOURCE = os.getenv("CHART_SOURCE", "upstream")  # 支持: upstream, local, hybrid
+    # 本地排盘使用的历法表（由build_calendar_tables.py生成，缺失时节气改为实时计算）
+    CALENDAR_TABLES_PATH = os.getenv(
+        "CALENDAR_TABLES_PATH",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'calendar_tables.bin')
+    )
+    # 本地排盘按出生地经度和时差校正为真太阳时（与上游接口zhen=1一致）
+    TRUE_SOLAR_TIME_ENABLED = os.getenv("TRUE_SOLAR_TIME_ENABLED", "True").lower() == "true"
+    # 省市经纬度索引（覆盖province.json中的全部省市）
+    CITY_COORDINATES_PATH = os.getenv(
+        "CITY_COORDINATES_PATH",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'city_coordinates.json')
+    )
+    
+    # 异步客户端连接池配置
+    ASYNC_MAX_CONNECTIONS = int(os.getenv("ASYNC_MAX_CONNECTIONS", "200"))
+    ASYNC_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("ASYNC_MAX_KEEPALIVE_CONNECTIONS", "50"))
+    ASYNC_KEEPALIVE_EXPIRY = float(os.getenv("ASYNC_KEEPALIVE_EXPIRY", "30"))
     
     # DeepSeek API配置
     DEEPSEEK_API_BASE = "https://api.deepseek.com/v1"
@@ -42,6 +76,40 @@ class Settings:
     LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "2000"))
     LLM_TOP_P = float(os.getenv("LLM_TOP_P", "0.9"))
     
+    # 大模型路由配置
+    # LLM_BACKENDS为JSON数组，每项包含name、provider、model、base_url、api_key或api_key_env，
+    # 其余字段作为模型参数传入；未配置时使用LLM_PROVIDER对应的DeepSeek后端
+    LLM_BACKENDS = os.getenv("LLM_BACKENDS", "")
+    LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "15"))  # 首字超时后切换后端（秒）
+    LLM_ROUTER_WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "50"))  # 延迟和错误率的滚动统计窗口
+    LLM_ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.5"))
+    LLM_ROUTER_MIN_SAMPLES = int(os.getenv("LLM_ROUTER_MIN_SAMPLES", "5"))
+    LLM_ROUTER_COOLDOWN = float(os.getenv("LLM_ROUTER_COOLDOWN", "30"))  # 不健康后端的暂停时间（秒）
+    
+    # 模型分级路由配置（按预测类型、问题长度和当前负载选择模型档位）
+    # standard档位使用各后端配置的模型、LLM_MAX_TOKENS和LLM_TEMPERATURE；
+    # light/heavy档位的模型按后端指定，JSON对象为{后端名称: 模型}，纯模型名只用于默认后端（名称为LLM_PROVIDER），
+    # 留空或未列出的后端使用其配置的模型
+    LLM_TIER_ROUTING_ENABLED = os.getenv("LLM_TIER_ROUTING_ENABLED", "False").lower() == "true"
+    LLM_TIER_LIGHT_MODEL = os.getenv("LLM_TIER_LIGHT_MODEL", "")
+    LLM_TIER_LIGHT_MAX_TOKENS = int(os.getenv("LLM_TIER_LIGHT_MAX_TOKENS", "1200"))
+    LLM_TIER_LIGHT_TEMPERATURE = float(os.getenv("LLM_TIER_LIGHT_TEMPERATURE", "0.5"))
+    LLM_TIER_HEAVY_MODEL = os.getenv("LLM_TIER_HEAVY_MODEL", "")
+    LLM_TIER_HEAVY_MAX_TOKENS = int(os.getenv("LLM_TIER_HEAVY_MAX_TOKENS", "4000"))
+    LLM_TIER_HEAVY_TEMPERATURE = float(os.getenv("LLM_TIER_HEAVY_TEMPERATURE", "0.7"))
+    LLM_TIER_SHORT_QUESTION_CHARS = int(os.getenv("LLM_TIER_SHORT_QUESTION_CHARS", "30"))  # 不超过此长度视为简单问题
+    LLM_TIER_LONG_QUESTION_CHARS = int(os.getenv("LLM_TIER_LONG_QUESTION_CHARS", "200"))  # 达到此长度视为复杂问题
+    LLM_TIER_HIGH_LOAD = int(os.getenv("LLM_TIER_HIGH_LOAD", "8"))  # 进行中的大模型调用数达到此值时降档
+    
+    # 提示词数据投影配置（按预测类型裁剪运势数据并紧凑序列化，启用前先用真实接口数据核对规则）
+    PROMPT_PROJECTION_ENABLED = os.getenv("PROMPT_PROJECTION_ENABLED", "False").lower() == "true"
+    PROMPT_PROJECTION_FILE = os.getenv(
+        "PROMPT_PROJECTION_FILE", os.path.join(os.path.dirname(__file__), 'projections.json')
+    )
+    
+    # 提示词布局（legacy: 原布局；prefix_cache: 稳定内容在前、日期在末尾，便于命中服务端前缀缓存）
+    PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "legacy")  # 支持: legacy, prefix_cache
+    
     # 系统提示词配置
     SYSTEM_PROMPT_COMPREHENSIVE = load_prompt_from_file('comprehensive_prompt.txt')
     
@@ -51,8 +119,54 @@ class Settings:
     
     SYSTEM_PROMPT_RELATIONSHIP = load_prompt_from_file('relationship_prompt.txt')
     
+    SYSTEM_PROMPT_DIGEST = load_prompt_from_file('digest_prompt.txt')
+    
+    SYSTEM_PROMPT_FOLLOWUP = load_prompt_from_file('followup_prompt.txt')
+    
+    SYSTEM_PROMPT_SECTION = load_prompt_from_file('section_prompt.txt')
+    
+    # 分章节生成配置（综合报告的各章节由并发的大模型调用分别生成）
+    SECTIONED_GENERATION_ENABLED = os.getenv("SECTIONED_GENERATION_ENABLED", "False").lower() == "true"
+    SECTION_MAX_TOKENS = int(os.getenv("SECTION_MAX_TOKENS", "600"))
+    SECTION_CONCURRENCY = int(os.getenv("SECTION_CONCURRENCY", "5"))
+    
+    # 两阶段生成配置（先按命盘生成并缓存分析摘要，再基于摘要回答各类咨询）
+    TWO_STAGE_ENABLED = os.getenv("TWO_STAGE_ENABLED", "False").lower() == "true"
+    DIGEST_MAX_TOKENS = int(os.getenv("DIGEST_MAX_TOKENS", "1500"))
+    DIGEST_CACHE_TTL = int(os.getenv("DIGEST_CACHE_TTL", "604800"))  # 7天
+    DIGEST_CACHE_MAX_ENTRIES = int(os.getenv("DIGEST_CACHE_MAX_ENTRIES", "1000"))
+    DIGEST_CACHE_MAX_BYTES = int(os.getenv("DIGEST_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))  # 16MB
+    
+    # 追问对话配置
+    FOLLOWUP_MAX_RECENT_TURNS = int(os.getenv("FOLLOWUP_MAX_RECENT_TURNS", "3"))  # 保留原文的最近对话轮数
+    FOLLOWUP_REPORT_MAX_CHARS = int(os.getenv("FOLLOWUP_REPORT_MAX_CHARS", "1500"))  # 提示词中引用报告的最大字数
+    FOLLOWUP_MAX_TOKENS = int(os.getenv("FOLLOWUP_MAX_TOKENS", "1000"))
+    FOLLOWUP_SUMMARY_MAX_TOKENS = int(os.getenv("FOLLOWUP_SUMMARY_MAX_TOKENS", "400"))
+    
+    # 批量预测配置
+    BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+    BATCH_FETCH_CONCURRENCY = int(os.getenv("BATCH_FETCH_CONCURRENCY", "4"))
+    BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+    BATCH_CHECKPOINT_EVERY = int(os.getenv("BATCH_CHECKPOINT_EVERY", "50"))
+    
     # 缓存配置
-    CACHE_TTL = 3600  # 1小时
+    CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))  # 1小时
+    CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "604800"))  # 命盘数据过期后仍可使用的宽限期（7天）
+    CHART_REFRESH_WORKERS = int(os.getenv("CHART_REFRESH_WORKERS", "2"))  # 后台刷新过期命盘数据的线程数
+    CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+    CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 64MB
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")  # 支持: memory, sqlite
+    CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache/aibz_cache.db")
+    CACHE_DISK_MAX_ENTRIES = int(os.getenv("CACHE_DISK_MAX_ENTRIES", "100000"))
+    CACHE_DISK_MAX_BYTES = int(os.getenv("CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))  # 512MB
+    
+    # 大模型响应缓存配置
+    LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "True").lower() == "true"
+    LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "43200"))  # 12小时
+    LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "500"))
+    LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # 32MB
+    LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", CACHE_BACKEND)  # 支持: memory, sqlite
+    DIGEST_CACHE_BACKEND = os.getenv("DIGEST_CACHE_BACKEND", CACHE_BACKEND)  # 支持: memory, sqlite
     
     @classmethod
     def validate_config(cls):
@@ -62,7 +176,8 @@ class Settings:
         if not cls.DEEPSEEK_API_KEY:
             missing_configs.append("DEEPSEEK_API_KEY")
         
-        if not cls.YUANFENJU_API_KEY:
+        # 本地排盘不需要缘分居API
+        if not cls.YUANFENJU_API_KEY and cls.CHART_SOURCE != 'local':
             missing_configs.append("YUANFENJU_API_KEY")
         
         if missing_configs:
@@ -0,0 +1,54 @@
+from pydantic import BaseModel
+from typing import List
+from datetime import datetime
+
+class ConversationTurn(BaseModel):
+    """一轮追问对话"""
+
+    question: str
+    answer: str
+    time: datetime
+
+
+class Conversation(BaseModel):
+    """追问对话数据模型
+
+    保留预测报告、较早对话的摘要和最近几轮原文，
+    上下文长度不随对话轮数线性增长。
+    """
+
+    # 基础信息
+    user_name: str
+    prediction_type: str
+
+    # 之前生成的预测报告
+    report: str
+
+    # 较早对话的摘要
+    summary: str = ""
+
+    # 最近几轮对话原文
+    turns: List[ConversationTurn] = []
+
+    # 累计对话轮数
+    turn_count: int = 0
+
+    def add_turn(self, question: str, answer: str):
+        """记录一轮对话"""
+        self.turns.append(ConversationTurn(question=question, answer=answer, time=datetime.now()))
+        self.turn_count += 1
+
+    def pop_overflow_turns(self, max_recent_turns: int) -> List[ConversationTurn]:
+        """取出超出保留轮数的较早对话，用于合并到摘要"""
+        overflow_count = len(self.turns) - max_recent_turns
+        if overflow_count <= 0:
+            return []
+        overflow = self.turns[:overflow_count]
+        self.turns = self.turns[overflow_count:]
+        return overflow
+
+    def format_recent_turns(self) -> str:
+        """格式化最近几轮对话"""
+        if not self.turns:
+            return "（无）"
+        return "\n\n".join(f"用户：{turn.question}\n命理师：{turn.answer}" for turn in self.turns)
@@ -27,6 +27,9 @@ class PredictionResult(BaseModel):
     # 预测类型
     prediction_type: Optional[str] = "综合运势"
     
+    # 命盘数据是否来自过期缓存（上游服务不可用时使用）
+    data_stale: bool = False
+    
     def get_formatted_time(self) -> str:
         """获取格式化的预测时间"""
         return self.prediction_time.strftime('%Y年%m月%d日 %H:%M:%S')
@@ -1,9 +1,17 @@
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, root_validator, validator
 from datetime import datetime
 from typing import Optional
 
+from utils.lunar_calendar import lunar_date_from_fields, lunar_to_solar
+
+CALENDAR_TYPES = ('solar', 'lunar')
+
 class UserInfo(BaseModel):
-    """用户信息数据模型"""
+    """用户信息数据模型
+    
+    calendar_type为lunar时，出生年月日按农历（is_leap_month表示闰月）输入，构造时本地换算为公历：
+    birth_year等字段始终为公历日期，原农历日期保存在lunar_birth_date中。
+    """
     
     name: str
     gender: str  # "男" 或 "女"
@@ -15,6 +23,29 @@ class UserInfo(BaseModel):
     birth_province: str
     birth_city: str
     question: Optional[str] = None
+    calendar_type: str = 'solar'  # "solar" 公历 或 "lunar" 农历
+    is_leap_month: bool = False
+    lunar_birth_date: Optional[str] = None
+    
+    @root_validator(pre=True)
+    def convert_lunar_birth_date(cls, values):
+        """农历出生日期换算为公历"""
+        calendar_type = values.get('calendar_type') or 'solar'
+        if calendar_type not in CALENDAR_TYPES:
+            raise ValueError('历法类型必须是"solar"或"lunar"')
+        if calendar_type == 'lunar':
+            lunar_date = lunar_date_from_fields(values)
+            solar_date = lunar_to_solar(*lunar_date)
+            values = {
+                **values,
+                'birth_year': solar_date.year,
+                'birth_month': solar_date.month,
+                'birth_day': solar_date.day,
+                'calendar_type': 'solar',
+                'is_leap_month': False,
+                'lunar_birth_date': str(lunar_date)
+            }
+        return values
     
     @validator('name')
     def validate_name(cls, v):
@@ -93,4 +124,5 @@ class UserInfo(BaseModel):
             "birth_minute": self.birth_minute,
             "birth_province": self.birth_province,
             "birth_city": self.birth_city
-        }
\ No newline at end of file
+        }
+
@@ -0,0 +1,190 @@
+import csv
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional, Tuple
+
+from config.settings import Settings
+from models.user_info import UserInfo
+from services.prediction_service import PredictionService
+from utils.data_validator import DataValidator
+from utils.logger import logger
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+# CSV输入中需要转换为整数的字段
+INTEGER_FIELDS = ('birth_year', 'birth_month', 'birth_day', 'birth_hour', 'birth_minute')
+USER_INFO_FIELDS = set(UserInfo.__fields__)
+
+
+def iter_records(input_path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """逐条读取JSONL或CSV格式的用户记录，返回(序号, 记录)"""
+    with open(input_path, 'r', encoding='utf-8-sig', newline='') as f:
+        if input_path.lower().endswith('.csv'):
+            for index, row in enumerate(csv.DictReader(f)):
+                record = {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+                for field in INTEGER_FIELDS:
+                    if record.get(field) not in (None, ''):
+                        try:
+                            record[field] = int(record[field])
+                        except ValueError:
+                            pass
+                    elif field in record:
+                        del record[field]
+                yield index, record
+        else:
+            index = 0
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    record = {'_parse_error': f"JSON格式错误: {str(e)}"}
+                if not isinstance(record, dict):
+                    # 数组、字符串、数字等合法JSON不是用户记录，按无效记录输出
+                    record = {'_parse_error': f"记录格式错误: 应为JSON对象，实际为{type(record).__name__}"}
+                yield index, record
+                index += 1
+
+
+class BatchPredictionRunner:
+    """批量预测执行器
+
+    流式读取输入记录，以有限的并发度获取运势数据和生成预测，按输入顺序
+    流式写出JSONL结果。同一命盘的运势数据通过BaziService的缓存和请求合并
+    只获取一次。内存占用只与并发窗口大小有关，与输入规模无关。
+    定期写入检查点（已完成记录数、处理统计和输出文件偏移），中断后可断点续跑。
+    """
+
+    def __init__(self, prediction_service: Optional[PredictionService] = None,
+                 workers: Optional[int] = None, fetch_concurrency: Optional[int] = None,
+                 llm_concurrency: Optional[int] = None, checkpoint_every: Optional[int] = None,
+                 use_cache: bool = True):
+        self.settings = Settings()
+        self.prediction_service = prediction_service or PredictionService()
+        self.validator = DataValidator()
+        self.workers = workers or self.settings.BATCH_WORKERS
+        self.checkpoint_every = checkpoint_every or self.settings.BATCH_CHECKPOINT_EVERY
+        self.use_cache = use_cache
+        self._fetch_slots = threading.BoundedSemaphore(fetch_concurrency or self.settings.BATCH_FETCH_CONCURRENCY)
+        self._llm_slots = threading.BoundedSemaphore(llm_concurrency or self.settings.BATCH_LLM_CONCURRENCY)
+
+    def run(self, input_path: str, output_path: str, prediction_type: str = 'comprehensive',
+            resume: bool = False) -> Dict[str, int]:
+        """执行批量预测，返回处理统计"""
+        checkpoint_path = f"{output_path}.ckpt"
+        stats, offset = {"processed": 0, "ok": 0, "invalid": 0, "error": 0}, 0
+        if resume:
+            # 统计从检查点继续累计，汇总包含之前已完成的记录
+            stats, offset = self._load_checkpoint(checkpoint_path, input_path)
+            if stats["processed"]:
+                logger.info(f"从检查点恢复批量预测: 跳过前{stats['processed']}条记录")
+        skip = stats["processed"]
+
+        # 已提交但尚未写出的任务，窗口大小限制了内存占用
+        window = self.workers * 2
+        pending: "deque[Tuple[int, Future]]" = deque()
+
+        mode = 'r+' if offset else 'w'
+        with open(output_path, mode, encoding='utf-8') as out, \
+                ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch') as executor:
+            if offset:
+                # 丢弃检查点之后写入的不完整输出
+                out.seek(offset)
+                out.truncate()
+
+            for index, record in iter_records(input_path):
+                if index < skip:
+                    continue
+
+                pending.append((index, executor.submit(self._process_record, index, record, prediction_type)))
+                if len(pending) >= window:
+                    self._write_next(pending, out, stats, checkpoint_path, input_path)
+
+            while pending:
+                self._write_next(pending, out, stats, checkpoint_path, input_path)
+
+            self._save_checkpoint(checkpoint_path, input_path, stats, out)
+
+        logger.info(f"批量预测完成: {stats}")
+        return stats
+
+    def _process_record(self, index: int, record: Dict[str, Any], prediction_type: str) -> Dict[str, Any]:
+        """处理单条记录：校验、获取运势数据、生成预测"""
+        output = {"index": index, "id": record.get('id')}
+
+        if '_parse_error' in record:
+            return {**output, "status": "invalid", "errors": [record['_parse_error']]}
+
+        validation_errors = self.validator.validate_user_info(record)
+        if validation_errors:
+            return {**output, "status": "invalid", "errors": validation_errors}
+
+        try:
+            fields = {k: v for k, v in record.items() if k in USER_INFO_FIELDS and v not in (None, '')}
+            user_info = UserInfo(**fields)
+            record_type = record.get('prediction_type') or prediction_type
+
+            with self._fetch_slots:
+                fortune_data = self.prediction_service.bazi_service.get_fortune_analysis(user_info, record_type)
+
+            with self._llm_slots:
+                result = self.prediction_service.get_prediction(
+                    user_info, record_type, use_cache=self.use_cache, fortune_data=fortune_data
+                )
+
+            return {**output, "status": "ok", "result": json.loads(result.json())}
+
+        except Exception as e:
+            logger.error(f"批量预测记录失败: 第{index}条 - {str(e)}")
+            return {**output, "status": "error", "error": str(e)}
+
+    def _write_next(self, pending: deque, out, stats: Dict[str, int], checkpoint_path: str, input_path: str):
+        """按输入顺序写出最早提交的任务结果"""
+        _, future = pending.popleft()
+        output = future.result()
+        out.write(json.dumps(output, ensure_ascii=False) + "\n")
+
+        stats["processed"] += 1
+        stats[output["status"]] += 1
+        if stats["processed"] % self.checkpoint_every == 0:
+            self._save_checkpoint(checkpoint_path, input_path, stats, out)
+            logger.info(f"批量预测进度: 已处理{stats['processed']}条")
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_path: str, input_path: str, stats: Dict[str, int], out) -> None:
+        """写入检查点（先落盘输出，再原子替换检查点文件）"""
+        out.flush()
+        os.fsync(out.fileno())
+        checkpoint = {
+            "input": os.path.abspath(input_path),
+            "records_done": stats["processed"],
+            "stats": dict(stats),
+            "output_offset": out.tell()
+        }
+        tmp_path = f"{checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, checkpoint_path)
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_path: str, input_path: str) -> Tuple[Dict[str, int], int]:
+        """读取检查点，返回(已完成记录的处理统计, 输出文件偏移)"""
+        stats = {"processed": 0, "ok": 0, "invalid": 0, "error": 0}
+        if not os.path.exists(checkpoint_path):
+            return stats, 0
+
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+
+        if checkpoint.get("input") != os.path.abspath(input_path):
+            raise ValueError(f"检查点对应的输入文件不一致: {checkpoint.get('input')}")
+
+        stats.update({key: int(value) for key, value in (checkpoint.get("stats") or {}).items() if key in stats})
+        stats["processed"] = int(checkpoint.get("records_done", 0))
+        return stats, int(checkpoint.get("output_offset", 0))
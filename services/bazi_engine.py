@@ -0,0 +1,316 @@
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from models.user_info import UserInfo
+from utils import astronomy
+from utils.calendar_tables import EPOCH, build_term_table, jie_times, load_calendar_tables
+from utils.logger import logger
+from utils.solar_time import STANDARD_MERIDIAN, format_offset, load_city_index, solar_time_offset
+
+# 天干、地支
+TIAN_GAN = '甲乙丙丁戊己庚辛壬癸'
+DI_ZHI = '子丑寅卯辰巳午未申酉戌亥'
+
+# 天干五行（甲乙木、丙丁火、戊己土、庚辛金、壬癸水），下标为五行序号
+WU_XING = ('木', '火', '土', '金', '水')
+WU_XING_KEYS = ('wood', 'fire', 'earth', 'metal', 'water')
+ZHI_WU_XING = (4, 2, 0, 0, 2, 1, 1, 2, 3, 3, 2, 4)
+
+# 地支藏干（本气在前）
+HIDDEN_STEMS = {
+    '子': '癸', '丑': '己癸辛', '寅': '甲丙戊', '卯': '乙', '辰': '戊乙癸', '巳': '丙庚戊',
+    '午': '丁己', '未': '己丁乙', '申': '庚壬戊', '酉': '辛', '戌': '戊辛丁', '亥': '壬甲'
+}
+
+# 十神：按（五行关系, 阴阳是否相同）索引；五行按木火土金水排列，关系为 (他干五行 - 日干五行) mod 5：
+# 0同我、1我生、2我克、3克我、4生我
+TEN_GODS = {
+    (0, True): '比肩', (0, False): '劫财',
+    (1, True): '食神', (1, False): '伤官',
+    (2, True): '偏财', (2, False): '正财',
+    (3, True): '七杀', (3, False): '正官',
+    (4, True): '偏印', (4, False): '正印'
+}
+
+# EPOCH（1970-01-01）的日柱序号，批量计算日柱用
+DAY_INDEX_AT_EPOCH = (EPOCH.toordinal() + 1721425 + 49) % 60
+
+
+def ganzhi(index: int) -> str:
+    """六十甲子序号对应的干支"""
+    return TIAN_GAN[index % 10] + DI_ZHI[index % 12]
+
+
+def ten_god(day_stem: str, other_stem: str) -> str:
+    """other_stem相对日干的十神"""
+    day_index, other_index = TIAN_GAN.index(day_stem), TIAN_GAN.index(other_stem)
+    relation = (other_index // 2 - day_index // 2) % 5
+    return TEN_GODS[(relation, day_index % 2 == other_index % 2)]
+
+
+def year_pillar_index(birth: datetime) -> int:
+    """年柱的六十甲子序号（以立春换年）"""
+    year = birth.year
+    if birth < jie_times(year)[1]:
+        year -= 1
+    return (year - 4) % 60
+
+
+def month_number(birth: datetime) -> int:
+    """所在节令月序号：寅月为1，依次至丑月为12"""
+    times = jie_times(birth.year)
+    position = bisect_right(times, birth)
+    # 小寒前为上一年的子月；小寒至立春为丑月；此后每过一节进一月
+    if position == 0:
+        return 11
+    if position == 1:
+        return 12
+    return position - 1
+
+
+def day_pillar_index(day: date) -> int:
+    """日柱的六十甲子序号（儒略日数 + 49）"""
+    return (day.toordinal() + 1721425 + 49) % 60
+
+
+def compute_pillars(year: int, month: int, day: int, hour: int, minute: int = 0,
+                    longitude: Optional[float] = None) -> Tuple[str, str, str, str]:
+    """计算四柱（北京时间）
+
+    年柱以立春换年，月柱以节气换月（五虎遁定月干），
+    日柱23点起算次日，时柱按五鼠遁定时干。
+    传入出生地经度时，日柱和时柱按真太阳时划分。
+    """
+    birth = datetime(year, month, day, hour, minute)
+    if longitude is None:
+        return pillars_at(birth)
+    return pillars_at(birth, birth + timedelta(minutes=solar_time_offset(birth, longitude)))
+
+
+def pillars_at(birth: datetime, solar_time: Optional[datetime] = None) -> Tuple[str, str, str, str]:
+    """由北京时间birth和真太阳时solar_time计算四柱
+
+    节气是确定的时刻，年柱和月柱按北京时间比较；日柱和时柱按当地真太阳时划分，未给出时同北京时间。
+    """
+    local = solar_time or birth
+
+    year_index = year_pillar_index(birth)
+    month_no = month_number(birth)
+    month_stem = (year_index % 10 * 2 + 2 + month_no - 1) % 10
+    month_branch = (month_no + 1) % 12
+
+    # 子时（23点）起算为次日
+    day_index = day_pillar_index((local + timedelta(hours=1)).date())
+    hour_branch = (local.hour + 1) // 2 % 12
+    hour_stem = (day_index % 10 * 2 + hour_branch) % 10
+
+    return (
+        ganzhi(year_index),
+        TIAN_GAN[month_stem] + DI_ZHI[month_branch],
+        ganzhi(day_index),
+        TIAN_GAN[hour_stem] + DI_ZHI[hour_branch]
+    )
+
+
+class BulkPillars(NamedTuple):
+    """批量排盘结果：stems、branches为(n, 4)数组，按年、月、日、时柱排列，
+    取值为TIAN_GAN、DI_ZHI中的下标；female为性别数组（True为女）"""
+    stems: np.ndarray
+    branches: np.ndarray
+    female: np.ndarray
+
+
+def compute_pillars_bulk(timestamps: Any, genders: Optional[Sequence[str]] = None,
+                         longitudes: Optional[Any] = None) -> BulkPillars:
+    """批量计算四柱（向量化），用于统计分析和批量活动
+
+    timestamps为北京时间，可以是datetime64数组，或自1970-01-01 00:00（北京时间，非Unix时间戳）起的秒数；
+    genders为"男"/"女"，四柱与性别无关，只按行对齐返回；longitudes为出生地经度，
+    给出时日柱和时柱按真太阳时划分（NaN表示不校正）。
+    节气按searchsorted在历法表的十二节时刻中定位，干支由六十甲子序号取模得到，单核每秒可排数百万盘。
+    不校正真太阳时时结果与逐条调用pillars_at一致；校正时时差使用向量化近似公式（误差在数秒以内），
+    恰在时辰交界数秒内的出生时间可能相差一个时辰。
+    """
+    seconds = _to_epoch_seconds(timestamps)
+    count = len(seconds)
+    female = _female_mask(genders, count)
+    if count == 0:
+        empty = np.empty((0, 4), dtype=np.int8)
+        return BulkPillars(empty, empty.copy(), female)
+
+    # 年柱、月柱：所在节令月在十二节序列中的位置（0为base_year的小寒，属上一年的丑月）。
+    # 月柱每过一节在六十甲子中进一位，寅月序号为年柱序号*12+2（五虎遁）
+    base_year, jie_seconds = _jie_seconds(seconds)
+    position = np.searchsorted(jie_seconds, seconds, side='right') - 1
+    year_index = (position - 1) // 12 + (base_year - 4)
+    month_index = position + ((base_year - 4) * 12 + 1)
+
+    # 日柱、时柱：按真太阳时划分。自EPOCH前1小时起的时辰数，每12个时辰为一日（23点起算次日），
+    # 时柱每个时辰在六十甲子中进一位，子时序号为日柱序号*12（五鼠遁）
+    if longitudes is not None:
+        offsets = np.nan_to_num(_solar_time_offsets(seconds, longitudes, count))
+        local = seconds + np.floor(offsets * 60).astype(np.int64)
+    else:
+        local = seconds
+    shichen = (local + 3600) // 7200
+    day_index = shichen // 12 + DAY_INDEX_AT_EPOCH
+    hour_index = shichen + DAY_INDEX_AT_EPOCH * 12
+
+    stems = np.empty((count, 4), dtype=np.int8)
+    branches = np.empty((count, 4), dtype=np.int8)
+    for column, index in enumerate((year_index, month_index, day_index, hour_index)):
+        index = (index % 60).astype(np.int8)
+        stems[:, column] = index % 10
+        branches[:, column] = index % 12
+    return BulkPillars(stems, branches, female)
+
+
+def _to_epoch_seconds(timestamps: Any) -> np.ndarray:
+    """北京时间数组转换为自EPOCH起的秒数"""
+    values = np.asarray(timestamps)
+    if values.ndim != 1:
+        raise ValueError('出生时间必须是一维数组')
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[s]').astype(np.int64)
+    if values.dtype.kind not in 'iuf':
+        raise ValueError('出生时间必须是datetime64数组或秒数')
+    return values.astype(np.int64)
+
+
+def _female_mask(genders: Optional[Sequence[str]], count: int) -> np.ndarray:
+    """性别数组转换为布尔数组（True为女）"""
+    if genders is None:
+        return np.zeros(count, dtype=bool)
+    values = np.asarray(genders)
+    if len(values) != count:
+        raise ValueError('性别与出生时间的数量不一致')
+    female = values == '女'
+    if not np.all(female | (values == '男')):
+        raise ValueError('性别必须是"男"或"女"')
+    return female
+
+
+def _solar_time_offsets(seconds: np.ndarray, longitudes: Any, count: int) -> np.ndarray:
+    """真太阳时与北京时间之差（分钟）的数组，经度为NaN处结果为NaN"""
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if longitudes.shape != (count,):
+        raise ValueError('经度与出生时间的数量不一致')
+    # 自EPOCH起的世界时日数（ΔT约1分钟，对时差的影响可忽略）
+    days = (seconds - 8 * 3600) / 86400
+    # 时差每天变化不超过半分钟，按日计算后线性插值，插值误差远小于1秒
+    first_day = np.floor(days.min())
+    grid = astronomy.equation_of_time_array(
+        np.arange(first_day, np.floor(days.max()) + 2) + astronomy.julian_day(EPOCH)
+    )
+    position = days - first_day
+    index = position.astype(np.int64)
+    equation = grid[index] + (position - index) * (grid[index + 1] - grid[index])
+    return (longitudes - STANDARD_MERIDIAN) * 4 + equation
+
+
+def _jie_seconds(seconds: np.ndarray) -> Tuple[int, np.ndarray]:
+    """覆盖seconds的十二节时刻（按时间排列），返回（首个小寒所在年, 秒数数组）"""
+    years = np.array([seconds.min(), seconds.max()]).astype('datetime64[s]').astype('datetime64[Y]').astype(int) + 1970
+    first_year, last_year = int(years[0]), int(years[1])
+    tables = load_calendar_tables()
+    if tables is not None and tables.covers(first_year) and tables.covers(last_year):
+        jie_seconds = _table_jie_seconds(tables.start_year, tables.end_year)
+        if seconds.min() >= jie_seconds[0]:
+            return tables.start_year, jie_seconds
+    # 表外年份：实时计算（首年小寒前属上一年的子月，需多算一年）
+    logger.warning(f"历法表未覆盖{first_year}-{last_year}年，节气改为实时计算")
+    return first_year - 1, _computed_jie_seconds(first_year - 1, last_year)
+
+
+@lru_cache(maxsize=4)
+def _table_jie_seconds(start_year: int, end_year: int) -> np.ndarray:
+    """历法表中start_year至end_year的十二节时刻"""
+    terms = load_calendar_tables().terms
+    return np.ascontiguousarray(terms[:end_year - start_year + 1, 0::2]).ravel()
+
+
+@lru_cache(maxsize=8)
+def _computed_jie_seconds(start_year: int, end_year: int) -> np.ndarray:
+    """实时计算start_year至end_year的十二节时刻"""
+    return build_term_table(start_year, end_year)[:, 0::2].ravel()
+
+
+class BaziEngine:
+    """本地八字排盘引擎
+
+    四柱、藏干、十神和五行统计均为确定的历法计算，节气时刻查内存映射的历法表，
+    单次排盘只需微秒级的查表和整数运算，无需调用上游接口。
+    输出与缘分居接口的base_info、bazi_info结构对齐，可直接作为命盘数据使用。
+    true_solar_time为True时按出生地经纬度索引将出生时间校正为真太阳时，不依赖上游接口。
+    """
+
+    SOURCE = 'local'
+
+    def __init__(self, true_solar_time: bool = True):
+        self.true_solar_time = true_solar_time
+
+    def compute_chart(self, user_info: UserInfo) -> Dict[str, Any]:
+        """根据用户出生信息排盘"""
+        birth = datetime(user_info.birth_year, user_info.birth_month, user_info.birth_day,
+                         user_info.birth_hour, user_info.birth_minute)
+        location = self._locate(user_info) if self.true_solar_time else None
+        offset = solar_time_offset(birth, location[0]) if location else None
+        solar_time = birth + timedelta(minutes=offset) if location else None
+        pillars = pillars_at(birth, solar_time)
+        day_stem = pillars[2][0]
+        hidden_stems = [list(HIDDEN_STEMS[pillar[1]]) for pillar in pillars]
+
+        return {
+            "base_info": {
+                "sex": "坤造" if user_info.gender == '女' else "乾造",
+                "gongli": f"{user_info.birth_year}年{user_info.birth_month}月{user_info.birth_day}日 "
+                          f"{user_info.birth_hour}时{user_info.birth_minute}分",
+                **({"zhen": self._solar_time_info(user_info, location, offset, solar_time)} if location else {})
+            },
+            "bazi_info": {
+                "bazi": list(pillars),
+                "tg_cg_god": [ten_god(day_stem, pillar[0]) if index != 2 else '日主'
+                              for index, pillar in enumerate(pillars)],
+                "cg": hidden_stems,
+                "cg_god": [[ten_god(day_stem, stem) for stem in stems] for stems in hidden_stems],
+                "day_master": f"{day_stem}{WU_XING[TIAN_GAN.index(day_stem) // 2]}",
+                "wuxing_count": self._count_wu_xing(pillars)
+            },
+            "chart_source": self.SOURCE
+        }
+
+    @staticmethod
+    def _locate(user_info: UserInfo) -> Optional[Tuple[float, float]]:
+        """出生地的（经度, 纬度），查不到时返回None（按北京时间排盘）"""
+        index = load_city_index()
+        location = index.lookup(user_info.birth_province, user_info.birth_city) if index else None
+        if location is None:
+            logger.warning(f"未找到出生地经纬度，按北京时间排盘: {user_info.birth_province}{user_info.birth_city}")
+        return location
+
+    @staticmethod
+    def _solar_time_info(user_info: UserInfo, location: Tuple[float, float],
+                         offset: float, solar_time: datetime) -> Dict[str, str]:
+        """真太阳时校正信息，与缘分居接口的base_info.zhen对齐"""
+        return {
+            "province": user_info.birth_province,
+            "city": user_info.birth_city,
+            "jingdu": f"{location[0]:.2f}",
+            "weidu": f"{location[1]:.2f}",
+            "shicha": format_offset(offset),
+            "zhen_time": f"{solar_time.year}年{solar_time.month}月{solar_time.day}日 "
+                         f"{solar_time.hour}时{solar_time.minute}分"
+        }
+
+    @staticmethod
+    def _count_wu_xing(pillars: Tuple[str, ...]) -> Dict[str, int]:
+        """统计八个字的五行个数"""
+        counts = [0] * 5
+        for pillar in pillars:
+            counts[TIAN_GAN.index(pillar[0]) // 2] += 1
+            counts[ZHI_WU_XING[DI_ZHI.index(pillar[1])]] += 1
+        return dict(zip(WU_XING_KEYS, counts))
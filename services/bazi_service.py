@@ -1,26 +1,111 @@
+import asyncio
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional
 from models.user_info import UserInfo
-from api_client import YuanFenJuAPIClient
+from api_client import YuanFenJuAPIClient, AsyncYuanFenJuAPIClient
+from services.bazi_engine import BaziEngine
+from config.settings import Settings
+from utils.cache import create_cache
+from utils.deadline import Deadline
 from utils.logger import logger
 from utils.data_validator import DataValidator
+from utils.singleflight import SingleFlight, AsyncSingleFlight
+
+# 运势数据中随姓名变化的字段路径，其余字段只取决于命盘（性别、出生时间、出生地）
+NAME_DEPENDENT_FIELDS = (
+    ('base_info', 'name'),
+)
+
+# hybrid模式下以本地排盘为准的字段：与缘分居接口字段名一致（见BaziData.from_api_response）的四柱和天干十神
+# 本地排盘的其余字段只补充上游缺少的键，不覆盖上游数据
+LOCAL_CHART_FIELDS = (
+    ('bazi_info', 'bazi'),
+    ('bazi_info', 'tg_cg_god'),
+)
+
+class FortuneData(dict):
+    """运势数据
+
+    is_stale为True表示数据来自已过期的缓存（后台刷新中或上游暂不可用）。
+    """
+    is_stale = False
+
 
 class BaziService:
     """八字数据服务"""
     
     def __init__(self):
+        self.settings = Settings()
         self.api_client = YuanFenJuAPIClient()
+        self.async_api_client = AsyncYuanFenJuAPIClient()
         self.validator = DataValidator()
-        self._cache = {}  # 简单的内存缓存
+        self.engine = BaziEngine(true_solar_time=self.settings.TRUE_SOLAR_TIME_ENABLED)
+        self._cache = create_cache(
+            namespace='bazi',
+            ttl=self.settings.CACHE_TTL,
+            max_entries=self.settings.CACHE_MAX_ENTRIES,
+            max_bytes=self.settings.CACHE_MAX_BYTES,
+            stale_ttl=self.settings.CACHE_STALE_TTL
+        )
+        # 合并同一命盘的并发上游请求
+        self._inflight = SingleFlight()
+        self._async_inflight = AsyncSingleFlight()
+        # 过期命盘数据的后台刷新
+        self._refresh_executor = ThreadPoolExecutor(
+            max_workers=self.settings.CHART_REFRESH_WORKERS, thread_name_prefix='chart-refresh'
+        )
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self._refresh_tasks = set()
+        self._refresh_stats = {"stale_served": 0, "refreshed": 0, "refresh_failed": 0}
     
-    def get_fortune_analysis(self, user_info: UserInfo, prediction_type: str = 'general') -> Dict[str, Any]:
-        """获取运势分析（包含完整的八字和运势信息）"""
-        # 生成缓存键
-        cache_key = self._generate_cache_key(user_info, prediction_type)
+    def get_fortune_analysis(self, user_info: UserInfo, prediction_type: str = 'general',
+                             deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """获取运势分析（包含完整的八字和运势信息）
+        
+        命盘来源由CHART_SOURCE决定：upstream只使用上游接口；local只使用本地排盘，
+        不发起网络请求；hybrid以本地排盘为准，上游数据用于补充分析内容，
+        上游不可用时退回本地排盘。
+        """
+        source = self.settings.CHART_SOURCE
+        if source == 'upstream':
+            return self._get_upstream_analysis(user_info, deadline)
+        
+        local_chart = self._compute_local_chart(user_info)
+        if source == 'local':
+            return self._personalize(local_chart, user_info)
+        
+        try:
+            fortune_data = self._get_upstream_analysis(user_info, deadline)
+        except Exception as e:
+            logger.warning(f"上游命盘数据获取失败，使用本地排盘: {user_info.name} - {str(e)}")
+            return self._personalize(local_chart, user_info)
+        return self._merge_local_chart(fortune_data, local_chart)
+    
+    def _get_upstream_analysis(self, user_info: UserInfo, deadline: Optional[Deadline] = None) -> 'FortuneData':
+        """从上游接口获取运势分析
+        
+        上游接口返回的命盘数据与预测类型无关，因此缓存以命盘为粒度，
+        不同预测类型、不同姓名的同一命盘共用一次API调用。
+        缓存过期但仍在宽限期内时立即返回旧数据（is_stale为True），并在后台刷新。
+        deadline为请求整体的时间预算，上游请求的超时和重试不会超出剩余时间。
+        """
+        # 生成命盘缓存键
+        cache_key = self.get_chart_key(user_info)
         
         # 检查缓存
-        if cache_key in self._cache:
+        chart_data = self._cache.get(cache_key)
+        if chart_data is not None:
             logger.info(f"从缓存获取运势数据: {user_info.name}")
-            return self._cache[cache_key]
+            return self._personalize(chart_data, user_info)
+        
+        # 过期数据先返回，后台刷新
+        stale_entry = self._cache.get_stale(cache_key)
+        if stale_entry is not None:
+            self._schedule_refresh(user_info, cache_key)
+            return self._serve_stale(stale_entry[0], user_info)
         
         # 验证用户信息
         user_data = user_info.dict()
@@ -28,31 +113,217 @@ class BaziService:
         if validation_errors:
             raise ValueError(f"用户信息验证失败: {', '.join(validation_errors)}")
         
+        if deadline is not None:
+            deadline.check("命盘数据")
+        
+        # 同一命盘的并发请求只调用一次API，其余请求共享结果或异常
+        chart_data = self._inflight.do(cache_key, self._fetch_chart_data, user_info, cache_key, deadline,
+                                       deadline=deadline)
+        
+        logger.info(f"运势分析获取成功: {user_info.name}")
+        return self._personalize(chart_data, user_info)
+    
+    def _fetch_chart_data(self, user_info: UserInfo, cache_key: str,
+                          deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """调用API获取命盘数据并写入缓存"""
+        # 等待期间可能已有其他请求完成并写入缓存
+        if cache_key in self._cache:
+            chart_data = self._cache.get(cache_key)
+            if chart_data is not None:
+                return chart_data
+        
         # 调用API获取运势分析（包含八字信息）
-        logger.info(f"开始获取运势分析: {user_info.name}, 类型: {prediction_type}")
-        api_response = self.api_client.get_fortune_prediction(
-            user_info.to_api_params(),
-            prediction_type
-        )
+        logger.info(f"开始获取运势分析: {user_info.name}")
+        api_response = self.api_client.get_fortune_prediction(user_info.to_api_params(), deadline=deadline)
         
         # 验证API响应
         if not self.validator.validate_api_response(api_response):
             raise ValueError("API响应数据格式不正确")
         
-        # 直接返回API响应的data部分
-        fortune_data = api_response.get('data', {})
+        # 去除姓名相关字段后按命盘缓存
+        chart_data = self._strip_name_fields(api_response.get('data', {}))
+        self._cache.set(cache_key, chart_data)
+        return chart_data
+    
+    async def aget_fortune_analysis(self, user_info: UserInfo, prediction_type: str = 'general',
+                                    deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """异步获取运势分析，与get_fortune_analysis共享命盘缓存和命盘来源配置"""
+        source = self.settings.CHART_SOURCE
+        if source == 'upstream':
+            return await self._aget_upstream_analysis(user_info, deadline)
+        
+        local_chart = self._compute_local_chart(user_info)
+        if source == 'local':
+            return self._personalize(local_chart, user_info)
+        
+        try:
+            fortune_data = await self._aget_upstream_analysis(user_info, deadline)
+        except Exception as e:
+            logger.warning(f"上游命盘数据获取失败，使用本地排盘: {user_info.name} - {str(e)}")
+            return self._personalize(local_chart, user_info)
+        return self._merge_local_chart(fortune_data, local_chart)
+    
+    async def _aget_upstream_analysis(self, user_info: UserInfo,
+                                      deadline: Optional[Deadline] = None) -> 'FortuneData':
+        """异步从上游接口获取运势分析"""
+        cache_key = self.get_chart_key(user_info)
+        
+        # 检查缓存
+        chart_data = self._cache.get(cache_key)
+        if chart_data is not None:
+            logger.info(f"从缓存获取运势数据: {user_info.name}")
+            return self._personalize(chart_data, user_info)
+        
+        # 过期数据先返回，在当前事件循环中后台刷新
+        stale_entry = self._cache.get_stale(cache_key)
+        if stale_entry is not None:
+            self._schedule_async_refresh(user_info, cache_key)
+            return self._serve_stale(stale_entry[0], user_info)
+        
+        # 验证用户信息
+        validation_errors = self.validator.validate_user_info(user_info.dict())
+        if validation_errors:
+            raise ValueError(f"用户信息验证失败: {', '.join(validation_errors)}")
         
-        # 缓存结果
-        self._cache[cache_key] = fortune_data
+        if deadline is not None:
+            deadline.check("命盘数据")
+        
+        chart_data = await self._async_inflight.do(cache_key, self._afetch_chart_data, user_info, cache_key, deadline,
+                                                   deadline=deadline)
         
         logger.info(f"运势分析获取成功: {user_info.name}")
-        return fortune_data
+        return self._personalize(chart_data, user_info)
     
-
+    async def _afetch_chart_data(self, user_info: UserInfo, cache_key: str,
+                                 deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """异步调用API获取命盘数据并写入缓存"""
+        if cache_key in self._cache:
+            chart_data = self._cache.get(cache_key)
+            if chart_data is not None:
+                return chart_data
+        
+        logger.info(f"开始异步获取运势分析: {user_info.name}")
+        api_response = await self.async_api_client.get_fortune_prediction(user_info.to_api_params(), deadline=deadline)
+        
+        if not self.validator.validate_api_response(api_response):
+            raise ValueError("API响应数据格式不正确")
+        
+        chart_data = self._strip_name_fields(api_response.get('data', {}))
+        self._cache.set(cache_key, chart_data)
+        return chart_data
+    
+    def _compute_local_chart(self, user_info: UserInfo) -> Dict[str, Any]:
+        """验证用户信息后本地排盘"""
+        validation_errors = self.validator.validate_user_info(user_info.dict())
+        if validation_errors:
+            raise ValueError(f"用户信息验证失败: {', '.join(validation_errors)}")
+        return self.engine.compute_chart(user_info)
+    
+    @staticmethod
+    def _merge_local_chart(fortune_data: 'FortuneData', local_chart: Dict[str, Any]) -> 'FortuneData':
+        """以本地排盘的四柱、天干十神覆盖上游数据，本地排盘的其余字段只补充上游缺少的键"""
+        merged = FortuneData(fortune_data)
+        merged.is_stale = fortune_data.is_stale
+        for section in ('base_info', 'bazi_info'):
+            merged[section] = {**local_chart[section], **(fortune_data.get(section) or {})}
+        for section, field in LOCAL_CHART_FIELDS:
+            upstream_value = (fortune_data.get(section) or {}).get(field)
+            if upstream_value is not None and upstream_value != local_chart[section][field]:
+                logger.warning(f"上游命盘与本地排盘不一致，以本地排盘为准: {section}.{field} "
+                               f"上游{upstream_value} 本地{local_chart[section][field]}")
+            merged[section][field] = local_chart[section][field]
+        merged["chart_source"] = 'hybrid'
+        return merged
+    
+    def _serve_stale(self, chart_data: Dict[str, Any], user_info: UserInfo) -> 'FortuneData':
+        """返回过期的命盘数据并标记"""
+        with self._refresh_lock:
+            self._refresh_stats["stale_served"] += 1
+        logger.info(f"返回过期的运势数据并后台刷新: {user_info.name}")
+        return self._personalize(chart_data, user_info, stale=True)
     
-    def _generate_cache_key(self, user_info: UserInfo, prediction_type: str = 'general') -> str:
-        """生成缓存键"""
-        return f"{user_info.name}_{user_info.birth_year}_{user_info.birth_month}_{user_info.birth_day}_{user_info.birth_hour}_{user_info.birth_minute}_{prediction_type}"
+    def _begin_refresh(self, cache_key: str) -> bool:
+        """登记后台刷新，同一命盘同时只刷新一次"""
+        with self._refresh_lock:
+            if cache_key in self._refreshing:
+                return False
+            self._refreshing.add(cache_key)
+            return True
+    
+    def _end_refresh(self, cache_key: str, error: Optional[Exception] = None):
+        """结束后台刷新并记录结果"""
+        with self._refresh_lock:
+            self._refreshing.discard(cache_key)
+            self._refresh_stats["refresh_failed" if error else "refreshed"] += 1
+        if error:
+            # 刷新失败时继续使用过期数据
+            logger.warning(f"后台刷新运势数据失败，继续使用缓存数据: {cache_key} - {str(error)}")
+    
+    def _schedule_refresh(self, user_info: UserInfo, cache_key: str):
+        """在后台线程中刷新过期的命盘数据"""
+        if not self._begin_refresh(cache_key):
+            return
+        
+        def refresh():
+            try:
+                self._inflight.do(cache_key, self._fetch_chart_data, user_info, cache_key)
+            except Exception as e:
+                self._end_refresh(cache_key, e)
+            else:
+                self._end_refresh(cache_key)
+        
+        self._refresh_executor.submit(refresh)
+    
+    def _schedule_async_refresh(self, user_info: UserInfo, cache_key: str):
+        """在当前事件循环中刷新过期的命盘数据"""
+        if not self._begin_refresh(cache_key):
+            return
+        
+        async def refresh():
+            try:
+                await self._async_inflight.do(cache_key, self._afetch_chart_data, user_info, cache_key)
+            except Exception as e:
+                self._end_refresh(cache_key, e)
+            else:
+                self._end_refresh(cache_key)
+        
+        # 保留任务引用，避免任务在完成前被回收
+        task = asyncio.get_running_loop().create_task(refresh())
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+    
+    @staticmethod
+    def get_chart_key(user_info: UserInfo) -> str:
+        """生成命盘缓存键（规范化的出生时间、性别、出生地）"""
+        birth_time = (
+            f"{user_info.birth_year:04d}{user_info.birth_month:02d}{user_info.birth_day:02d}"
+            f"{user_info.birth_hour:02d}{user_info.birth_minute:02d}"
+        )
+        province = user_info.birth_province.strip()
+        city = user_info.birth_city.strip()
+        return f"chart:{birth_time}:{user_info.gender}:{province}:{city}"
+    
+    @staticmethod
+    def _strip_name_fields(fortune_data: Dict[str, Any]) -> Dict[str, Any]:
+        """移除随姓名变化的字段，得到可在同一命盘间共享的数据"""
+        chart_data = dict(fortune_data)
+        for section, field in NAME_DEPENDENT_FIELDS:
+            if isinstance(chart_data.get(section), dict) and field in chart_data[section]:
+                chart_data[section] = {k: v for k, v in chart_data[section].items() if k != field}
+        return chart_data
+    
+    @staticmethod
+    def _personalize(chart_data: Dict[str, Any], user_info: UserInfo, stale: bool = False) -> 'FortuneData':
+        """在共享的命盘数据上叠加当前用户的姓名字段
+        
+        缓存按引用返回命盘数据，这里深拷贝后再叠加姓名，调用方修改返回值不会影响缓存中的共享命盘。
+        """
+        fortune_data = FortuneData(copy.deepcopy(chart_data))
+        fortune_data.is_stale = stale
+        for section, field in NAME_DEPENDENT_FIELDS:
+            if isinstance(fortune_data.get(section), dict):
+                fortune_data[section] = {**fortune_data[section], field: user_info.name}
+        return fortune_data
     
 
     
@@ -65,9 +336,18 @@ class BaziService:
         """获取缓存信息"""
         return {
             "cache_size": len(self._cache),
-            "cached_users": list(self._cache.keys())
+            "cached_users": self._cache.keys(),
+            "cache_stats": self._cache.stats(),
+            "inflight_stats": self._inflight.stats(),
+            "async_inflight_stats": self._async_inflight.stats(),
+            "refresh_stats": self.get_refresh_stats()
         }
     
+    def get_refresh_stats(self) -> Dict[str, Any]:
+        """获取过期数据返回和后台刷新的统计"""
+        with self._refresh_lock:
+            return {**self._refresh_stats, "refreshing": len(self._refreshing)}
+    
     def validate_service_health(self) -> Dict[str, Any]:
         """验证服务健康状态"""
         health_status = {
@@ -75,12 +355,26 @@ class BaziService:
             "status": "healthy",
             "api_connection": False,
             "cache_status": "active",
+            "chart_source": self.settings.CHART_SOURCE,
+            "circuit_breaker": self.api_client.circuit_breaker.stats(),
+            "retry_budget": self.api_client.retry_budget.stats(),
             "errors": []
         }
         
+        # 本地排盘不依赖上游接口
+        if self.settings.CHART_SOURCE == 'local':
+            return health_status
+        
         try:
+            # 熔断时不再探测，直接报告降级
+            if health_status["circuit_breaker"]["state"] == 'open':
+                health_status["errors"].append("缘分居API熔断中")
+                health_status["status"] = "degraded"
+                return health_status
+            
             # 测试API连接
             health_status["api_connection"] = self.api_client.test_connection()
+            health_status["circuit_breaker"] = self.api_client.circuit_breaker.stats()
             
             if not health_status["api_connection"]:
                 health_status["errors"].append("API连接失败")
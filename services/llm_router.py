@@ -0,0 +1,338 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_deepseek import ChatDeepSeek
+from langchain_openai import ChatOpenAI
+
+from config.settings import Settings
+from utils.deadline import DeadlineExceeded
+from utils.logger import logger
+
+# 后端流式输出结束标记
+_STREAM_DONE = object()
+
+
+def create_chat_model(provider: str, model: str, api_key: str, base_url: Optional[str] = None,
+                      **model_kwargs) -> BaseChatModel:
+    """根据提供商创建聊天模型"""
+    if provider == 'chatdeepseek':
+        if base_url:
+            model_kwargs['api_base'] = base_url
+        # 流式输出时也返回token用量
+        return ChatDeepSeek(api_key=api_key, model=model, stream_usage=True, **model_kwargs)
+    if provider == 'chatopenai':
+        return ChatOpenAI(api_key=api_key, model=model, base_url=base_url, stream_usage=True, **model_kwargs)
+    raise ValueError(f"不支持的大模型提供商: {provider}")
+
+
+class LLMBackend:
+    """大模型后端及其滚动统计（首字延迟、错误率）"""
+
+    def __init__(self, name: str, model: BaseChatModel, window: int = 50):
+        self.name = name
+        self.model = model
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.unhealthy_until = 0.0
+
+    def record_success(self, latency: float):
+        """记录一次成功请求及其首字延迟"""
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+            self._outcomes.append(True)
+
+    def record_failure(self, max_error_rate: float, min_samples: int, cooldown: float,
+                       latency: Optional[float] = None):
+        """记录一次失败请求，错误率超过阈值时暂停使用该后端
+
+        首字超时的请求以超时时间计入延迟统计。
+        """
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            if latency is not None:
+                self._latencies.append(latency)
+            self._outcomes.append(False)
+            if len(self._outcomes) >= min_samples and self._error_rate() >= max_error_rate:
+                self.unhealthy_until = time.monotonic() + cooldown
+                # 冷却结束后重新统计，避免一直被历史错误拖累
+                self._outcomes.clear()
+
+    def percentile(self, q: float) -> Optional[float]:
+        """首字延迟的分位数（秒），暂无数据时返回None"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[int(q * (len(latencies) - 1))]
+
+    def _error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            return self._error_rate()
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def stats(self) -> Dict[str, Any]:
+        """获取后端统计信息"""
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "name": self.name,
+            "model": getattr(self.model, 'model_name', None),
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "failures": self.failures,
+            "error_rate": round(self.error_rate, 4),
+            "p50_first_token": round(p50, 3) if p50 is not None else None,
+            "p95_first_token": round(p95, 3) if p95 is not None else None
+        }
+
+
+class LLMRouter(BaseChatModel):
+    """多后端大模型路由
+
+    每次请求按滚动p50首字延迟选择最快的健康后端；首个输出片段（含推理过程等无正文的片段）
+    超过first_token_timeout未返回或请求出错时，切换到下一个后端重新请求，放弃的请求随即关闭。
+    首个片段返回后不再切换；最后一个后端不按首字超时切换，只受请求超时限制。
+    bind/invoke传入的参数（如max_tokens、temperature）原样传给后端；
+    backend_models为{后端名称: 模型}，只替换所列后端的模型；
+    传入timeout时作为整个请求（含切换后端和首字之后的输出）的时间上限，超出时抛出DeadlineExceeded。
+    """
+
+    backends: List[Any]
+    first_token_timeout: float = 15.0
+    max_error_rate: float = 0.5
+    min_samples: int = 5
+    cooldown: float = 30.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm_router"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"backends": [backend.name for backend in self.backends]}
+
+    def select_backends(self) -> List[LLMBackend]:
+        """按优先级排列后端：健康的在前，暂无延迟数据的优先采样，其余按p50升序"""
+        healthy = [backend for backend in self.backends if backend.healthy]
+        unhealthy = [backend for backend in self.backends if not backend.healthy]
+        healthy.sort(key=lambda backend: backend.percentile(0.5) or 0.0)
+        # 所有后端都不健康时仍按冷却结束时间依次尝试
+        unhealthy.sort(key=lambda backend: backend.unhealthy_until)
+        return healthy + unhealthy
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        # 统一走流式请求，以便按首字延迟切换后端
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        errors = []
+        backend_models = kwargs.pop('backend_models', None) or {}
+        request_timeout = kwargs.get('timeout')
+        expires_at = time.monotonic() + request_timeout if request_timeout else None
+        backends = self.select_backends()
+        for position, backend in enumerate(backends):
+            started = time.monotonic()
+            # 最后一个后端没有可切换的对象，首字等待只受请求超时限制
+            can_switch = position < len(backends) - 1
+            first_token_timeout = self.first_token_timeout if can_switch else None
+            backend_kwargs = dict(kwargs)
+            if backend.name in backend_models:
+                backend_kwargs['model'] = backend_models[backend.name]
+            if expires_at is not None:
+                remaining = expires_at - started
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"大模型请求超时({request_timeout:g}秒): {'; '.join(errors)}")
+                # 后端请求的超时取剩余时间
+                backend_kwargs['timeout'] = remaining
+                first_token_timeout = remaining if first_token_timeout is None else min(first_token_timeout, remaining)
+            chunks, cancelled = self._start_stream(backend, messages, stop, backend_kwargs)
+            try:
+                buffered = self._wait_first_token(chunks, started, first_token_timeout)
+            except Exception as e:
+                cancelled.set()
+                if not isinstance(e, TimeoutError):
+                    self._record_failure(backend)
+                elif can_switch and first_token_timeout >= self.first_token_timeout:
+                    # 首字超时计入错误率；因请求剩余时间不足而提前结束等待的不计入
+                    self._record_failure(backend, first_token_timeout)
+                errors.append(f"{backend.name}: {str(e) or type(e).__name__}")
+                logger.warning(f"大模型后端{backend.name}请求失败，切换后端: {str(e) or type(e).__name__}")
+                continue
+
+            backend.record_success(time.monotonic() - started)
+            try:
+                for chunk in buffered:
+                    yield self._to_generation_chunk(chunk, run_manager)
+                while True:
+                    try:
+                        item = chunks.get(timeout=None if expires_at is None
+                                          else max(0.0, expires_at - time.monotonic()))
+                    except queue.Empty:
+                        raise DeadlineExceeded(f"大模型请求超时({request_timeout:g}秒): {backend.name}输出未完成")
+                    if item is _STREAM_DONE:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield self._to_generation_chunk(item, run_manager)
+            except Exception as e:
+                # 首字之后出错无法切换后端，计入错误率后直接抛出（请求超时不计入）
+                if not isinstance(e, DeadlineExceeded):
+                    self._record_failure(backend)
+                raise
+            finally:
+                cancelled.set()
+
+        if expires_at is not None and time.monotonic() >= expires_at:
+            raise DeadlineExceeded(f"大模型请求超时({request_timeout:g}秒): {'; '.join(errors)}")
+        raise RuntimeError(f"所有大模型后端均不可用: {'; '.join(errors)}")
+
+    def _start_stream(self, backend: LLMBackend, messages: List[BaseMessage], stop: Optional[List[str]],
+                      kwargs: Dict[str, Any]):
+        """在后台线程中请求后端，输出片段放入队列；cancelled置位后关闭后端的流"""
+        chunks: queue.Queue = queue.Queue()
+        cancelled = threading.Event()
+
+        def worker():
+            stream = backend.model.stream(messages, stop=stop, **kwargs)
+            try:
+                for chunk in stream:
+                    if cancelled.is_set():
+                        break
+                    chunks.put(chunk)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                # 关闭流即断开与后端的连接，已放弃的请求不再继续生成
+                stream.close()
+                chunks.put(_STREAM_DONE)
+
+        threading.Thread(target=worker, name=f"llm-{backend.name}", daemon=True).start()
+        return chunks, cancelled
+
+    @staticmethod
+    def _wait_first_token(chunks: queue.Queue, started: float, timeout: Optional[float]) -> List[Any]:
+        """等待首个输出片段（推理过程等无正文的片段也算），超时或出错时抛出异常
+
+        timeout为None时不限制等待时间。返回已收到的片段。
+        """
+        remaining = None if timeout is None else timeout - (time.monotonic() - started)
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"首字超时({timeout:.1f}秒)")
+        try:
+            item = chunks.get(timeout=remaining)
+        except queue.Empty:
+            raise TimeoutError(f"首字超时({timeout:.1f}秒)")
+        if isinstance(item, Exception):
+            raise item
+        if item is _STREAM_DONE:
+            # 空响应也视为成功，放回结束标记
+            chunks.put(_STREAM_DONE)
+            return []
+        return [item]
+
+    def _record_failure(self, backend: LLMBackend, latency: Optional[float] = None):
+        backend.record_failure(self.max_error_rate, self.min_samples, self.cooldown, latency)
+
+    @staticmethod
+    def _to_generation_chunk(chunk, run_manager: Optional[CallbackManagerForLLMRun]) -> ChatGenerationChunk:
+        generation_chunk = ChatGenerationChunk(message=chunk)
+        if run_manager:
+            run_manager.on_llm_new_token(chunk.content, chunk=generation_chunk)
+        return generation_chunk
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """获取各后端统计信息"""
+        return [backend.stats() for backend in self.backends]
+
+
+def load_backend_configs(settings: Settings) -> List[Dict[str, Any]]:
+    """读取后端配置，未配置LLM_BACKENDS时使用LLM_PROVIDER对应的单个后端"""
+    if settings.LLM_BACKENDS.strip():
+        try:
+            configs = json.loads(settings.LLM_BACKENDS)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"LLM_BACKENDS配置格式错误: {str(e)}")
+        if not isinstance(configs, list) or not configs:
+            raise ValueError("LLM_BACKENDS必须是非空的JSON数组")
+        return configs
+
+    return [{
+        "name": settings.LLM_PROVIDER,
+        "provider": settings.LLM_PROVIDER,
+        "model": settings.DEEPSEEK_MODEL_NAME,
+        "api_key": settings.DEEPSEEK_API_KEY,
+        "base_url": settings.DEEPSEEK_API_BASE_URL
+    }]
+
+
+def parse_backend_models(value: str, settings: Settings) -> Dict[str, str]:
+    """解析按后端指定的模型：JSON对象为{后端名称: 模型}，纯模型名只用于默认后端（名称为LLM_PROVIDER）"""
+    value = (value or "").strip()
+    if not value:
+        return {}
+    if not value.startswith('{'):
+        return {settings.LLM_PROVIDER: value}
+    try:
+        models = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"分级模型配置格式错误: {str(e)}")
+    if not isinstance(models, dict):
+        raise ValueError("分级模型配置必须是JSON对象")
+    return {str(name): str(model) for name, model in models.items() if model}
+
+
+def create_llm_router(settings: Optional[Settings] = None) -> LLMRouter:
+    """根据配置创建大模型路由"""
+    settings = settings or Settings()
+    backends = []
+    for index, config in enumerate(load_backend_configs(settings)):
+        config = dict(config)
+        name = config.pop('name', None) or f"backend{index}"
+        provider = config.pop('provider', 'chatopenai')
+        api_key_env = config.pop('api_key_env', None)
+        api_key = config.pop('api_key', None) or (os.getenv(api_key_env, "") if api_key_env else "")
+        model_kwargs = {
+            "temperature": settings.LLM_TEMPERATURE,
+            "max_tokens": settings.LLM_MAX_TOKENS,
+            "top_p": settings.LLM_TOP_P,
+            **config
+        }
+        model = model_kwargs.pop('model', settings.DEEPSEEK_MODEL_NAME)
+        base_url = model_kwargs.pop('base_url', None)
+        backends.append(LLMBackend(
+            name=name,
+            model=create_chat_model(provider, model, api_key, base_url, **model_kwargs),
+            window=settings.LLM_ROUTER_WINDOW
+        ))
+
+    return LLMRouter(
+        backends=backends,
+        first_token_timeout=settings.LLM_FIRST_TOKEN_TIMEOUT,
+        max_error_rate=settings.LLM_ROUTER_MAX_ERROR_RATE,
+        min_samples=settings.LLM_ROUTER_MIN_SAMPLES,
+        cooldown=settings.LLM_ROUTER_COOLDOWN
+    )
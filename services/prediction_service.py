@@ -1,37 +1,238 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
 import json
-from langchain_openai import ChatOpenAI
+import queue
+import threading
 from langchain.prompts import PromptTemplate
 
 from models.user_info import UserInfo
 from models.prediction_result import PredictionResult
+from models.conversation import Conversation
 from services.bazi_service import BaziService
+from services.llm_router import LLMRouter, create_llm_router, parse_backend_models
 from config.settings import Settings
+from utils.cache import create_cache
+from utils.data_projection import DataProjector, estimate_tokens
+from utils.deadline import Deadline, DeadlineExceeded
 from utils.logger import logger
-from langchain_deepseek import ChatDeepSeek
+from utils.singleflight import SingleFlight
+
+# 章节生成结束标记
+_SECTION_DONE = object()
 
 class PredictionService:
     """预测服务"""
     
-    def __init__(self):
+    # 预测类型对应的展示名称和日志动作
+    PREDICTION_TYPES = {
+        'comprehensive': {'label': '综合运势', 'action': '综合预测'},
+        'career': {'label': '事业运势', 'action': '事业预测'},
+        'relationship': {'label': '感情运势', 'action': '感情预测'}
+    }
+    
+    # 不参与响应缓存键计算的提示词输入字段
+    VOLATILE_PROMPT_FIELDS = ('current_time', 'current_date')
+    
+    # 流式生成超出时间预算时追加的提示
+    TRUNCATED_NOTICE = "\n\n（生成超时，以上内容未完整生成，请稍后重试）"
+    
+    # 分章节生成时综合报告的章节（按此顺序拼接）
+    REPORT_SECTIONS = {
+        'personality': {'title': '性格特点', 'focus': '结合日主、五行和十神分析性格特点、优势与短板，并给出个人成长建议'},
+        'career': {'title': '事业发展', 'focus': '分析适合的职业方向和行业、事业发展的关键时间节点和需要注意的风险'},
+        'wealth': {'title': '财运分析', 'focus': '分析正财偏财、财富积累方式、近期流年的财运起伏和理财建议'},
+        'relationship': {'title': '感情婚姻', 'focus': '分析感情特点、婚恋时机、伴侣相处方式和六亲关系'},
+        'health': {'title': '健康养生', 'focus': '根据五行旺衰分析需要关注的身体部位和健康隐患，给出养生建议'}
+    }
+    
+    # 命理数据的分析说明（prefix_cache布局中置于数据之前，保持前缀稳定）
+    DATA_INSTRUCTIONS = """请根据下面的JSON数据进行全面的命理分析，数据包含：
+1. 八字信息：四柱、格局、十神、五行等基础命理要素
+2. 运势信息：各方面运势分析和预测
+3. 详细分析：性格特点、发展建议等深度解读
+
+请综合所有信息进行专业分析，不要在回答中显示原始JSON数据。"""
+    
+    def __init__(self, bazi_service: Optional[BaziService] = None, llm: Optional[LLMRouter] = None):
         self.settings = Settings()
-        self.bazi_service = BaziService()
-        self._setup_llm()
+        self.bazi_service = bazi_service or BaziService()
+        self._setup_llm(llm)
         self._setup_prompts()
+        self._setup_response_cache()
+        self._setup_two_stage()
+        self._setup_followup_prompts()
+        self._setup_section_prompt()
+        self.projector = DataProjector() if self.settings.PROMPT_PROJECTION_ENABLED else None
+        self._prompt_stats = {"prompts": 0, "before_tokens": 0, "after_tokens": 0}
+        self._usage_stats = {"calls": 0, "prompt_tokens": 0, "cache_hit_tokens": 0, "cache_miss_tokens": 0}
+        self._inflight_llm_calls = 0
+        self._tier_stats = {"light": 0, "standard": 0, "heavy": 0}
+        self._stats_lock = threading.Lock()
+    
+    def _setup_llm(self, llm: Optional[LLMRouter] = None):
+        """设置大语言模型（未传入时按配置的后端创建路由）"""
+        self.llm = llm or create_llm_router(self.settings)
+    
+    def _setup_response_cache(self):
+        """设置大模型响应缓存"""
+        self.response_cache = None
+        if self.settings.LLM_CACHE_ENABLED:
+            self.response_cache = create_cache(
+                namespace='llm',
+                ttl=self.settings.LLM_CACHE_TTL,
+                max_entries=self.settings.LLM_CACHE_MAX_ENTRIES,
+                max_bytes=self.settings.LLM_CACHE_MAX_BYTES,
+                backend=self.settings.LLM_CACHE_BACKEND
+            )
+    
+    def _setup_two_stage(self):
+        """设置两阶段生成：命盘分析摘要的提示词、缓存和回答提示词"""
+        self.digest_cache = None
+        if not self.settings.TWO_STAGE_ENABLED:
+            return
+        
+        self.digest_cache = create_cache(
+            namespace='digest',
+            ttl=self.settings.DIGEST_CACHE_TTL,
+            max_entries=self.settings.DIGEST_CACHE_MAX_ENTRIES,
+            max_bytes=self.settings.DIGEST_CACHE_MAX_BYTES,
+            backend=self.settings.DIGEST_CACHE_BACKEND
+        )
+        self._digest_inflight = SingleFlight()
+        
+        # 第一阶段：根据完整命理数据生成摘要（与姓名无关，按命盘共享）
+        digest_template = f"""
+{self.settings.SYSTEM_PROMPT_DIGEST.strip()}
+
+性别：{{gender}}
+
+完整命理分析数据（JSON格式）：
+{{complete_data}}
+
+请输出命盘分析摘要：
+        """
+        self.digest_prompt = PromptTemplate(
+            input_variables=["gender", "complete_data"],
+            template=digest_template
+        )
+        
+        # 第二阶段：基于摘要回答，稳定内容在前以便命中前缀缓存
+        answer_templates = {
+            'comprehensive': (self.settings.SYSTEM_PROMPT_COMPREHENSIVE, "用户咨询：{question}\n\n", "请开始你的分析："),
+            'career': (self.settings.SYSTEM_PROMPT_CAREER, "", "请开始你的事业分析："),
+            'relationship': (self.settings.SYSTEM_PROMPT_RELATIONSHIP, "", "请开始你的感情分析：")
+        }
+        self.answer_prompts = {}
+        for prediction_type, (system_prompt, question_part, closing) in answer_templates.items():
+            template = f"""
+{system_prompt.strip()}
+
+以下是根据用户完整命理数据整理的命盘分析摘要，请以摘要中的结论和数据为依据进行分析：
+{{digest}}
+
+用户信息：
+姓名：{{user_name}}
+性别：{{gender}}
+
+{question_part}当前日期：{{current_date}}
+
+{closing}
+        """
+            input_variables = ["digest", "user_name", "gender", "current_date"]
+            if question_part:
+                input_variables.append("question")
+            self.answer_prompts[prediction_type] = PromptTemplate(
+                input_variables=input_variables, template=template
+            )
+    
+    def _setup_followup_prompts(self):
+        """设置追问对话的提示词模板"""
+        # 命理数据在前，报告、对话摘要和最近对话在后，当前日期放在末尾
+        followup_template = f"""
+{self.settings.SYSTEM_PROMPT_FOLLOWUP.strip()}
+
+用户命理数据：
+{{chart_context}}
+
+用户信息：
+姓名：{{user_name}}
+性别：{{gender}}
+
+之前的{{prediction_type}}报告（节选）：
+{{report}}
+
+较早对话摘要：
+{{summary}}
+
+最近对话：
+{{recent_turns}}
+
+当前日期：{{current_date}}
+
+用户新的问题：{{question}}
+
+请直接回答用户的新问题：
+        """
+        self.followup_prompt = PromptTemplate(
+            input_variables=["chart_context", "user_name", "gender", "prediction_type", "report",
+                             "summary", "recent_turns", "current_date", "question"],
+            template=followup_template
+        )
+        
+        # 将较早的对话合并到摘要中
+        summary_template = """
+请将已有的对话摘要和新增的对话合并为一份简洁的摘要，保留用户关心的问题、给出的关键结论和建议，字数控制在300字以内，只输出摘要内容。
+
+已有摘要：
+{summary}
+
+新增对话：
+{turns}
+
+合并后的摘要：
+        """
+        self.conversation_summary_prompt = PromptTemplate(
+            input_variables=["summary", "turns"],
+            template=summary_template
+        )
     
-    def _setup_llm(self):
-        """设置大语言模型"""
-        self.llm = ChatDeepSeek(
-            api_key=self.settings.DEEPSEEK_API_KEY,
-            model=self.settings.DEEPSEEK_MODEL_NAME,
-            temperature=self.settings.LLM_TEMPERATURE,
-            max_tokens=self.settings.LLM_MAX_TOKENS,
-            top_p=self.settings.LLM_TOP_P
+    def _setup_section_prompt(self):
+        """设置分章节生成的提示词模板"""
+        # 章节要求放在末尾，各章节共享命理数据部分的前缀
+        section_template = f"""
+{self.settings.SYSTEM_PROMPT_SECTION.strip()}
+
+用户命理数据：
+{{chart_context}}
+
+用户信息：
+姓名：{{user_name}}
+性别：{{gender}}
+
+用户咨询：{{question}}
+
+当前日期：{{current_date}}
+
+本次撰写的章节：{{section_title}}
+写作要点：{{section_focus}}
+
+请撰写本章节：
+        """
+        self.section_prompt = PromptTemplate(
+            input_variables=["chart_context", "user_name", "gender", "question", "current_date",
+                             "section_title", "section_focus"],
+            template=section_template
         )
     
     def _setup_prompts(self):
         """设置提示词模板"""
+        if self.settings.PROMPT_LAYOUT == 'prefix_cache':
+            self._setup_prefix_cache_prompts()
+            return
+        
         # 综合预测提示词模板
         comprehensive_template = f"""
 {self.settings.SYSTEM_PROMPT_COMPREHENSIVE.strip()}
@@ -97,83 +298,515 @@ class PredictionService:
             template=relationship_template
         )
     
-    def get_comprehensive_prediction(self, user_info: UserInfo) -> PredictionResult:
+    def _setup_prefix_cache_prompts(self):
+        """设置前缀缓存友好的提示词模板
+        
+        按"系统提示词 → 分析说明 → 命理数据 → 用户信息 → 咨询问题 → 当前日期"排列，
+        同一命盘、同一预测类型的请求共享尽可能长的提示词前缀，日期精确到天并放在末尾。
+        """
+        templates = {
+            'comprehensive': (self.settings.SYSTEM_PROMPT_COMPREHENSIVE, "用户咨询：{question}\n\n", "请开始你的分析："),
+            'career': (self.settings.SYSTEM_PROMPT_CAREER, "", "请开始你的事业分析："),
+            'relationship': (self.settings.SYSTEM_PROMPT_RELATIONSHIP, "", "请开始你的感情分析：")
+        }
+        
+        prompts = {}
+        for prediction_type, (system_prompt, question_part, closing) in templates.items():
+            template = f"""
+{system_prompt.strip()}
+
+{self.DATA_INSTRUCTIONS}
+
+完整命理分析数据（JSON格式）：
+{{complete_data}}
+
+用户信息：
+姓名：{{user_name}}
+性别：{{gender}}
+
+{question_part}当前日期：{{current_date}}
+
+{closing}
+        """
+            input_variables = ["complete_data", "user_name", "gender", "current_date"]
+            if question_part:
+                input_variables.append("question")
+            prompts[prediction_type] = PromptTemplate(input_variables=input_variables, template=template)
+        
+        self.comprehensive_prompt = prompts['comprehensive']
+        self.career_prompt = prompts['career']
+        self.relationship_prompt = prompts['relationship']
+    
+    def get_comprehensive_prediction(self, user_info: UserInfo, use_cache: bool = True) -> PredictionResult:
         """获取综合预测"""
-        logger.log_user_action("综合预测请求", user_info.dict())
+        return self.get_prediction(user_info, 'comprehensive', use_cache=use_cache)
+    
+    def get_career_prediction(self, user_info: UserInfo, use_cache: bool = True) -> PredictionResult:
+        """获取事业预测"""
+        return self.get_prediction(user_info, 'career', use_cache=use_cache)
+    
+    def get_relationship_prediction(self, user_info: UserInfo, use_cache: bool = True) -> PredictionResult:
+        """获取感情预测"""
+        return self.get_prediction(user_info, 'relationship', use_cache=use_cache)
+    
+    def get_predictions(self, user_info: UserInfo, types: Optional[List[str]] = None,
+                        use_cache: bool = True) -> Iterator[PredictionResult]:
+        """一次获取多种类型的预测，按完成顺序返回结果
         
-        # 获取运势数据（包含八字信息）
-        fortune_data = self.bazi_service.get_fortune_analysis(user_info, 'comprehensive')
+        运势数据只获取一次，各类型的大模型生成并发执行，
+        总耗时接近最慢的单个报告。某个类型生成失败不影响其他类型，
+        其余结果全部返回后再抛出首个异常。
+        """
+        types = list(dict.fromkeys(types or self.PREDICTION_TYPES))
+        unknown_types = [t for t in types if t not in self.PREDICTION_TYPES]
+        if unknown_types:
+            raise ValueError(f"不支持的预测类型: {', '.join(unknown_types)}")
+        
+        logger.log_user_action("多类型预测请求", user_info.dict(), details=",".join(types))
+        
+        # 获取运势数据（包含八字信息），各类型共用；各类型共享同一个时间预算
+        deadline = Deadline(self.settings.REQUEST_DEADLINE)
+        fortune_data = self.bazi_service.get_fortune_analysis(user_info, types[0], deadline=deadline)
+        
+        executor = ThreadPoolExecutor(max_workers=len(types), thread_name_prefix='prediction')
+        try:
+            futures = {
+                executor.submit(self.get_prediction, user_info, prediction_type, use_cache, fortune_data,
+                                deadline): prediction_type
+                for prediction_type in types
+            }
+            errors = []
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    action = self.PREDICTION_TYPES[futures[future]]['action']
+                    logger.log_prediction_request(user_info.name, action, False, str(e))
+                    errors.append(e)
+                    continue
+                yield result
+            if errors:
+                raise errors[0]
+        finally:
+            # 调用方提前结束迭代时不再等待剩余任务
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def get_prediction(self, user_info: UserInfo, prediction_type: str = 'comprehensive', use_cache: bool = True,
+                       fortune_data: Optional[Dict[str, Any]] = None,
+                       deadline: Optional[Deadline] = None) -> PredictionResult:
+        """获取指定类型的预测，已获取运势数据时可通过fortune_data传入
+        
+        deadline为请求整体的时间预算，未传入时按REQUEST_DEADLINE新建。
+        """
+        action = self.PREDICTION_TYPES[prediction_type]['action']
+        logger.log_user_action(f"{action}请求", user_info.dict())
+        deadline = deadline or Deadline(self.settings.REQUEST_DEADLINE)
+        
+        if fortune_data is None:
+            fortune_data = self.bazi_service.get_fortune_analysis(user_info, prediction_type, deadline=deadline)
         
-        # 生成AI预测
         prediction_content = self._generate_prediction(
-            user_info, fortune_data, 'comprehensive'
+            user_info, fortune_data, prediction_type, use_cache=use_cache, deadline=deadline
         )
         
-        # 创建预测结果
-        result = PredictionResult(
-            user_name=user_info.name,
-            prediction_time=datetime.now(),
-            bazi_summary="",  # 不再显示八字摘要
-            prediction_content=prediction_content,
-            prediction_type="综合运势"
+        result = self.create_prediction_result(
+            user_info, prediction_type, prediction_content, data_stale=getattr(fortune_data, 'is_stale', False)
         )
-        
-        logger.log_prediction_request(user_info.name, "综合预测", True)
+        logger.log_prediction_request(user_info.name, action, True)
         return result
     
-    def get_career_prediction(self, user_info: UserInfo) -> PredictionResult:
-        """获取事业预测"""
-        logger.log_user_action("事业预测请求", user_info.dict())
+    def stream_prediction(self, user_info: UserInfo, prediction_type: str = 'comprehensive',
+                          use_cache: bool = True, fortune_data: Optional[Dict[str, Any]] = None,
+                          deadline: Optional[Deadline] = None) -> Iterator[str]:
+        """流式获取预测内容，逐段返回生成的文本
         
-        # 获取运势数据（包含八字信息）
-        fortune_data = self.bazi_service.get_fortune_analysis(user_info, 'career')
+        调用方拼接全部文本后可通过create_prediction_result构建预测结果。
+        超出时间预算时停止生成，以TRUNCATED_NOTICE结尾。
+        """
+        action = self.PREDICTION_TYPES[prediction_type]['action']
+        logger.log_user_action(f"{action}请求", user_info.dict())
+        deadline = deadline or Deadline(self.settings.REQUEST_DEADLINE)
         
-        # 生成AI预测
-        prediction_content = self._generate_prediction(
-            user_info, fortune_data, 'career'
-        )
+        # 获取运势数据（包含八字信息）
+        if fortune_data is None:
+            fortune_data = self.bazi_service.get_fortune_analysis(user_info, prediction_type, deadline=deadline)
         
-        # 创建预测结果
-        result = PredictionResult(
+        yield from self._stream_prediction(user_info, fortune_data, prediction_type, use_cache=use_cache,
+                                           deadline=deadline)
+        logger.log_prediction_request(user_info.name, action, True)
+    
+    def create_prediction_result(self, user_info: UserInfo, prediction_type: str, prediction_content: str,
+                                 data_stale: bool = False) -> PredictionResult:
+        """根据生成的内容创建预测结果"""
+        return PredictionResult(
             user_name=user_info.name,
             prediction_time=datetime.now(),
             bazi_summary="",  # 不再显示八字摘要
-            prediction_content=prediction_content,
-            prediction_type="事业运势"
+            prediction_content=prediction_content.strip(),
+            prediction_type=self.PREDICTION_TYPES[prediction_type]['label'],
+            data_stale=data_stale
         )
+    
+    def start_conversation(self, result: PredictionResult) -> Conversation:
+        """基于预测结果开始追问对话"""
+        return Conversation(
+            user_name=result.user_name,
+            prediction_type=result.prediction_type,
+            report=result.prediction_content
+        )
+    
+    def ask_followup(self, user_info: UserInfo, conversation: Conversation, question: str,
+                     deadline: Optional[Deadline] = None) -> str:
+        """追问：基于命盘数据、之前的报告和对话记录回答新问题"""
+        return "".join(self.stream_followup(user_info, conversation, question, deadline)).strip()
+    
+    def stream_followup(self, user_info: UserInfo, conversation: Conversation, question: str,
+                        deadline: Optional[Deadline] = None) -> Iterator[str]:
+        """流式追问，完整回答后记录到对话中并压缩较早的对话
         
-        logger.log_prediction_request(user_info.name, "事业预测", True)
-        return result
+        命盘数据来自缓存（不重新请求排盘接口），对话上下文只包含
+        报告节选、较早对话的摘要和最近几轮原文。
+        deadline未传入时按REQUEST_DEADLINE新建；超出时间预算时停止生成，以TRUNCATED_NOTICE结尾，不记录本轮对话。
+        """
+        question = (question or "").strip()
+        if not question:
+            raise ValueError("问题不能为空")
+        if len(question) > 500:
+            raise ValueError("问题长度不能超过500个字符")
+        
+        logger.log_user_action("追问请求", user_info.dict(), details=question)
+        deadline = deadline or Deadline(self.settings.REQUEST_DEADLINE)
+        
+        chain_input = {
+            "chart_context": self._get_chart_context(user_info, deadline=deadline),
+            "user_name": user_info.name,
+            "gender": user_info.gender,
+            "prediction_type": conversation.prediction_type,
+            "report": conversation.report[:self.settings.FOLLOWUP_REPORT_MAX_CHARS],
+            "summary": conversation.summary or "（无）",
+            "recent_turns": conversation.format_recent_turns(),
+            "current_date": datetime.now().strftime('%Y年%m月%d日'),
+            "question": question
+        }
+        
+        chain = self.followup_prompt | self.llm.bind(max_tokens=self.settings.FOLLOWUP_MAX_TOKENS,
+                                                     timeout=deadline.timeout())
+        chunks = []
+        for chunk in self._stream_within_deadline(chain, chain_input, deadline, chunks):
+            if getattr(chunk, 'usage_metadata', None):
+                self._record_usage(chunk, 'followup')
+            text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+            if text:
+                chunks.append(text)
+                yield text
+        if deadline.expired:
+            logger.warning(f"追问回答超时，内容未完整: {user_info.name}")
+            yield self.TRUNCATED_NOTICE
+            return
+        
+        conversation.add_turn(question, "".join(chunks).strip())
+        self._compact_conversation(conversation, deadline)
+        logger.log_prediction_request(user_info.name, "追问", True)
     
-    def get_relationship_prediction(self, user_info: UserInfo) -> PredictionResult:
-        """获取感情预测"""
-        logger.log_user_action("感情预测请求", user_info.dict())
+    def _get_chart_context(self, user_info: UserInfo, fortune_data: Optional[Dict[str, Any]] = None,
+                           deadline: Optional[Deadline] = None) -> str:
+        """获取提示词使用的命盘数据（启用两阶段生成时使用命盘分析摘要）"""
+        if fortune_data is None:
+            # 命盘数据已在生成报告时缓存
+            fortune_data = self.bazi_service.get_fortune_analysis(user_info, deadline=deadline)
+        if self.digest_cache is not None:
+            return self.get_chart_digest(user_info, fortune_data, deadline)
+        return self._serialize_fortune_data(BaziService._strip_name_fields(fortune_data), 'comprehensive')
+    
+    def _compact_conversation(self, conversation: Conversation, deadline: Optional[Deadline] = None):
+        """将超出保留轮数的较早对话合并到摘要中（超出时间预算时按摘要失败处理）"""
+        overflow = conversation.pop_overflow_turns(self.settings.FOLLOWUP_MAX_RECENT_TURNS)
+        if not overflow:
+            return
         
-        # 获取运势数据（包含八字信息）
-        fortune_data = self.bazi_service.get_fortune_analysis(user_info, 'relationship')
+        turns_text = "\n\n".join(f"用户：{turn.question}\n命理师：{turn.answer}" for turn in overflow)
+        try:
+            chain = self.conversation_summary_prompt | self.llm.bind(
+                max_tokens=self.settings.FOLLOWUP_SUMMARY_MAX_TOKENS,
+                **({"timeout": deadline.timeout()} if deadline is not None else {})
+            )
+            result = chain.invoke({"summary": conversation.summary or "（无）", "turns": turns_text})
+            self._record_usage(result, 'conversation_summary')
+            summary = result.content.strip() if hasattr(result, 'content') else str(result).strip()
+        except Exception as e:
+            # 摘要失败时只保留问题，避免上下文无限增长
+            logger.warning(f"对话摘要生成失败: {str(e)}")
+            questions = [f"用户曾询问：{turn.question}" for turn in overflow]
+            summary = "\n".join(filter(None, [conversation.summary] + questions))[-1000:]
         
-        # 生成AI预测
-        prediction_content = self._generate_prediction(
-            user_info, fortune_data, 'relationship'
-        )
+        conversation.summary = summary
+    
+    def _generate_prediction(self, user_info: UserInfo, fortune_data: Dict[str, Any], prediction_type: str,
+                             use_cache: bool = True, deadline: Optional[Deadline] = None) -> str:
+        """生成AI预测内容
         
-        # 创建预测结果
-        result = PredictionResult(
-            user_name=user_info.name,
-            prediction_time=datetime.now(),
-            bazi_summary="",  # 不再显示八字摘要
-            prediction_content=prediction_content,
-            prediction_type="感情运势"
+        use_cache为False时跳过响应缓存的读取（重新生成），生成结果仍会写入缓存。
+        传入deadline时大模型请求的超时不超过剩余时间，预算已耗尽时抛出DeadlineExceeded。
+        """
+        if self._use_sections(prediction_type):
+            return "".join(self._stream_sections(user_info, fortune_data, use_cache, deadline)).strip()
+        
+        prompt, chain_input = self._build_chain_input(user_info, fortune_data, prediction_type, deadline)
+        llm_params = self._select_llm_params(user_info, prediction_type)
+        
+        # 检查响应缓存
+        cache_key = self._generate_response_cache_key(prediction_type, prompt, chain_input, llm_params)
+        cached_content = self._get_cached_response(cache_key, use_cache)
+        if cached_content is not None:
+            logger.info(f"从缓存获取预测内容: {user_info.name}, 类型: {prediction_type}")
+            return cached_content
+        
+        if deadline is not None:
+            deadline.check("生成预测")
+        
+        # 使用LLM生成预测
+        chain = prompt | self._bind_llm(llm_params, deadline)
+        with self._track_llm_call():
+            result = chain.invoke(chain_input)
+        self._record_usage(result, prediction_type)
+        content = result.content.strip() if hasattr(result, 'content') else str(result).strip()
+        
+        self._set_cached_response(cache_key, content)
+        return content
+    
+    def _stream_prediction(self, user_info: UserInfo, fortune_data: Dict[str, Any], prediction_type: str,
+                           use_cache: bool = True, deadline: Optional[Deadline] = None) -> Iterator[str]:
+        """流式生成AI预测内容，完整生成后写入响应缓存"""
+        if self._use_sections(prediction_type):
+            yield from self._stream_sections(user_info, fortune_data, use_cache, deadline)
+            return
+        
+        prompt, chain_input = self._build_chain_input(user_info, fortune_data, prediction_type, deadline)
+        llm_params = self._select_llm_params(user_info, prediction_type)
+        
+        # 缓存命中时一次性返回完整内容
+        cache_key = self._generate_response_cache_key(prediction_type, prompt, chain_input, llm_params)
+        cached_content = self._get_cached_response(cache_key, use_cache)
+        if cached_content is not None:
+            logger.info(f"从缓存获取预测内容: {user_info.name}, 类型: {prediction_type}")
+            yield cached_content
+            return
+        
+        if deadline is not None:
+            deadline.check("生成预测")
+        
+        # 使用LLM流式生成预测
+        chain = prompt | self._bind_llm(llm_params, deadline)
+        chunks = []
+        with self._track_llm_call():
+            for chunk in self._stream_within_deadline(chain, chain_input, deadline, chunks):
+                if getattr(chunk, 'usage_metadata', None):
+                    # token用量在最后一个数据块中返回
+                    self._record_usage(chunk, prediction_type)
+                text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                if text:
+                    chunks.append(text)
+                    yield text
+                if deadline is not None and deadline.expired:
+                    # 超出时间预算时保留已生成的内容，不写入缓存
+                    logger.warning(f"预测生成超时，内容未完整: {user_info.name}, 类型: {prediction_type}")
+                    yield self.TRUNCATED_NOTICE
+                    return
+        
+            if deadline is not None and deadline.expired:
+                # 输出中途超时（大模型路由在剩余时间用完时结束等待）
+                logger.warning(f"预测生成超时，内容未完整: {user_info.name}, 类型: {prediction_type}")
+                yield self.TRUNCATED_NOTICE
+                return
+        
+        # 只有完整生成的内容才写入缓存
+        self._set_cached_response(cache_key, "".join(chunks).strip())
+    
+    @staticmethod
+    def _stream_within_deadline(chain, chain_input: Dict[str, Any], deadline: Optional[Deadline],
+                                received: List[str]) -> Iterator[Any]:
+        """流式调用大模型；已有输出（received非空）后超出时间预算时正常结束，由调用方追加TRUNCATED_NOTICE"""
+        try:
+            yield from chain.stream(chain_input)
+        except DeadlineExceeded:
+            if deadline is None or not received:
+                raise
+    
+    def _select_llm_params(self, user_info: UserInfo, prediction_type: str) -> Dict[str, Any]:
+        """按预测类型、问题长度和当前负载选择模型档位
+        
+        - 综合预测且问题较长：heavy档位
+        - 事业、感情预测且无具体问题（或问题较短）：light档位
+        - 其余：standard档位；进行中的大模型调用较多时standard降为light，heavy不降档
+        
+        models为档位按后端指定的模型（{后端名称: 模型}），为空时各后端使用其配置的模型。
+        """
+        settings = self.settings
+        tiers = {
+            'light': {"models": parse_backend_models(settings.LLM_TIER_LIGHT_MODEL, settings),
+                      "max_tokens": settings.LLM_TIER_LIGHT_MAX_TOKENS,
+                      "temperature": settings.LLM_TIER_LIGHT_TEMPERATURE},
+            'standard': {"models": {}, "max_tokens": settings.LLM_MAX_TOKENS,
+                         "temperature": settings.LLM_TEMPERATURE},
+            'heavy': {"models": parse_backend_models(settings.LLM_TIER_HEAVY_MODEL, settings),
+                      "max_tokens": settings.LLM_TIER_HEAVY_MAX_TOKENS,
+                      "temperature": settings.LLM_TIER_HEAVY_TEMPERATURE}
+        }
+        if not settings.LLM_TIER_ROUTING_ENABLED:
+            return {"tier": 'standard', **tiers['standard']}
+        
+        question_length = len((user_info.question or "").strip())
+        load = self._inflight_llm_calls
+        if prediction_type == 'comprehensive' and question_length >= settings.LLM_TIER_LONG_QUESTION_CHARS:
+            tier = 'heavy'
+        elif prediction_type != 'comprehensive' and question_length <= settings.LLM_TIER_SHORT_QUESTION_CHARS:
+            tier = 'light'
+        else:
+            tier = 'standard'
+        if tier == 'standard' and load >= settings.LLM_TIER_HIGH_LOAD:
+            tier = 'light'
+        
+        with self._stats_lock:
+            self._tier_stats[tier] += 1
+        params = {"tier": tier, **tiers[tier]}
+        logger.info(
+            f"模型路由: 类型={prediction_type}, 问题长度={question_length}, 进行中调用={load} -> "
+            f"{tier}({params['models'] or '后端默认模型'}, max_tokens={params['max_tokens']}, "
+            f"temperature={params['temperature']})"
         )
+        return params
+    
+    def _bind_llm(self, llm_params: Dict[str, Any], deadline: Optional[Deadline] = None):
+        """将档位对应的模型参数和请求超时绑定到大模型（只替换档位明确指定了模型的后端）"""
+        bind_kwargs = {}
+        if self.settings.LLM_TIER_ROUTING_ENABLED:
+            bind_kwargs.update(max_tokens=llm_params["max_tokens"], temperature=llm_params["temperature"])
+            if llm_params["models"]:
+                bind_kwargs["backend_models"] = llm_params["models"]
+        if deadline is not None:
+            bind_kwargs["timeout"] = deadline.timeout()
+        return self.llm.bind(**bind_kwargs) if bind_kwargs else self.llm
+    
+    @contextmanager
+    def _track_llm_call(self):
+        """统计进行中的大模型调用数"""
+        with self._stats_lock:
+            self._inflight_llm_calls += 1
+        try:
+            yield
+        finally:
+            with self._stats_lock:
+                self._inflight_llm_calls -= 1
+    
+    def _use_sections(self, prediction_type: str) -> bool:
+        """综合报告是否按章节并发生成"""
+        return self.settings.SECTIONED_GENERATION_ENABLED and prediction_type == 'comprehensive'
+    
+    def _stream_sections(self, user_info: UserInfo, fortune_data: Dict[str, Any],
+                         use_cache: bool = True, deadline: Optional[Deadline] = None) -> Iterator[str]:
+        """并发生成综合报告的各章节，按固定顺序流式返回
         
-        logger.log_prediction_request(user_info.name, "感情预测", True)
-        return result
+        各章节同时开始生成，当前章节的内容实时返回，后续章节的内容先缓冲，
+        轮到时立即返回，总耗时接近最慢的单个章节。
+        超出时间预算时停止等待，已生成的内容保留并追加TRUNCATED_NOTICE。
+        """
+        base_input = {
+            "chart_context": self._get_chart_context(user_info, fortune_data, deadline),
+            "user_name": user_info.name,
+            "gender": user_info.gender,
+            "question": user_info.question or "无",
+            "current_date": datetime.now().strftime('%Y年%m月%d日')
+        }
+        
+        if deadline is not None:
+            deadline.check("生成预测")
+        llm_params = {"max_tokens": self.settings.SECTION_MAX_TOKENS}
+        llm = self.llm.bind(**llm_params, **({"timeout": deadline.timeout()} if deadline is not None else {}))
+        
+        sections = list(self.REPORT_SECTIONS.items())
+        queues = [queue.Queue() for _ in sections]
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(self.settings.SECTION_CONCURRENCY, len(sections))),
+            thread_name_prefix='section'
+        )
+        try:
+            for (section_key, section), section_queue in zip(sections, queues):
+                chain_input = {**base_input, "section_title": section['title'], "section_focus": section['focus']}
+                executor.submit(self._produce_section, section_key, chain_input, section_queue, cancelled,
+                                llm, llm_params, use_cache)
+            
+            for (_, section), section_queue in zip(sections, queues):
+                yield f"### {section['title']}\n\n"
+                while True:
+                    try:
+                        item = section_queue.get(timeout=deadline.remaining() if deadline is not None else None)
+                    except queue.Empty:
+                        logger.warning(f"综合报告生成超时，内容未完整: {user_info.name}")
+                        yield self.TRUNCATED_NOTICE
+                        return
+                    if item is _SECTION_DONE:
+                        break
+                    if isinstance(item, DeadlineExceeded) and deadline is not None:
+                        logger.warning(f"综合报告生成超时，内容未完整: {user_info.name}")
+                        yield self.TRUNCATED_NOTICE
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                yield "\n\n"
+        finally:
+            # 调用方提前结束或出错时停止其余章节的生成
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _produce_section(self, section_key: str, chain_input: Dict[str, Any], section_queue: queue.Queue,
+                         cancelled: threading.Event, llm, llm_params: Dict[str, Any], use_cache: bool = True):
+        """生成单个章节，将文本片段放入队列（llm_params为绑定到llm的模型参数，参与缓存键计算）"""
+        try:
+            cache_key = self._generate_response_cache_key(f"section:{section_key}", self.section_prompt, chain_input,
+                                                         llm_params)
+            cached_content = self._get_cached_response(cache_key, use_cache)
+            if cached_content is not None:
+                section_queue.put(cached_content)
+                return
+            
+            chain = self.section_prompt | llm
+            chunks = []
+            with self._track_llm_call():
+                for chunk in chain.stream(chain_input):
+                    if cancelled.is_set():
+                        return
+                    if getattr(chunk, 'usage_metadata', None):
+                        self._record_usage(chunk, f"section:{section_key}")
+                    text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                    if text:
+                        chunks.append(text)
+                        section_queue.put(text)
+            
+            self._set_cached_response(cache_key, "".join(chunks).strip())
+        except Exception as e:
+            logger.error(f"章节生成失败: {section_key} - {str(e)}")
+            section_queue.put(e)
+        finally:
+            section_queue.put(_SECTION_DONE)
     
-    def _generate_prediction(self, user_info: UserInfo, fortune_data: Dict[str, Any], prediction_type: str) -> str:
-        """生成AI预测内容"""
+    def _build_chain_input(self, user_info: UserInfo, fortune_data: Dict[str, Any], prediction_type: str,
+                           deadline: Optional[Deadline] = None):
+        """选择提示词模板并准备模板输入"""
+        if self.digest_cache is not None:
+            return self._build_answer_input(user_info, fortune_data, prediction_type, deadline)
+        
         # 准备输入数据
-        complete_data = self._format_complete_data(fortune_data)
-        current_time = datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')
+        if self.settings.PROMPT_LAYOUT == 'prefix_cache':
+            # 分析说明已在模板中；去掉数据中的姓名（已在用户信息中给出），
+            # 使同一命盘的不同用户共享数据部分的前缀；日期精确到天以保持提示词稳定
+            chart_data = BaziService._strip_name_fields(fortune_data)
+            complete_data = self._serialize_fortune_data(chart_data, prediction_type)
+            time_input = {"current_date": datetime.now().strftime('%Y年%m月%d日')}
+        else:
+            complete_data = self._format_complete_data(fortune_data, prediction_type)
+            time_input = {"current_time": datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}
         
         # 选择合适的提示词模板
         if prediction_type == 'career':
@@ -182,7 +815,7 @@ class PredictionService:
                 "user_name": user_info.name,
                 "gender": user_info.gender,
                 "complete_data": complete_data,
-                "current_time": current_time
+                **time_input
             }
         elif prediction_type == 'relationship':
             prompt = self.relationship_prompt
@@ -190,7 +823,7 @@ class PredictionService:
                 "user_name": user_info.name,
                 "gender": user_info.gender,
                 "complete_data": complete_data,
-                "current_time": current_time
+                **time_input
             }
         else:  # comprehensive
             prompt = self.comprehensive_prompt
@@ -199,18 +832,140 @@ class PredictionService:
                 "gender": user_info.gender,
                 "complete_data": complete_data,
                 "question": user_info.question or "请为我进行全面的命理分析",
-                "current_time": current_time
+                **time_input
             }
         
-        # 使用LLM生成预测
-        chain = prompt | self.llm
+        return prompt, chain_input
+    
+    def _build_answer_input(self, user_info: UserInfo, fortune_data: Dict[str, Any], prediction_type: str,
+                            deadline: Optional[Deadline] = None):
+        """两阶段生成：基于命盘分析摘要准备回答的模板输入"""
+        chain_input = {
+            "digest": self.get_chart_digest(user_info, fortune_data, deadline),
+            "user_name": user_info.name,
+            "gender": user_info.gender,
+            "current_date": datetime.now().strftime('%Y年%m月%d日')
+        }
+        if prediction_type == 'career':
+            prompt = self.answer_prompts['career']
+        elif prediction_type == 'relationship':
+            prompt = self.answer_prompts['relationship']
+        else:  # comprehensive
+            prompt = self.answer_prompts['comprehensive']
+            chain_input["question"] = user_info.question or "请为我进行全面的命理分析"
+        return prompt, chain_input
+    
+    def get_chart_digest(self, user_info: UserInfo, fortune_data: Optional[Dict[str, Any]] = None,
+                         deadline: Optional[Deadline] = None) -> str:
+        """获取命盘分析摘要，按命盘缓存，并发请求只生成一次
+        
+        传入deadline时，生成摘要和等待其他请求生成摘要都不超过剩余时间。
+        """
+        if self.digest_cache is None:
+            raise ValueError("未启用两阶段生成，请设置TWO_STAGE_ENABLED=True")
+        
+        # 缓存键包含生成摘要的模型和摘要提示词模板，更换模型或修改提示词后重新生成
+        cache_key = (f"digest:{self._model_key()}:{self._template_key(self.digest_prompt)}:"
+                     f"{BaziService.get_chart_key(user_info)}")
+        digest = self.digest_cache.get(cache_key)
+        if digest is not None:
+            logger.info(f"从缓存获取命盘分析摘要: {user_info.name}")
+            return digest
+        
+        if fortune_data is None:
+            fortune_data = self.bazi_service.get_fortune_analysis(user_info, deadline=deadline)
+        return self._digest_inflight.do(cache_key, self._generate_digest, user_info, fortune_data, cache_key,
+                                        deadline, deadline=deadline)
+    
+    def _generate_digest(self, user_info: UserInfo, fortune_data: Dict[str, Any], cache_key: str,
+                         deadline: Optional[Deadline] = None) -> str:
+        """生成命盘分析摘要并写入缓存"""
+        # 等待期间其他请求可能已生成完成
+        if cache_key in self.digest_cache:
+            return self.digest_cache.get(cache_key)
+        
+        if deadline is not None:
+            deadline.check("生成命盘分析摘要")
+        
+        chain_input = {
+            "gender": user_info.gender,
+            "complete_data": self._serialize_fortune_data(
+                BaziService._strip_name_fields(fortune_data), 'comprehensive'
+            )
+        }
+        chain = self.digest_prompt | self.llm.bind(
+            max_tokens=self.settings.DIGEST_MAX_TOKENS,
+            **({"timeout": deadline.timeout()} if deadline is not None else {})
+        )
         result = chain.invoke(chain_input)
-        return result.content.strip() if hasattr(result, 'content') else str(result).strip()
+        self._record_usage(result, 'digest')
+        digest = result.content.strip() if hasattr(result, 'content') else str(result).strip()
+        
+        if digest:
+            self.digest_cache.set(cache_key, digest)
+        logger.info(f"生成命盘分析摘要: {user_info.name}, 长度: {len(digest)}")
+        return digest
+    
+    def _model_key(self, models: Optional[Dict[str, str]] = None) -> str:
+        """缓存键中的模型标识：路由中各后端实际使用的模型（models为按后端绑定的模型）"""
+        backends = getattr(self.llm, 'backends', None)
+        if not backends:
+            return self.settings.DEEPSEEK_MODEL_NAME
+        models = models or {}
+        return ",".join(sorted({
+            models.get(backend.name) or getattr(backend.model, 'model_name', None) or backend.name
+            for backend in backends
+        }))
+    
+    def _get_cached_response(self, cache_key: str, use_cache: bool = True) -> Optional[str]:
+        """读取响应缓存"""
+        if self.response_cache is None or not use_cache:
+            return None
+        return self.response_cache.get(cache_key)
+    
+    def _set_cached_response(self, cache_key: str, content: str):
+        """写入响应缓存"""
+        if self.response_cache is not None and content:
+            self.response_cache.set(cache_key, content)
+    
+    @staticmethod
+    def _template_key(prompt: PromptTemplate) -> str:
+        """提示词模板文本的哈希，修改模板（或切换提示词布局）后缓存键随之变化"""
+        return hashlib.sha256(prompt.template.encode('utf-8')).hexdigest()[:16]
     
-    def _format_complete_data(self, fortune_data: Dict[str, Any]) -> str:
+    def _generate_response_cache_key(self, prediction_type: str, prompt: PromptTemplate, chain_input: Dict[str, Any],
+                                     llm_params: Optional[Dict[str, Any]] = None) -> str:
+        """根据提示词模板、提示词输入和模型参数生成响应缓存键（排除当前时间等易变字段）"""
+        llm_params = llm_params or {}
+        key_data = {
+            "prediction_type": prediction_type,
+            "template": self._template_key(prompt),
+            "model": self._model_key(llm_params.get("models")),
+            "temperature": llm_params.get("temperature", self.settings.LLM_TEMPERATURE),
+            "max_tokens": llm_params.get("max_tokens", self.settings.LLM_MAX_TOKENS),
+            "top_p": self.settings.LLM_TOP_P,
+            "inputs": {k: v for k, v in chain_input.items() if k not in self.VOLATILE_PROMPT_FIELDS}
+        }
+        digest = hashlib.sha256(
+            json.dumps(key_data, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+        return f"llm:{digest}"
+    
+    def _serialize_fortune_data(self, fortune_data: Dict[str, Any], prediction_type: str = 'comprehensive') -> str:
+        """将运势数据序列化为JSON文本"""
+        if self.projector is not None:
+            # 按预测类型裁剪字段并紧凑序列化，减少输入token
+            data_json = self.projector.serialize(self.projector.project(fortune_data, prediction_type))
+            self._record_prompt_size(fortune_data, data_json, prediction_type)
+            return data_json
+        return json.dumps(fortune_data, ensure_ascii=False, indent=2)
+    
+    def _format_complete_data(self, fortune_data: Dict[str, Any], prediction_type: str = 'comprehensive') -> str:
         """格式化完整数据（包含八字和运势信息）"""
+        data_json = self._serialize_fortune_data(fortune_data, prediction_type)
+        
         return f"""完整命理分析数据（JSON格式）：
-{json.dumps(fortune_data, ensure_ascii=False, indent=2)}
+{data_json}
 
 请根据以上JSON数据进行全面的命理分析，数据包含：
 1. 八字信息：四柱、格局、十神、五行等基础命理要素
@@ -219,11 +974,73 @@ class PredictionService:
 
 请综合所有信息进行专业分析，不要在回答中显示原始JSON数据。"""
     
+    def _record_prompt_size(self, fortune_data: Dict[str, Any], data_json: str, prediction_type: str):
+        """记录数据投影前后的token估算"""
+        before_tokens = estimate_tokens(json.dumps(fortune_data, ensure_ascii=False, indent=2))
+        after_tokens = estimate_tokens(data_json)
+        with self._stats_lock:
+            self._prompt_stats["prompts"] += 1
+            self._prompt_stats["before_tokens"] += before_tokens
+            self._prompt_stats["after_tokens"] += after_tokens
+        logger.debug(f"命理数据token估算({prediction_type}): 投影前{before_tokens}, 投影后{after_tokens}")
+    
+    def get_prompt_report(self) -> Dict[str, Any]:
+        """获取数据投影前后的累计token估算"""
+        with self._stats_lock:
+            stats = dict(self._prompt_stats)
+        before_tokens = stats["before_tokens"]
+        stats["saved_ratio"] = round(1 - stats["after_tokens"] / before_tokens, 4) if before_tokens else 0.0
+        return stats
+    
+    def _record_usage(self, message: Any, prediction_type: str):
+        """记录大模型token用量及服务端前缀缓存命中情况"""
+        usage = getattr(message, 'usage_metadata', None) or {}
+        token_usage = (getattr(message, 'response_metadata', None) or {}).get('token_usage') or {}
+        prompt_tokens = usage.get('input_tokens') or token_usage.get('prompt_tokens') or 0
+        if not prompt_tokens:
+            return
+        
+        # DeepSeek返回prompt_cache_hit_tokens，OpenAI兼容接口返回cached_tokens（映射为cache_read）
+        cache_hit_tokens = token_usage.get('prompt_cache_hit_tokens')
+        if cache_hit_tokens is None:
+            cache_hit_tokens = (usage.get('input_token_details') or {}).get('cache_read') or 0
+        
+        with self._stats_lock:
+            self._usage_stats["calls"] += 1
+            self._usage_stats["prompt_tokens"] += prompt_tokens
+            self._usage_stats["cache_hit_tokens"] += cache_hit_tokens
+            self._usage_stats["cache_miss_tokens"] += prompt_tokens - cache_hit_tokens
+        logger.debug(f"大模型输入token({prediction_type}): 共{prompt_tokens}, 前缀缓存命中{cache_hit_tokens}")
+    
+    def get_usage_report(self) -> Dict[str, Any]:
+        """获取大模型累计token用量和前缀缓存命中率"""
+        with self._stats_lock:
+            stats = dict(self._usage_stats)
+        prompt_tokens = stats["prompt_tokens"]
+        stats["cache_hit_ratio"] = round(stats["cache_hit_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0
+        stats["prompt_layout"] = self.settings.PROMPT_LAYOUT
+        return stats
+    
+    def get_tier_report(self) -> Dict[str, Any]:
+        """获取模型分级路由的统计"""
+        with self._stats_lock:
+            return {
+                "enabled": self.settings.LLM_TIER_ROUTING_ENABLED,
+                "inflight_llm_calls": self._inflight_llm_calls,
+                "decisions": dict(self._tier_stats)
+            }
+    
     def get_service_status(self) -> Dict[str, Any]:
         """获取服务状态"""
         return {
             "service_name": "PredictionService",
             "llm_status": "active",
             "bazi_service_status": self.bazi_service.validate_service_health(),
+            "response_cache": self.response_cache.stats() if self.response_cache is not None else None,
+            "prompt_report": self.get_prompt_report(),
+            "digest_cache": self.digest_cache.stats() if self.digest_cache is not None else None,
+            "llm_usage": self.get_usage_report(),
+            "llm_backends": self.llm.stats() if hasattr(self.llm, 'stats') else None,
+            "tier_routing": self.get_tier_report(),
             "available_predictions": ["综合预测", "事业预测", "感情预测"]
         }
\ No newline at end of file
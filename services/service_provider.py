@@ -0,0 +1,53 @@
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, List
+
+from services.bazi_service import BaziService
+from services.prediction_service import PredictionService
+from utils.logger import logger
+
+# 进程级共享资源：Streamlit每次重新运行脚本时复用，而不是重新创建
+_instances: Dict[str, Any] = {}
+_lock = threading.RLock()
+
+PROVINCE_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'province.json')
+
+
+def _get_or_create(name: str, factory: Callable[[], Any]) -> Any:
+    """获取共享实例，不存在时在锁内创建（双重检查）"""
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                logger.info(f"初始化共享资源: {name}")
+                instance = factory()
+                _instances[name] = instance
+    return instance
+
+
+def get_bazi_service() -> BaziService:
+    """获取进程内共享的八字数据服务"""
+    return _get_or_create('bazi_service', BaziService)
+
+
+def get_prediction_service() -> PredictionService:
+    """获取进程内共享的预测服务"""
+    return _get_or_create('prediction_service', lambda: PredictionService(bazi_service=get_bazi_service()))
+
+
+def get_province_data() -> Dict[str, List[str]]:
+    """获取省市数据（只在首次调用时读取province.json）"""
+    return _get_or_create('province_data', _load_province_data)
+
+
+def _load_province_data() -> Dict[str, List[str]]:
+    with open(PROVINCE_DATA_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def reset_services() -> None:
+    """清除所有共享实例（配置变更或测试时使用）"""
+    with _lock:
+        _instances.clear()
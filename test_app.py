@@ -11,6 +11,69 @@ import sys
 from datetime import datetime
 from pathlib import Path
 
+class FakeChatModel:
+    """大模型后端桩：按提示词生成回复，记录每次调用的参数
+    
+    respond接收提示词文本，返回回复文本（或片段列表），抛出异常时模拟后端出错。
+    """
+    
+    def __init__(self, respond=None, delay=0.0):
+        import threading
+        self.respond = respond or (lambda prompt: "测试回复")
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+    
+    def stream(self, messages, stop=None, **kwargs):
+        import time
+        from langchain_core.messages import AIMessageChunk
+        prompt = "\n".join(str(message.content) for message in messages)
+        with self._lock:
+            self.calls.append({"prompt": prompt, **kwargs})
+        time.sleep(self.delay)
+        reply = self.respond(prompt)
+        for text in ([reply] if isinstance(reply, str) else reply):
+            yield text if isinstance(text, AIMessageChunk) else AIMessageChunk(content=text)
+
+class StubBaziService:
+    """返回固定命盘数据的八字服务桩"""
+    
+    def __init__(self):
+        self.calls = 0
+    
+    def get_fortune_analysis(self, user_info, prediction_type='comprehensive', deadline=None):
+        self.calls += 1
+        return {
+            "base_info": {"name": user_info.name, "zhengge": "正官格"},
+            "bazi_info": {"bazi": ["庚午", "戊子", "甲申", "丙午"]}
+        }
+    
+    def validate_service_health(self):
+        return {"status": "healthy"}
+
+def make_prediction_service(model, **overrides):
+    """创建使用大模型桩和八字服务桩的预测服务，overrides覆盖配置项"""
+    from services.llm_router import LLMBackend, LLMRouter
+    from services.prediction_service import PredictionService
+    from utils.data_projection import DataProjector
+    
+    # 直接传入大模型路由，不创建真实后端（无需API密钥）
+    service = PredictionService(bazi_service=StubBaziService(), llm=LLMRouter(backends=[LLMBackend("fake", model)]))
+    for name, value in overrides.items():
+        setattr(service.settings, name, value)
+    # 按覆盖后的配置重新初始化
+    service._setup_prompts()
+    service._setup_response_cache()
+    service._setup_two_stage()
+    service.projector = DataProjector() if service.settings.PROMPT_PROJECTION_ENABLED else None
+    return service
+
+def make_user(name='张三', **fields):
+    """创建测试用户信息"""
+    from models.user_info import UserInfo
+    return UserInfo(**{"name": name, "gender": '男', "birth_year": 1990, "birth_month": 1, "birth_day": 1,
+                       "birth_hour": 12, "birth_province": '北京市', "birth_city": '北京', **fields})
+
 def test_imports():
     """测试模块导入"""
     print("🧪 测试模块导入...")
@@ -122,6 +185,62 @@ def test_data_models():
         print(f"❌ 数据模型测试失败: {str(e)}")
         return False
 
+def test_conversation():
+    """测试追问对话（只保留最近几轮原文，较早的对话合并为摘要）"""
+    print("\n💬 测试追问对话...")
+    
+    try:
+        from models.conversation import Conversation
+        
+        # Conversation模型只保留最近几轮对话
+        conversation = Conversation(user_name="测试用户", prediction_type="综合运势", report="测试预测内容")
+        for i in range(5):
+            conversation.add_turn(f"问题{i}", f"回答{i}")
+        overflow = conversation.pop_overflow_turns(3)
+        if len(overflow) != 2 or len(conversation.turns) != 3 or conversation.turn_count != 5:
+            print("❌ Conversation模型保留轮数不正确")
+            return False
+        print(f"✅ Conversation模型: 保留最近{len(conversation.turns)}轮对话")
+        
+        # 追问超出保留轮数时，较早的对话由大模型合并为摘要
+        model = FakeChatModel(lambda prompt: "对话摘要" if "合并后的摘要" in prompt else "追问回答")
+        service = make_prediction_service(model, FOLLOWUP_MAX_RECENT_TURNS=2, TWO_STAGE_ENABLED=False)
+        user_info = make_user()
+        conversation = service.start_conversation(service.get_prediction(user_info, 'career', use_cache=False))
+        for question in ("今年事业如何", "适合跳槽吗", "明年呢"):
+            if service.ask_followup(user_info, conversation, question) != "追问回答":
+                print("❌ 追问回答不正确")
+                return False
+        if conversation.summary != "对话摘要" or [turn.question for turn in conversation.turns] != ["适合跳槽吗", "明年呢"]:
+            print(f"❌ 较早的对话未合并为摘要: {conversation.summary}")
+            return False
+        print(f"✅ 追问{conversation.turn_count}轮后保留最近{len(conversation.turns)}轮原文和对话摘要")
+        
+        # 追问回答中途超出时间预算时保留已输出内容，不记录本轮对话
+        import time
+        from utils.deadline import Deadline
+        
+        def stall_after_first(prompt):
+            yield "开头"
+            time.sleep(2.0)
+            yield "迟到的后续"
+        
+        from services.llm_router import LLMBackend, LLMRouter
+        service.llm = LLMRouter(backends=[LLMBackend("fake", FakeChatModel(stall_after_first))])
+        turn_count = conversation.turn_count
+        started = time.monotonic()
+        chunks = list(service.stream_followup(user_info, conversation, "后年呢", Deadline(0.3)))
+        if time.monotonic() - started > 1.0 or chunks != ["开头", service.TRUNCATED_NOTICE] \
+                or conversation.turn_count != turn_count:
+            print(f"❌ 追问超时处理不正确: {chunks}")
+            return False
+        print("✅ 追问超出时间预算时结束输出，不记录本轮对话")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 追问对话测试失败: {str(e)}")
+        return False
+
 def test_data_validator():
     """测试数据验证器"""
     print("\n🔍 测试数据验证器...")
@@ -235,6 +354,1255 @@ def test_services():
         print(f"❌ 服务层测试失败: {str(e)}")
         return False
 
+def test_cache():
+    """测试缓存"""
+    print("\n🗄️ 测试缓存...")
+    
+    try:
+        import time
+        from utils.cache import MemoryCache
+        
+        # 测试LRU淘汰
+        cache = MemoryCache(ttl=60, max_entries=2)
+        cache.set("a", {"value": 1})
+        cache.set("b", {"value": 2})
+        cache.get("a")
+        cache.set("c", {"value": 3})
+        if "b" in cache or "a" not in cache:
+            print("❌ LRU淘汰顺序不正确")
+            return False
+        print("✅ LRU淘汰正常")
+        
+        # 测试字节上限
+        cache = MemoryCache(ttl=60, max_entries=100, max_bytes=100)
+        for i in range(10):
+            cache.set(f"key_{i}", {"text": "x" * 30})
+        if cache.stats()["bytes"] > 100:
+            print("❌ 缓存字节数超过上限")
+            return False
+        print(f"✅ 字节上限生效: {cache.stats()['bytes']} 字节")
+        
+        # 测试TTL过期
+        cache = MemoryCache(ttl=0.05)
+        cache.set("a", 1)
+        time.sleep(0.1)
+        if cache.get("a") is not None:
+            print("❌ 缓存未按TTL过期")
+            return False
+        
+        stats = cache.stats()
+        print(f"✅ TTL过期正常: 命中{stats['hits']}次, 未命中{stats['misses']}次, 过期{stats['expirations']}次")
+        
+        # 测试宽限期内读取过期条目
+        cache = MemoryCache(ttl=0.05, stale_ttl=60)
+        cache.set("a", 1)
+        time.sleep(0.1)
+        if cache.get("a") is not None or cache.get_stale("a") is None:
+            print("❌ 宽限期内无法读取过期条目")
+            return False
+        print("✅ 宽限期内可读取过期条目")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 缓存测试失败: {str(e)}")
+        return False
+
+def test_sqlite_cache():
+    """测试磁盘缓存和两级缓存"""
+    print("\n💾 测试磁盘缓存...")
+
+    try:
+        import json
+        import sqlite3
+        import subprocess
+        import tempfile
+        import time
+        import zlib
+        from utils.cache import MemoryCache, SQLiteCache, TieredCache
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.db')
+
+            # 读写往返，存储内容为压缩后的JSON
+            cache = SQLiteCache(path, namespace='test', ttl=60)
+            value = {"text": "命盘" * 200, "items": [1, 2, 3]}
+            cache.set("a", value)
+            payload, size = sqlite3.connect(path).execute(
+                "SELECT value, size FROM cache_entries WHERE namespace = 'test' AND key = 'a'"
+            ).fetchone()
+            raw_size = len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+            if cache.get("a") != value or json.loads(zlib.decompress(payload)) != value or size >= raw_size:
+                print("❌ 磁盘缓存读写或压缩不正确")
+                return False
+            print(f"✅ 磁盘缓存读写正常: 压缩后{size}字节（原{raw_size}字节）")
+
+            # TTL过期后宽限期内只能通过get_stale读取，宽限期结束后清理
+            cache = SQLiteCache(path, namespace='ttl', ttl=0.05, stale_ttl=0.3)
+            cache.set("a", 1)
+            time.sleep(0.1)
+            stale = cache.get_stale("a")
+            if cache.get("a") is not None or stale is None or stale[0] != 1:
+                print("❌ 磁盘缓存TTL过期不正确")
+                return False
+            time.sleep(0.3)
+            cache.prune()
+            if cache.get_stale("a") is not None or len(cache) != 0:
+                print("❌ 宽限期结束后磁盘缓存条目未清理")
+                return False
+            print("✅ 磁盘缓存TTL过期和宽限期正常")
+
+            # 超出条目上限时按最近访问时间淘汰
+            cache = SQLiteCache(path, namespace='prune', ttl=60, max_entries=3)
+            for i in range(5):
+                cache.set(f"k{i}", i)
+                time.sleep(0.01)
+            cache.prune()
+            if sorted(cache.keys()) != ["k2", "k3", "k4"] or cache.stats()["evictions"] != 2:
+                print(f"❌ 磁盘缓存容量淘汰不正确: {cache.keys()}")
+                return False
+            print("✅ 磁盘缓存超出上限时淘汰最久未访问的条目")
+
+            # 两级缓存：内存未命中时读取磁盘并回填内存
+            disk = SQLiteCache(path, namespace='tiered', ttl=60)
+            TieredCache(MemoryCache(ttl=60), disk).set("a", value)
+            tiered = TieredCache(MemoryCache(ttl=60), disk)
+            if tiered.memory.get("a") is not None or tiered.get("a") != value or tiered.memory.get("a") != value:
+                print("❌ 两级缓存未从磁盘回填内存")
+                return False
+            print("✅ 两级缓存从磁盘回填内存")
+
+            # 另一个进程写入的条目在当前进程可读
+            script = (
+                "import sys; from utils.cache import SQLiteCache; "
+                "SQLiteCache(sys.argv[1], namespace='shared', ttl=60).set('from_child', {'pid': 'child'})"
+            )
+            subprocess.run([sys.executable, '-c', script, path], check=True, timeout=60,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+            if SQLiteCache(path, namespace='shared', ttl=60).get('from_child') != {'pid': 'child'}:
+                print("❌ 多进程无法共享磁盘缓存")
+                return False
+            print("✅ 多进程共享磁盘缓存")
+        return True
+
+    except Exception as e:
+        print(f"❌ 磁盘缓存测试失败: {str(e)}")
+        return False
+
+def test_chart_cache():
+    """测试命盘缓存（缓存键与姓名无关，姓名在读取时叠加）"""
+    print("\n🗂️ 测试命盘缓存...")
+
+    try:
+        from models.user_info import UserInfo
+        from services.bazi_service import BaziService
+
+        class StubAPIClient:
+            """记录调用次数的缘分居API桩"""
+            def __init__(self):
+                self.calls = 0
+
+            def get_fortune_prediction(self, user_info, prediction_type='general', deadline=None):
+                self.calls += 1
+                return {"errcode": 0, "data": {
+                    "base_info": {"name": user_info["name"], "sex": "乾造"},
+                    "bazi_info": {"bazi": ["庚午", "戊子", "甲申", "丙午"]}
+                }}
+
+        service = BaziService()
+        service.settings.CHART_SOURCE = 'upstream'
+        service.api_client = StubAPIClient()
+        birth = dict(gender='男', birth_year=1990, birth_month=1, birth_day=1, birth_hour=12,
+                     birth_province='北京市', birth_city='北京')
+        zhang, li = UserInfo(name='张三', **birth), UserInfo(name='李四', **birth)
+
+        # 同一命盘不同姓名共用缓存键，缓存键中不含姓名
+        key = service.get_chart_key(zhang)
+        if key != service.get_chart_key(li) or '张三' in key:
+            print(f"❌ 命盘缓存键不正确: {key}")
+            return False
+        print(f"✅ 命盘缓存键与姓名无关: {key}")
+
+        # 只调用一次上游，各自叠加姓名，缓存中不保存姓名
+        first, second = service.get_fortune_analysis(zhang), service.get_fortune_analysis(li)
+        if service.api_client.calls != 1 or first["base_info"]["name"] != '张三' \
+                or second["base_info"]["name"] != '李四' or 'name' in service._cache.get(key)["base_info"]:
+            print("❌ 命盘缓存未按姓名叠加")
+            return False
+        print("✅ 同一命盘只调用一次上游，姓名在读取时叠加")
+
+        # 修改返回的运势数据不影响缓存中的共享命盘
+        first["base_info"]["sex"] = "坤造"
+        first["bazi_info"]["bazi"].append("甲子")
+        third = service.get_fortune_analysis(li)
+        if third["base_info"]["sex"] != "乾造" or len(third["bazi_info"]["bazi"]) != 4:
+            print("❌ 修改返回值影响了缓存中的命盘")
+            return False
+        print("✅ 返回值与缓存中的命盘相互独立")
+        return True
+
+    except Exception as e:
+        print(f"❌ 命盘缓存测试失败: {str(e)}")
+        return False
+
+def test_singleflight():
+    """测试同一命盘的并发请求合并"""
+    print("\n🔗 测试并发请求合并...")
+
+    try:
+        import threading
+        import time
+        from models.user_info import UserInfo
+        from services.bazi_service import BaziService
+
+        class SlowAPIClient:
+            """等待所有请求到达后才返回的缘分居API桩"""
+            def __init__(self, error=None):
+                self.calls = 0
+                self.error = error
+
+            def get_fortune_prediction(self, user_info, prediction_type='general', deadline=None):
+                self.calls += 1
+                time.sleep(0.2)
+                if self.error:
+                    raise self.error
+                return {"errcode": 0, "data": {"bazi_info": {"bazi": ["庚午", "戊子", "甲申", "丙午"]}}}
+
+        def run_concurrently(service, count=8):
+            """count个线程同时查询同一命盘，返回各自的结果或异常"""
+            barrier = threading.Barrier(count)
+            outcomes = [None] * count
+
+            def worker(index):
+                user_info = UserInfo(name="用户" + "甲乙丙丁戊己庚辛壬癸"[index], gender='男', birth_year=1990, birth_month=1,
+                                     birth_day=1, birth_hour=12, birth_province='北京市', birth_city='北京')
+                barrier.wait()
+                try:
+                    outcomes[index] = service.get_fortune_analysis(user_info)
+                except Exception as e:
+                    outcomes[index] = e
+
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return outcomes
+
+        # 并发的相同查询只调用一次上游，共享结果
+        service = BaziService()
+        service.settings.CHART_SOURCE = 'upstream'
+        service.api_client = SlowAPIClient()
+        outcomes = run_concurrently(service)
+        if service.api_client.calls != 1 or not all(
+                isinstance(outcome, dict) and outcome["bazi_info"]["bazi"][0] == "庚午" for outcome in outcomes):
+            print(f"❌ 并发查询未合并: 上游调用{service.api_client.calls}次")
+            return False
+        print(f"✅ 8个并发查询只调用1次上游: {service._inflight.stats()}")
+
+        # 上游失败时所有等待方收到同一个异常
+        service = BaziService()
+        service.settings.CHART_SOURCE = 'upstream'
+        error = RuntimeError("上游不可用")
+        service.api_client = SlowAPIClient(error=error)
+        outcomes = run_concurrently(service)
+        if service.api_client.calls != 1 or not all(outcome is error for outcome in outcomes):
+            print(f"❌ 并发查询未共享异常: 上游调用{service.api_client.calls}次")
+            return False
+        print("✅ 上游失败时所有并发查询共享同一异常")
+        
+        # 等待方最多等待自己的剩余时间，首个调用不受影响
+        from utils.deadline import Deadline, DeadlineExceeded
+        from utils.singleflight import SingleFlight
+        flight = SingleFlight()
+        leader_result = []
+        leader = threading.Thread(target=lambda: leader_result.append(
+            flight.do("命盘", lambda: time.sleep(0.5) or "排盘结果")))
+        leader.start()
+        time.sleep(0.05)
+        started = time.monotonic()
+        try:
+            flight.do("命盘", lambda: "不应执行", deadline=Deadline(0.1))
+            print("❌ 等待方未按剩余时间超时")
+            return False
+        except DeadlineExceeded:
+            pass
+        waited = time.monotonic() - started
+        leader.join()
+        if waited > 0.3 or leader_result != ["排盘结果"]:
+            print(f"❌ 等待方超时处理不正确: {leader_result}")
+            return False
+        print("✅ 等待方按剩余时间超时，首个调用正常完成")
+        return True
+
+    except Exception as e:
+        print(f"❌ 并发请求合并测试失败: {str(e)}")
+        return False
+
+def test_response_cache():
+    """测试大模型响应缓存（缓存键排除易变字段，use_cache=False时重新生成）"""
+    print("\n💾 测试大模型响应缓存...")
+    
+    try:
+        model = FakeChatModel()
+        service = make_prediction_service(model, LLM_CACHE_ENABLED=True, SECTIONED_GENERATION_ENABLED=False,
+                                          TWO_STAGE_ENABLED=False, LLM_TIER_ROUTING_ENABLED=False)
+        
+        # 当前时间、当前日期不影响缓存键，提示词模板和其他输入影响缓存键
+        from langchain.prompts import PromptTemplate
+        prompt = service.career_prompt
+        chain_input = {"user_name": "张三", "complete_data": "{}", "current_time": "2024年01月01日 08:00:00",
+                       "current_date": "2024年01月01日"}
+        key = service._generate_response_cache_key('career', prompt, chain_input)
+        later = {**chain_input, "current_time": "2024年06月01日 20:30:00", "current_date": "2024年06月01日"}
+        if service._generate_response_cache_key('career', prompt, later) != key:
+            print("❌ 易变字段影响了缓存键")
+            return False
+        if service._generate_response_cache_key('career', prompt, {**chain_input, "user_name": "李四"}) == key \
+                or service._generate_response_cache_key('relationship', prompt, chain_input) == key \
+                or service._generate_response_cache_key('career', prompt, chain_input, {"max_tokens": 600}) == key:
+            print("❌ 提示词输入或模型参数变化时缓存键未变化")
+            return False
+        edited = PromptTemplate(input_variables=prompt.input_variables, template=prompt.template + "\n请简要回答。")
+        if service._generate_response_cache_key('career', edited, chain_input) == key:
+            print("❌ 提示词模板修改后缓存键未变化")
+            return False
+        print("✅ 缓存键排除易变字段，包含提示词模板、提示词输入和模型参数")
+        
+        # 相同请求命中缓存，不再调用大模型
+        user_info = make_user()
+        first = service.get_prediction(user_info, 'career')
+        second = service.get_prediction(user_info, 'career')
+        if len(model.calls) != 1 or second.prediction_content != first.prediction_content:
+            print(f"❌ 相同请求未命中缓存: 大模型调用{len(model.calls)}次")
+            return False
+        print("✅ 相同请求命中响应缓存")
+        
+        # use_cache=False跳过缓存读取，重新生成
+        service.get_prediction(user_info, 'career', use_cache=False)
+        if len(model.calls) != 2:
+            print(f"❌ use_cache=False未重新生成: 大模型调用{len(model.calls)}次")
+            return False
+        print("✅ use_cache=False时跳过缓存重新生成")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 大模型响应缓存测试失败: {str(e)}")
+        return False
+
+def test_batch_runner():
+    """测试批量预测（按输入顺序输出、检查点断点续跑）"""
+    print("\n📦 测试批量预测...")
+    
+    try:
+        import json
+        import tempfile
+        import time
+        from datetime import datetime
+        from models.prediction_result import PredictionResult
+        from services.batch_service import BatchPredictionRunner
+        
+        class StubPredictionService:
+            """后提交的记录先完成的预测服务桩，interrupt_on中的姓名模拟中断"""
+            def __init__(self, interrupt_on=()):
+                self.bazi_service = StubBaziService()
+                self.interrupt_on = interrupt_on
+                self.names = []
+            
+            def get_prediction(self, user_info, prediction_type='comprehensive', use_cache=True,
+                               fortune_data=None, deadline=None):
+                self.names.append(user_info.name)
+                time.sleep(0.05 if user_info.name == '赵一' else 0.01)
+                if user_info.name in self.interrupt_on:
+                    raise KeyboardInterrupt
+                if user_info.name == '王五':
+                    raise RuntimeError("大模型不可用")
+                return PredictionResult(user_name=user_info.name, prediction_time=datetime.now(), bazi_summary="",
+                                        prediction_content="测试报告", prediction_type="综合运势")
+        
+        names = ['赵一', '钱二', None, '王五', '孙三', '周四']
+        birth = dict(gender='男', birth_year=1990, birth_month=1, birth_day=1, birth_hour=12,
+                     birth_province='北京市', birth_city='北京')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path, output_path = f"{tmp_dir}/users.jsonl", f"{tmp_dir}/results.jsonl"
+            with open(input_path, 'w', encoding='utf-8') as f:
+                for index, name in enumerate(names):
+                    f.write("{不是JSON\n" if name is None else json.dumps({"id": index, "name": name, **birth},
+                                                                          ensure_ascii=False) + "\n")
+            
+            # 第5条记录处理时中断，检查点之前的输出保留
+            interrupted = StubPredictionService(interrupt_on=('孙三',))
+            try:
+                BatchPredictionRunner(interrupted, workers=2, checkpoint_every=2).run(input_path, output_path)
+                print("❌ 模拟中断未生效")
+                return False
+            except KeyboardInterrupt:
+                pass
+            
+            # 断点续跑只处理剩余记录，统计包含之前完成的记录
+            service = StubPredictionService()
+            stats = BatchPredictionRunner(service, workers=2, checkpoint_every=2).run(
+                input_path, output_path, resume=True)
+            with open(output_path, 'r', encoding='utf-8') as f:
+                outputs = [json.loads(line) for line in f]
+        
+        if [output["index"] for output in outputs] != list(range(len(names))):
+            print(f"❌ 输出顺序不正确: {[output['index'] for output in outputs]}")
+            return False
+        if [output["status"] for output in outputs] != ["ok", "ok", "invalid", "error", "ok", "ok"]:
+            print(f"❌ 记录状态不正确: {[output['status'] for output in outputs]}")
+            return False
+        print("✅ 结果按输入顺序写出，无效和失败的记录互不影响")
+        
+        if service.names != ['孙三', '周四']:
+            print(f"❌ 断点续跑重复处理了记录: {service.names}")
+            return False
+        if stats != {"processed": 6, "ok": 4, "invalid": 1, "error": 1}:
+            print(f"❌ 断点续跑统计不正确: {stats}")
+            return False
+        print(f"✅ 断点续跑只处理剩余记录，统计完整: {stats}")
+        
+        # 不是JSON对象的行按无效记录输出，不中断批量任务
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path, output_path = f"{tmp_dir}/users.jsonl", f"{tmp_dir}/results.jsonl"
+            with open(input_path, 'w', encoding='utf-8') as f:
+                f.write('[1, 2]\n"张三"\n42\nnull\n' + json.dumps({"id": 4, "name": "赵一", **birth},
+                                                                  ensure_ascii=False) + "\n")
+            stats = BatchPredictionRunner(StubPredictionService(), workers=2).run(input_path, output_path)
+            with open(output_path, 'r', encoding='utf-8') as f:
+                outputs = [json.loads(line) for line in f]
+        if [output["status"] for output in outputs] != ["invalid"] * 4 + ["ok"] or stats["invalid"] != 4:
+            print(f"❌ 非对象记录处理不正确: {[output['status'] for output in outputs]}")
+            return False
+        print("✅ 非JSON对象的记录按无效记录输出")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 批量预测测试失败: {str(e)}")
+        return False
+
+def test_multi_predictions():
+    """测试多类型预测（并发生成、按完成顺序返回、单个类型失败不影响其他类型）"""
+    print("\n🧩 测试多类型预测...")
+    
+    try:
+        import threading
+        import time
+        
+        state = {"inflight": 0, "max_inflight": 0}
+        lock = threading.Lock()
+        
+        def respond(prompt):
+            with lock:
+                state["inflight"] += 1
+                state["max_inflight"] = max(state["max_inflight"], state["inflight"])
+            try:
+                if "请开始你的事业分析" in prompt:
+                    time.sleep(0.1)
+                    return "事业报告"
+                if "请开始你的感情分析" in prompt:
+                    time.sleep(0.2)
+                    raise RuntimeError("后端出错")
+                time.sleep(0.3)
+                return "综合报告"
+            finally:
+                with lock:
+                    state["inflight"] -= 1
+        
+        service = make_prediction_service(FakeChatModel(respond), LLM_CACHE_ENABLED=False,
+                                          SECTIONED_GENERATION_ENABLED=False, TWO_STAGE_ENABLED=False)
+        results = []
+        try:
+            for result in service.get_predictions(make_user()):
+                results.append(result)
+            print("❌ 失败的类型未抛出异常")
+            return False
+        except RuntimeError:
+            pass
+        
+        if state["max_inflight"] != 3 or service.bazi_service.calls != 1:
+            print(f"❌ 未并发生成: 最大并发{state['max_inflight']}, 获取运势数据{service.bazi_service.calls}次")
+            return False
+        print("✅ 运势数据只获取一次，各类型并发生成")
+        
+        if [result.prediction_content for result in results] != ["事业报告", "综合报告"]:
+            print(f"❌ 结果顺序或内容不正确: {[result.prediction_content for result in results]}")
+            return False
+        print("✅ 按完成顺序返回，失败的类型不影响其他类型")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 多类型预测测试失败: {str(e)}")
+        return False
+
+def test_data_projection():
+    """测试提示词数据投影（字段裁剪、空值移除、重复文本去重）"""
+    print("\n✂️ 测试数据投影...")
+    
+    try:
+        import json
+        import tempfile
+        from utils.data_projection import DataProjector
+        
+        long_text = "日主甲木生于子月，水旺木相，印星得力"
+        data = {
+            "base_info": {"name": "张三", "zhen": "1", "zhengge": "正官格"},
+            "bazi_info": {"bazi": ["庚午", "戊子", "甲申", "丙午"], "kw": "", "tg_cg_god": []},
+            "xingge": {"summary": long_text, "detail": long_text},
+            "caiyun": {"summary": "财运平稳"},
+            "chart_source": "hybrid"
+        }
+        rules = {
+            "_common": {"exclude": ["base_info.zhen"], "drop_empty": True, "dedupe_strings": True,
+                        "dedupe_min_length": 10},
+            "career": {"include": ["base_info", "bazi_info.bazi", "caiyun"]},
+            "relationship": {"exclude": ["caiyun"], "drop_empty": False, "dedupe_strings": False}
+        }
+        with tempfile.NamedTemporaryFile('w', suffix='.json', encoding='utf-8', delete=False) as f:
+            json.dump(rules, f)
+        projector = DataProjector(config_path=f.name)
+        os.unlink(f.name)
+        
+        # include只保留指定字段，exclude在此基础上移除字段
+        career = projector.project(data, 'career')
+        if career != {"base_info": {"name": "张三", "zhengge": "正官格"},
+                      "bazi_info": {"bazi": ["庚午", "戊子", "甲申", "丙午"]}, "caiyun": {"summary": "财运平稳"}}:
+            print(f"❌ include/exclude裁剪不正确: {career}")
+            return False
+        print("✅ include/exclude按字段路径裁剪")
+        
+        # drop_empty移除空值，dedupe_strings将重复长文本替换为引用
+        comprehensive = projector.project(data, 'comprehensive')
+        if "kw" in comprehensive["bazi_info"] or "tg_cg_god" in comprehensive["bazi_info"] \
+                or comprehensive["xingge"] != {"summary": long_text, "detail": "(同xingge.summary)"}:
+            print(f"❌ 空值移除或重复文本去重不正确: {comprehensive}")
+            return False
+        print("✅ 移除空值，重复长文本替换为引用")
+        
+        # 预测类型规则可关闭通用规则中的drop_empty和dedupe_strings
+        relationship = projector.project(data, 'relationship')
+        if "caiyun" in relationship or relationship["bazi_info"]["kw"] != "" \
+                or relationship["xingge"]["detail"] != long_text:
+            print(f"❌ 预测类型规则未覆盖通用规则: {relationship}")
+            return False
+        if data["base_info"]["zhen"] != "1" or data["xingge"]["detail"] != long_text:
+            print("❌ 投影修改了原始数据")
+            return False
+        print("✅ 预测类型规则覆盖通用规则，原始数据不变")
+        
+        # 默认规则不移除任何上游字段，只去掉本系统添加的chart_source
+        default_projector = DataProjector()
+        upstream = {key: value for key, value in data.items() if key != "chart_source"}
+        for prediction_type in ('comprehensive', 'career', 'relationship'):
+            projected = default_projector.project(data, prediction_type)
+            if set(projected) != set(upstream) or set(projected["base_info"]) != set(upstream["base_info"]):
+                print(f"❌ 默认规则移除了上游字段: {prediction_type}")
+                return False
+        print("✅ 默认规则保留全部上游字段")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 数据投影测试失败: {str(e)}")
+        return False
+
+def test_prompt_layout():
+    """测试提示词布局（默认布局与原提示词一致）和前缀缓存用量统计"""
+    print("\n📐 测试提示词布局...")
+    
+    try:
+        import json
+        import re
+        from langchain_core.messages import AIMessage, AIMessageChunk
+        
+        # 默认legacy布局：渲染结果与原提示词逐字一致（当前时间除外）
+        model = FakeChatModel()
+        service = make_prediction_service(model, LLM_CACHE_ENABLED=False, SECTIONED_GENERATION_ENABLED=False,
+                                          TWO_STAGE_ENABLED=False, PROMPT_PROJECTION_ENABLED=False)
+        if service.settings.PROMPT_LAYOUT != 'legacy':
+            print(f"❌ 默认提示词布局不是legacy: {service.settings.PROMPT_LAYOUT}")
+            return False
+        user_info = make_user(question="今年适合换工作吗")
+        service.get_prediction(user_info, 'comprehensive')
+        fortune_data = service.bazi_service.get_fortune_analysis(user_info)
+        expected = f"""
+{service.settings.SYSTEM_PROMPT_COMPREHENSIVE.strip()}
+
+当前时间：<time>
+
+用户信息：
+姓名：张三
+性别：男
+
+完整命理数据：
+完整命理分析数据（JSON格式）：
+{json.dumps(fortune_data, ensure_ascii=False, indent=2)}
+
+请根据以上JSON数据进行全面的命理分析，数据包含：
+1. 八字信息：四柱、格局、十神、五行等基础命理要素
+2. 运势信息：各方面运势分析和预测
+3. 详细分析：性格特点、发展建议等深度解读
+
+请综合所有信息进行专业分析，不要在回答中显示原始JSON数据。
+
+用户咨询：今年适合换工作吗
+
+请开始你的分析：
+        """
+        rendered = re.sub(r"当前时间：\d{4}年\d{2}月\d{2}日 \d{2}:\d{2}:\d{2}", "当前时间：<time>", model.calls[0]["prompt"])
+        if rendered != expected:
+            print("❌ 默认布局的提示词与原提示词不一致")
+            return False
+        print("✅ 默认布局与原提示词一致")
+        
+        # prefix_cache布局：同一命盘不同用户共享数据部分的前缀，日期在末尾
+        model = FakeChatModel()
+        service = make_prediction_service(model, LLM_CACHE_ENABLED=False, SECTIONED_GENERATION_ENABLED=False,
+                                          TWO_STAGE_ENABLED=False, PROMPT_LAYOUT='prefix_cache')
+        service.get_prediction(make_user('张三'), 'career')
+        service.get_prediction(make_user('李四'), 'career')
+        first, second = (call["prompt"] for call in model.calls)
+        shared = first.split("用户信息：")[0]
+        if not second.startswith(shared) or "张三" in shared or "正官格" not in shared \
+                or not first.rstrip().endswith("请开始你的事业分析：") or "当前日期：" not in first.split("性别：")[1]:
+            print("❌ prefix_cache布局的提示词前缀不稳定")
+            return False
+        print(f"✅ prefix_cache布局共享{len(shared)}字符的提示词前缀")
+        
+        # 记录前缀缓存命中的token数（OpenAI兼容的cache_read和DeepSeek的prompt_cache_hit_tokens）
+        usage = {"input_tokens": 1000, "output_tokens": 10, "total_tokens": 1010,
+                 "input_token_details": {"cache_read": 600}}
+        service.llm.backends[0].model = FakeChatModel(
+            lambda prompt: ["报告", AIMessageChunk(content="", usage_metadata=usage)])
+        service.get_prediction(make_user('王五'), 'career')
+        service._record_usage(AIMessage(content="", response_metadata={
+            "token_usage": {"prompt_tokens": 500, "prompt_cache_hit_tokens": 400}}), 'career')
+        report = service.get_usage_report()
+        if (report["calls"], report["prompt_tokens"], report["cache_hit_tokens"], report["cache_miss_tokens"]) \
+                != (2, 1500, 1000, 500) or report["prompt_layout"] != 'prefix_cache':
+            print(f"❌ 前缀缓存用量统计不正确: {report}")
+            return False
+        print(f"✅ 前缀缓存用量统计: {report}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 提示词布局测试失败: {str(e)}")
+        return False
+
+def test_chart_digest():
+    """测试命盘分析摘要（按命盘和生成摘要的模型缓存）"""
+    print("\n📝 测试命盘分析摘要...")
+    
+    try:
+        from services.bazi_service import BaziService
+        
+        model = FakeChatModel(lambda prompt: "命盘摘要" if "请输出命盘分析摘要" in prompt else "报告")
+        service = make_prediction_service(model, TWO_STAGE_ENABLED=True, LLM_CACHE_ENABLED=False,
+                                          SECTIONED_GENERATION_ENABLED=False)
+        
+        # 同一命盘的不同用户共用一份摘要
+        zhang, li = make_user('张三'), make_user('李四')
+        if service.get_chart_digest(zhang) != "命盘摘要" or service.get_chart_digest(li) != "命盘摘要" \
+                or len(model.calls) != 1:
+            print(f"❌ 同一命盘未共用摘要: 大模型调用{len(model.calls)}次")
+            return False
+        print("✅ 同一命盘的不同用户共用一份摘要")
+        
+        # 缓存键包含实际生成摘要的模型，更换后端模型后重新生成
+        template_key = service._template_key(service.digest_prompt)
+        if service.digest_cache.get(f"digest:fake:{template_key}:{BaziService.get_chart_key(zhang)}") != "命盘摘要":
+            print("❌ 摘要缓存键未包含生成摘要的模型")
+            return False
+        service.llm.backends[0].name = "other"
+        service.get_chart_digest(zhang)
+        if len(model.calls) != 2:
+            print(f"❌ 更换模型后仍使用旧摘要: 大模型调用{len(model.calls)}次")
+            return False
+        print("✅ 摘要缓存按生成摘要的模型区分")
+        
+        # 修改摘要提示词后不再使用旧摘要
+        from langchain.prompts import PromptTemplate
+        service.digest_prompt = PromptTemplate(input_variables=service.digest_prompt.input_variables,
+                                               template=service.digest_prompt.template + "\n不超过300字。")
+        service.get_chart_digest(zhang)
+        if len(model.calls) != 3:
+            print(f"❌ 修改摘要提示词后仍使用旧摘要: 大模型调用{len(model.calls)}次")
+            return False
+        print("✅ 摘要缓存按摘要提示词模板区分")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 命盘分析摘要测试失败: {str(e)}")
+        return False
+
+def test_sectioned_generation():
+    """测试分章节生成（并发生成、按固定顺序输出、章节失败时抛出异常）"""
+    print("\n📑 测试分章节生成...")
+    
+    try:
+        import re
+        import time
+        from services.prediction_service import PredictionService
+        
+        titles = [section['title'] for section in PredictionService.REPORT_SECTIONS.values()]
+        
+        def respond(prompt):
+            title = re.search(r"本次撰写的章节：(\S+)", prompt).group(1)
+            # 靠前的章节完成得更晚
+            time.sleep(0.05 * (len(titles) - titles.index(title)))
+            if title in failing:
+                raise RuntimeError(f"{title}生成失败")
+            return [f"{title}第一段", f"{title}第二段"]
+        
+        failing = set()
+        model = FakeChatModel(respond)
+        service = make_prediction_service(model, SECTIONED_GENERATION_ENABLED=True, TWO_STAGE_ENABLED=False,
+                                          LLM_CACHE_ENABLED=True, SECTION_MAX_TOKENS=600)
+        user_info = make_user()
+        started = time.monotonic()
+        content = "".join(service.stream_prediction(user_info, 'comprehensive'))
+        elapsed = time.monotonic() - started
+        expected = "".join(f"### {title}\n\n{title}第一段{title}第二段\n\n" for title in titles)
+        if content != expected:
+            print("❌ 章节内容或顺序不正确")
+            return False
+        if elapsed > 0.05 * len(titles) * 2 or any(call.get("max_tokens") != 600 for call in model.calls):
+            print(f"❌ 章节未并发生成或未使用章节的max_tokens: 耗时{elapsed:.2f}秒")
+            return False
+        print(f"✅ {len(titles)}个章节并发生成，按固定顺序输出（耗时{elapsed:.2f}秒）")
+        
+        # 章节缓存键包含章节的max_tokens
+        calls = len(model.calls)
+        service.get_prediction(user_info, 'comprehensive')
+        service.settings.SECTION_MAX_TOKENS = 800
+        service.get_prediction(user_info, 'comprehensive')
+        if len(model.calls) != calls + len(titles):
+            print(f"❌ 章节缓存键未区分max_tokens: 大模型调用{len(model.calls) - calls}次")
+            return False
+        print("✅ 章节缓存按章节的max_tokens区分")
+        
+        # 任一章节失败时，之前的章节正常输出，随后抛出异常
+        failing.add(titles[2])
+        received = []
+        try:
+            for chunk in service.stream_prediction(user_info, 'comprehensive', use_cache=False):
+                received.append(chunk)
+            print("❌ 章节失败未抛出异常")
+            return False
+        except RuntimeError:
+            pass
+        if f"### {titles[1]}\n\n" not in received or f"### {titles[3]}\n\n" in received:
+            print("❌ 章节失败前后的输出不正确")
+            return False
+        print("✅ 章节失败时异常传递给调用方")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 分章节生成测试失败: {str(e)}")
+        return False
+
+def test_tier_routing():
+    """测试模型分级路由（档位选择、按后端绑定模型）"""
+    print("\n🎚️ 测试模型分级路由...")
+    
+    try:
+        from services.llm_router import LLMBackend, LLMRouter
+        
+        def failing(prompt):
+            raise RuntimeError("后端出错")
+        
+        primary, backup = FakeChatModel(), FakeChatModel()
+        service = make_prediction_service(
+            primary, LLM_TIER_ROUTING_ENABLED=True, LLM_CACHE_ENABLED=False, SECTIONED_GENERATION_ENABLED=False,
+            TWO_STAGE_ENABLED=False, LLM_PROVIDER='chatdeepseek', LLM_TIER_HEAVY_MODEL='deepseek-reasoner',
+            LLM_TIER_LIGHT_MODEL='{"openai": "gpt-4o-mini"}', LLM_TIER_HEAVY_MAX_TOKENS=4000,
+            LLM_TIER_LONG_QUESTION_CHARS=20, LLM_TIER_SHORT_QUESTION_CHARS=10, LLM_TIER_HIGH_LOAD=8
+        )
+        service.llm = LLMRouter(backends=[LLMBackend("chatdeepseek", primary), LLMBackend("openai", backup)])
+        
+        # 按预测类型、问题长度和负载选择档位
+        long_question = "请详细分析我未来五年的事业发展、财运变化以及感情走向"
+        cases = [
+            ('comprehensive', long_question, 0, 'heavy'),
+            ('career', "", 0, 'light'),
+            ('career', long_question, 0, 'standard'),
+            ('comprehensive', "", 0, 'standard'),
+            ('comprehensive', "", 8, 'light'),
+            ('comprehensive', long_question, 8, 'heavy')
+        ]
+        for prediction_type, question, load, expected in cases:
+            service._inflight_llm_calls = load
+            tier = service._select_llm_params(make_user(question=question or None), prediction_type)["tier"]
+            if tier != expected:
+                print(f"❌ 档位选择不正确: {prediction_type}, 问题长度{len(question)}, 负载{load} -> {tier}")
+                return False
+        service._inflight_llm_calls = 0
+        print(f"✅ 档位选择正确: {service.get_tier_report()['decisions']}")
+        
+        # 档位模型只绑定到指定的后端，切换到其他后端时使用其配置的模型
+        primary.respond = failing
+        service.get_prediction(make_user(question=long_question), 'comprehensive')
+        if primary.calls[-1].get("model") != 'deepseek-reasoner' or primary.calls[-1].get("max_tokens") != 4000 \
+                or "model" in backup.calls[-1] or backup.calls[-1].get("max_tokens") != 4000:
+            print(f"❌ heavy档位的模型参数不正确: {primary.calls[-1]}, {backup.calls[-1]}")
+            return False
+        service.get_prediction(make_user(), 'career')
+        if "model" in primary.calls[-1] or backup.calls[-1].get("model") != 'gpt-4o-mini':
+            print(f"❌ light档位的模型参数不正确: {primary.calls[-1]}, {backup.calls[-1]}")
+            return False
+        service.get_prediction(make_user(), 'comprehensive')
+        if "model" in primary.calls[-1] or "model" in backup.calls[-1]:
+            print("❌ standard档位不应绑定模型")
+            return False
+        print("✅ 档位模型按后端绑定，未指定的后端使用其配置的模型")
+        
+        # 未启用分级路由时不绑定模型参数
+        service.settings.LLM_TIER_ROUTING_ENABLED = False
+        service.get_prediction(make_user(question=long_question), 'comprehensive')
+        if any(key in backup.calls[-1] for key in ("model", "max_tokens", "temperature")):
+            print(f"❌ 未启用分级路由时绑定了模型参数: {backup.calls[-1]}")
+            return False
+        print("✅ 未启用分级路由时不绑定模型参数")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 模型分级路由测试失败: {str(e)}")
+        return False
+
+def test_resilience():
+    """测试熔断器和重试预算"""
+    print("\n🛡️ 测试熔断器和重试预算...")
+    
+    try:
+        import time
+        from utils.resilience import CircuitBreaker, RetryBudget
+        
+        # 错误率达到阈值后打开，快速拒绝请求
+        breaker = CircuitBreaker("test", failure_rate_threshold=0.5, min_requests=4, open_duration=0.05)
+        for _ in range(4):
+            breaker.record_failure()
+        if breaker.state != 'open' or breaker.allow_request():
+            print("❌ 熔断器未按错误率打开")
+            return False
+        print("✅ 熔断器打开后快速失败")
+        
+        # 到期后半开，只放行探测请求，探测成功后关闭
+        time.sleep(0.06)
+        if not breaker.allow_request() or breaker.allow_request():
+            print("❌ 熔断器半开状态探测不正确")
+            return False
+        breaker.record_success()
+        if breaker.state != 'closed':
+            print("❌ 探测成功后熔断器未关闭")
+            return False
+        print("✅ 熔断器半开探测后恢复")
+        
+        # 重试次数受预算限制
+        budget = RetryBudget(ratio=0.5, min_retries=1, window=10)
+        for _ in range(4):
+            budget.record_request()
+        granted = sum(budget.try_acquire_retry() for _ in range(5))
+        if granted != 2:
+            print(f"❌ 重试预算不正确: 允许{granted}次")
+            return False
+        print(f"✅ 重试预算生效: {budget.stats()}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 熔断器和重试预算测试失败: {str(e)}")
+        return False
+
+def test_async_client():
+    """测试缘分居异步客户端的重试和熔断（httpx.MockTransport模拟上游）"""
+    print("\n🌐 测试异步客户端...")
+    
+    try:
+        import asyncio
+        import time
+        import httpx
+        from api_client import AsyncYuanFenJuAPIClient
+        from utils.resilience import CircuitBreaker, RetryBudget
+        
+        def make_client(status_codes):
+            """按顺序返回status_codes中状态码的客户端，记录请求次数"""
+            requests_seen = []
+            
+            def handler(request):
+                status = status_codes[min(len(requests_seen), len(status_codes) - 1)]
+                requests_seen.append(request)
+                return httpx.Response(status, json={"errcode": 0 if status == 200 else status, "data": {}})
+            
+            client = AsyncYuanFenJuAPIClient(transport=httpx.MockTransport(handler))
+            client.settings.RETRY_DELAY = 0
+            client.circuit_breaker = CircuitBreaker("test", min_requests=100, open_duration=0.05)
+            client.retry_budget = RetryBudget(min_retries=10)
+            return client, requests_seen
+        
+        async def fetch(client):
+            async with client:
+                return await client.get_fortune_prediction({"name": "张三", "gender": "男"})
+        
+        # 成功请求直接返回
+        client, requests_seen = make_client([200])
+        if asyncio.run(fetch(client))["errcode"] != 0 or len(requests_seen) != 1:
+            print("❌ 异步请求未正确返回")
+            return False
+        print("✅ 异步请求成功返回")
+        
+        # 5xx重试后成功
+        client, requests_seen = make_client([503, 502, 200])
+        if asyncio.run(fetch(client))["errcode"] != 0 or len(requests_seen) != 3:
+            print(f"❌ 5xx未重试: 请求{len(requests_seen)}次")
+            return False
+        print("✅ 5xx错误重试后成功")
+        
+        # 4xx不重试，也不影响熔断器（半开状态保持半开，探测名额释放）
+        client, requests_seen = make_client([400])
+        for _ in range(client.circuit_breaker.min_requests):
+            client.circuit_breaker.record_failure()
+        time.sleep(0.06)
+        if client.circuit_breaker.state != CircuitBreaker.HALF_OPEN:
+            print("❌ 熔断器未进入半开状态")
+            return False
+        try:
+            asyncio.run(fetch(client))
+            print("❌ 4xx错误未抛出异常")
+            return False
+        except Exception:
+            pass
+        if len(requests_seen) != 1:
+            print(f"❌ 4xx错误被重试: 请求{len(requests_seen)}次")
+            return False
+        if client.circuit_breaker.state != CircuitBreaker.HALF_OPEN or not client.circuit_breaker.allow_request():
+            print("❌ 4xx错误改变了熔断器状态")
+            return False
+        print("✅ 4xx错误不重试，熔断器状态不变")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 异步客户端测试失败: {str(e)}")
+        return False
+
+def test_llm_router():
+    """测试大模型路由（本地OpenAI兼容桩服务）"""
+    print("\n🔀 测试大模型路由...")
+    
+    try:
+        import json
+        import threading
+        import time
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from services.llm_router import LLMBackend, LLMRouter, create_chat_model
+        
+        def start_stub(content, delay):
+            """启动返回固定内容的OpenAI兼容流式桩服务，delay为首字前的等待时间"""
+            class Handler(BaseHTTPRequestHandler):
+                def do_POST(self):
+                    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    time.sleep(delay)
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.end_headers()
+                    try:
+                        for text in (content, ""):
+                            chunk = {
+                                "id": "stub", "object": "chat.completion.chunk", "created": 0, "model": "stub",
+                                "choices": [{"index": 0, "delta": {"content": text},
+                                             "finish_reason": None if text else "stop"}]
+                            }
+                            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.write(b"data: [DONE]\n\n")
+                    except (BrokenPipeError, ConnectionResetError):
+                        # 路由切换后端后会关闭被放弃的请求
+                        pass
+                
+                def log_message(self, *args):
+                    pass
+            
+            server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            return server, f"http://127.0.0.1:{server.server_port}/v1"
+        
+        slow_server, slow_url = start_stub("慢速后端", delay=1.0)
+        fast_server, fast_url = start_stub("快速后端", delay=0)
+        router = LLMRouter(
+            backends=[
+                LLMBackend("slow", create_chat_model('chatopenai', 'stub', 'test', slow_url, max_retries=0)),
+                LLMBackend("fast", create_chat_model('chatopenai', 'stub', 'test', fast_url, max_retries=0))
+            ],
+            first_token_timeout=0.5
+        )
+        
+        # 首个后端首字超时，切换到下一个后端
+        if router.invoke("你好").content != "快速后端":
+            print("❌ 首字超时后未切换后端")
+            return False
+        print("✅ 首字超时后切换后端")
+        
+        # 之后优先选择延迟更低的后端
+        if [backend.name for backend in router.select_backends()] != ["fast", "slow"]:
+            print("❌ 未按延迟选择后端")
+            return False
+        print(f"✅ 按延迟选择后端: {router.stats()}")
+
+        # 请求超时作为整体上限，用完后不再切换后端
+        slow_router = LLMRouter(
+            backends=[
+                LLMBackend("slow1", create_chat_model('chatopenai', 'stub', 'test', slow_url, max_retries=0)),
+                LLMBackend("slow2", create_chat_model('chatopenai', 'stub', 'test', slow_url, max_retries=0))
+            ],
+            first_token_timeout=0.8
+        )
+        started = time.monotonic()
+        try:
+            slow_router.bind(timeout=0.3).invoke("你好")
+            print("❌ 超出请求超时后仍返回结果")
+            return False
+        except TimeoutError:
+            pass
+        if time.monotonic() - started > 0.6:
+            print("❌ 请求超时未限制后端切换")
+            return False
+        print("✅ 请求超时限制首字等待和后端切换")
+
+        slow_server.shutdown()
+        fast_server.shutdown()
+        
+        from langchain_core.messages import AIMessageChunk
+        
+        class ScriptedModel:
+            """按脚本输出片段的后端桩，script为[(等待秒数, 正文, 推理内容)]，记录流是否被关闭"""
+            def __init__(self, script):
+                self.script = script
+                self.sent = 0
+                self.closed = threading.Event()
+            
+            def stream(self, messages, stop=None, **kwargs):
+                try:
+                    for delay, content, reasoning in self.script:
+                        time.sleep(delay)
+                        self.sent += 1
+                        yield AIMessageChunk(content=content, additional_kwargs={"reasoning_content": reasoning})
+                finally:
+                    self.closed.set()
+        
+        # 唯一（最后一个）后端不按首字超时切换
+        single = LLMRouter(backends=[LLMBackend("only", ScriptedModel([(0.4, "迟到的回复", "")]))],
+                           first_token_timeout=0.1)
+        if single.invoke("你好").content != "迟到的回复":
+            print("❌ 最后一个后端因首字超时失败")
+            return False
+        print("✅ 最后一个后端不按首字超时切换")
+        
+        # 推理过程的片段也算首字，不切换后端
+        reasoning_model = ScriptedModel([(0.05, "", "思考中"), (0.3, "推理后的回复", "")])
+        reasoning_router = LLMRouter(
+            backends=[LLMBackend("reasoner", reasoning_model),
+                      LLMBackend("backup", ScriptedModel([(0, "备用回复", "")]))],
+            first_token_timeout=0.2
+        )
+        if reasoning_router.invoke("你好").content != "推理后的回复":
+            print("❌ 推理过程的片段未计为首字")
+            return False
+        print("✅ 推理过程的片段计为首字")
+        
+        # 切换后端后关闭被放弃的流，不再继续生成
+        abandoned = ScriptedModel([(0.3, "被放弃的回复", "")] + [(0.01, "后续内容", "")] * 20)
+        failover_router = LLMRouter(
+            backends=[LLMBackend("stalled", abandoned), LLMBackend("backup", ScriptedModel([(0, "备用回复", "")]))],
+            first_token_timeout=0.1
+        )
+        if failover_router.invoke("你好").content != "备用回复":
+            print("❌ 首字超时后未切换后端")
+            return False
+        if not abandoned.closed.wait(1.0) or abandoned.sent != 1:
+            print(f"❌ 被放弃的流未关闭: 已输出{abandoned.sent}个片段")
+            return False
+        print("✅ 切换后端后关闭被放弃的流")
+        
+        # 首字之后输出停滞时，请求超时同样生效并关闭流
+        from utils.deadline import DeadlineExceeded
+        stalled_after_first = ScriptedModel([(0, "开头", ""), (2.0, "迟到的后续", "")])
+        stall_router = LLMRouter(backends=[LLMBackend("only", stalled_after_first)])
+        started = time.monotonic()
+        try:
+            stall_router.bind(timeout=0.3).invoke("你好")
+            print("❌ 首字之后输出停滞时未超时")
+            return False
+        except DeadlineExceeded:
+            pass
+        if time.monotonic() - started > 1.0 or not stalled_after_first.closed.wait(3.0):
+            print("❌ 首字之后的超时未按剩余时间生效")
+            return False
+        print("✅ 首字之后输出停滞时按剩余时间超时")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 大模型路由测试失败: {str(e)}")
+        return False
+
+def test_bazi_engine():
+    """测试本地排盘引擎"""
+    print("\n🧭 测试本地排盘引擎...")
+    
+    try:
+        from services.bazi_engine import compute_pillars, ten_god
+        
+        # 立春前仍属上一年，小寒前为子月
+        pillars = compute_pillars(1990, 1, 1, 12, 0)
+        if pillars != ('己巳', '丙子', '丙寅', '甲午'):
+            print(f"❌ 四柱计算不正确: {pillars}")
+            return False
+        print(f"✅ 四柱计算正确: {' '.join(pillars)}")
+        
+        # 2024年立春为2月4日16:27，前后分属癸卯年丑月和甲辰年寅月
+        before, after = compute_pillars(2024, 2, 4, 16, 0), compute_pillars(2024, 2, 4, 17, 0)
+        if before[:2] != ('癸卯', '乙丑') or after[:2] != ('甲辰', '丙寅'):
+            print(f"❌ 节气换年换月不正确: {before} {after}")
+            return False
+        print("✅ 以立春换年、以节气换月")
+        
+        # 节气时刻与公布值（北京时间，IERS/ERFA星历）相差不超过3秒
+        from datetime import datetime
+        from utils.astronomy import solar_term_time
+        published = {
+            (1990, 315): datetime(1990, 2, 4, 10, 14, 0), (2000, 0): datetime(2000, 3, 20, 15, 35, 15),
+            (2024, 315): datetime(2024, 2, 4, 16, 27, 8), (2024, 0): datetime(2024, 3, 20, 11, 6, 24),
+            (2024, 90): datetime(2024, 6, 21, 4, 51, 0), (2024, 270): datetime(2024, 12, 21, 17, 20, 34),
+            (2025, 315): datetime(2025, 2, 3, 22, 10, 28)
+        }
+        errors = {key: abs((solar_term_time(*key) - instant).total_seconds()) for key, instant in published.items()}
+        if max(errors.values()) > 3:
+            print(f"❌ 节气时刻误差过大: {errors}")
+            return False
+        # 2024年立春在16:27:08，16:27仍属癸卯年，16:28起为甲辰年
+        if compute_pillars(2024, 2, 4, 16, 27)[:2] != ('癸卯', '乙丑') \
+                or compute_pillars(2024, 2, 4, 16, 28)[:2] != ('甲辰', '丙寅'):
+            print("❌ 立春前后一分钟的年柱、月柱不正确")
+            return False
+        print(f"✅ 节气时刻与公布值相差不超过{max(errors.values()):.1f}秒")
+        
+        # 23点起算次日
+        if compute_pillars(2024, 1, 1, 23, 30)[2:] != ('乙丑', '丙子'):
+            print("❌ 子时换日不正确")
+            return False
+        print("✅ 23点起算次日")
+        
+        from utils.calendar_tables import load_calendar_tables
+        from utils import astronomy
+        tables = load_calendar_tables()
+        if tables is None or not tables.covers(1900) or not tables.covers(2100):
+            print("❌ 历法表加载失败")
+            return False
+        drift = abs((tables.jie_times(2024)[1] - astronomy.solar_term_time(2024, 315)).total_seconds())
+        if drift > 1:
+            print(f"❌ 历法表与实时计算不一致: 相差{drift}秒")
+            return False
+        print(f"✅ 历法表加载成功: {tables.start_year}-{tables.end_year}")
+
+        # 时差（Meeus例28.b：1992年10月13日为13分42.6秒）
+        from datetime import datetime
+        equation = astronomy.equation_of_time(astronomy.julian_day(datetime(1992, 10, 13)))
+        if abs(equation - 13.71) > 0.02:
+            print(f"❌ 时差计算不正确: {equation:.2f}分钟")
+            return False
+
+        # 乌鲁木齐北京时间10:30约为真太阳时8:06，时柱由巳时变为辰时
+        from utils.solar_time import load_city_index, true_solar_time
+        index = load_city_index()
+        location = index.lookup('新疆维吾尔自治区', '乌鲁木齐市') if index else None
+        if location is None:
+            print("❌ 省市经纬度索引加载失败")
+            return False
+        solar = true_solar_time(datetime(2024, 2, 11, 10, 30), location[0])
+        pillars = compute_pillars(2024, 2, 11, 10, 30, longitude=location[0])
+        if solar.strftime('%H:%M') != '08:06' or pillars[3][1] != '辰':
+            print(f"❌ 真太阳时校正不正确: {solar} {pillars}")
+            return False
+        print(f"✅ 真太阳时校正正确: 索引{len(index)}个城市")
+
+        # 农历换算：2023年闰二月初一为公历3月22日，农历正月初一在创建UserInfo时换算为公历
+        from datetime import date
+        from utils.lunar_calendar import lunar_to_solar, solar_to_lunar
+        from models.user_info import UserInfo
+        user_info = UserInfo(name='张三', gender='男', birth_year=2024, birth_month=1, birth_day=1,
+                             birth_hour=8, birth_province='北京市', birth_city='北京', calendar_type='lunar')
+        if (lunar_to_solar(2023, 2, 1, True) != date(2023, 3, 22)
+                or str(solar_to_lunar(date(1990, 1, 1))) != '农历1989年腊月初五'
+                or (user_info.birth_month, user_info.birth_day) != (2, 10)):
+            print(f"❌ 农历换算不正确: {user_info}")
+            return False
+        try:
+            lunar_to_solar(2024, 2, 1, True)
+            print("❌ 不存在的闰月未报错")
+            return False
+        except ValueError:
+            pass
+        print(f"✅ 农历换算正确: {user_info.lunar_birth_date}")
+
+        # 批量排盘与逐条计算一致（乌鲁木齐经度按真太阳时划分时柱）
+        import numpy as np
+        from services.bazi_engine import compute_pillars_bulk, TIAN_GAN, DI_ZHI
+        times = np.array(['1990-01-01T12:00', '2024-02-04T16:00', '2024-02-04T17:00', '2024-02-11T10:30'],
+                         dtype='datetime64[m]')
+        bulk = compute_pillars_bulk(times, ['男', '女', '男', '女'], [np.nan, np.nan, np.nan, location[0]])
+        expected = [compute_pillars(1990, 1, 1, 12, 0), before, after, pillars]
+        result = [tuple(TIAN_GAN[s] + DI_ZHI[b] for s, b in zip(stems, branches))
+                  for stems, branches in zip(bulk.stems, bulk.branches)]
+        if result != expected or bulk.female.tolist() != [False, True, False, True]:
+            print(f"❌ 批量排盘结果不一致: {result}")
+            return False
+        print("✅ 批量排盘与逐条计算一致")
+
+        if ten_god('甲', '庚') != '七杀' or ten_god('甲', '己') != '正财' or ten_god('丙', '乙') != '正印':
+            print("❌ 十神计算不正确")
+            return False
+        print("✅ 十神计算正确")
+        
+        # hybrid模式：四柱和天干十神以本地排盘为准，上游的其余字段保留，合并结果仍可按上游格式解析
+        from models.bazi_data import BaziData
+        from services.bazi_service import BaziService
+        
+        class CesuanAPIClient:
+            """返回缘分居cesuan接口格式数据的API桩（字段按BaziData.from_api_response解析的结构）"""
+            def get_fortune_prediction(self, user_info, prediction_type='general', deadline=None):
+                return {"errcode": 0, "errmsg": "success", "data": {
+                    "base_info": {"name": user_info["name"], "sex": "乾造", "gongli": "1990年1月1日12时",
+                                  "zhengge": "正官格",
+                                  "zhen": {"province": "北京市", "city": "北京", "shicha": "-17分"}},
+                    "bazi_info": {"kw": "戌亥", "bazi": ["己巳", "丙子", "丙寅", "乙未"],
+                                  "tg_cg_god": ["伤官", "比肩", "日主", "正印"]},
+                    "dayun_info": {"big": ["丁丑", "戊寅"], "big_god": ["劫财", "食神"], "xu_sui": [3, 13]}
+                }}
+        
+        service = BaziService()
+        service.settings.CHART_SOURCE = 'hybrid'
+        service.api_client = CesuanAPIClient()
+        user_info = UserInfo(name='张三', gender='男', birth_year=1990, birth_month=1, birth_day=1,
+                             birth_hour=12, birth_province='北京市', birth_city='北京')
+        local_chart = service.engine.compute_chart(user_info)
+        merged = service.get_fortune_analysis(user_info)
+        base_info, bazi_info = merged["base_info"], merged["bazi_info"]
+        if (bazi_info["bazi"] != local_chart["bazi_info"]["bazi"]
+                or bazi_info["tg_cg_god"] != local_chart["bazi_info"]["tg_cg_god"]
+                or merged["chart_source"] != 'hybrid'):
+            print(f"❌ hybrid模式四柱未以本地排盘为准: {bazi_info}")
+            return False
+        if (base_info["gongli"] != "1990年1月1日12时" or base_info["zhen"]["shicha"] != "-17分"
+                or base_info["zhengge"] != "正官格" or bazi_info["kw"] != "戌亥"
+                or bazi_info["cg"] != local_chart["bazi_info"]["cg"] or merged["dayun_info"]["big"] != ["丁丑", "戊寅"]):
+            print(f"❌ hybrid模式覆盖或丢失了上游字段: {merged}")
+            return False
+        bazi_data = BaziData.from_api_response(merged)
+        if bazi_data.get_bazi_string() != ' '.join(local_chart["bazi_info"]["bazi"]) or bazi_data.pattern != "正官格" \
+                or [item["pillar"] for item in bazi_data.dayun] != ["丁丑", "戊寅"]:
+            print("❌ hybrid合并结果无法按上游格式解析")
+            return False
+        print(f"✅ hybrid模式合并上游数据: 四柱{bazi_data.get_bazi_string()}，保留格局、大运等上游字段")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 本地排盘引擎测试失败: {str(e)}")
+        return False
+
 def test_file_structure():
     """测试文件结构"""
     print("\n📁 测试文件结构...")
@@ -283,9 +1651,26 @@ def main():
         ("模块导入", test_imports),
         ("配置系统", test_configuration),
         ("数据模型", test_data_models),
+        ("追问对话", test_conversation),
         ("数据验证", test_data_validator),
         ("日志系统", test_logger),
-        ("服务层", test_services)
+        ("服务层", test_services),
+        ("缓存", test_cache),
+        ("磁盘缓存", test_sqlite_cache),
+        ("命盘缓存", test_chart_cache),
+        ("请求合并", test_singleflight),
+        ("响应缓存", test_response_cache),
+        ("批量预测", test_batch_runner),
+        ("多类型预测", test_multi_predictions),
+        ("数据投影", test_data_projection),
+        ("提示词布局", test_prompt_layout),
+        ("命盘摘要", test_chart_digest),
+        ("分章节生成", test_sectioned_generation),
+        ("模型分级路由", test_tier_routing),
+        ("熔断与重试", test_resilience),
+        ("异步客户端", test_async_client),
+        ("大模型路由", test_llm_router),
+        ("本地排盘", test_bazi_engine)
     ]
     
     passed = 0
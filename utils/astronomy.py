@@ -0,0 +1,336 @@
+import math
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+
+# J2000.0历元的儒略日
+J2000 = 2451545.0
+
+# 地球日心黄经的VSOP87D级数（Bretagnon & Francou），保留1900-2100年间振幅不小于5e-8弧度的项，
+# 每项为(A, B, C)，取值A*cos(B + C*τ)，单位1e-8弧度
+_EARTH_L = (
+    (
+        (175347046, 0, 0), (3341656, 4.669257, 6283.07585), (34894, 4.626102, 12566.1517),
+        (3497, 2.744118, 5753.38488), (3418, 2.828866, 3.52312), (3136, 3.62767, 77713.77147),
+        (2676, 4.418084, 7860.41939), (2343, 6.135162, 3930.2097), (1324, 0.742464, 11506.76977),
+        (1273, 2.037097, 529.69097), (1199, 1.109629, 1577.34354), (990, 5.232681, 5884.92685),
+        (902, 2.045054, 26.29832), (857, 3.508492, 398.149), (780, 1.178827, 5223.69392),
+        (753, 2.533391, 5507.55324), (505, 4.582926, 18849.22755), (492, 4.205066, 775.52261),
+        (357, 2.919541, 0.06731), (317, 5.84902, 11790.62909), (284, 1.89869, 796.29801),
+        (271, 0.314886, 10977.0788), (243, 0.344811, 5486.77784), (206, 4.806466, 2544.31442),
+        (205, 1.869478, 5573.1428), (202, 2.457678, 6069.77675), (156, 0.833061, 213.2991),
+        (132, 3.411183, 2942.46342), (126, 1.083026, 20.7754), (115, 0.645449, 0.98032),
+        (103, 0.635998, 4694.00295), (102, 0.975692, 15720.83878), (102, 4.266798, 7.11355),
+        (99, 6.209929, 2146.16542), (98, 0.681013, 155.4204), (86, 5.983226, 161000.68574),
+        (85, 1.298707, 6275.9623), (85, 3.670801, 71430.69562), (80, 1.807913, 17260.15465),
+        (79, 3.036983, 12036.46073), (75, 1.755089, 5088.62884), (74, 3.503194, 3154.68708),
+        (74, 4.679266, 801.82093), (70, 0.832976, 9437.76293), (62, 3.977639, 8827.39027),
+        (61, 1.818398, 7084.89678), (57, 2.784304, 6286.59897), (56, 4.386949, 14143.49524),
+        (56, 3.47006, 6279.55273), (52, 0.189149, 12139.55351), (52, 1.332827, 1748.01641),
+        (51, 0.283069, 5856.47766), (49, 0.487351, 1194.44701), (41, 5.368174, 8429.24127),
+        (41, 2.398509, 19651.04848), (39, 6.16833, 10447.38784), (37, 6.041339, 10213.28555),
+        (37, 2.569552, 1059.38193), (36, 1.708761, 2352.86615), (36, 1.775973, 6812.76682),
+        (33, 0.593095, 17789.84562), (30, 0.442945, 83996.84732), (30, 2.739751, 1349.86741),
+        (25, 3.16471, 4690.47984), (25, 0.214848, 3.59043), (24, 0.484736, 8031.09226),
+        (24, 2.065277, 3340.61243), (23, 5.221979, 4705.73231), (22, 5.555943, 553.5694),
+        (21, 1.425637, 16730.46369), (21, 4.148255, 951.71841), (20, 0.371338, 283.85932),
+        (20, 5.222085, 12168.0027), (20, 5.774702, 6309.37417), (19, 3.8222, 23581.25818),
+        (19, 5.386269, 149854.40013), (18, 2.214907, 13367.97263), (17, 4.560529, 135.06508),
+        (16, 5.988377, 11769.85369), (15, 4.195672, 6256.77753), (14, 4.193153, 242.7286),
+        (14, 3.723551, 38.02767), (14, 4.401381, 6681.22485), (14, 1.889345, 7632.94326),
+        (13, 1.130524, 5.52292), (12, 2.622296, 955.59974), (12, 1.003515, 632.78374),
+        (11, 0.177393, 4164.31199), (11, 0.327345, 103.09277), (11, 0.938718, 11926.25441),
+        (10, 5.359095, 1592.59601), (10, 6.199826, 6438.49625), (10, 6.02915, 5746.27134),
+        (10, 0.999475, 11371.70469), (10, 5.24414, 27511.46787), (9, 2.624142, 5760.49843),
+        (9, 0.48344, 522.57742), (9, 4.571386, 4292.33083), (9, 5.336863, 6386.16862),
+        (9, 4.165382, 7058.59846), (8, 3.299467, 7234.79426), (8, 4.539027, 25132.3034),
+        (8, 6.11228, 4732.03063), (8, 6.27053, 426.59819), (8, 5.821453, 28.44919),
+        (8, 0.995902, 5643.17856), (8, 2.957291, 23013.53954), (8, 3.121424, 7238.67559),
+        (8, 3.973829, 11499.65622), (7, 4.385824, 316.39187), (7, 0.606525, 11513.88332),
+        (7, 3.998315, 74.7816), (7, 0.322584, 263.08392), (7, 5.911325, 90955.55169),
+        (7, 3.664752, 17298.18233), (7, 5.790729, 18073.70494), (6, 4.717248, 6836.64525),
+        (6, 1.458233, 233141.3144), (6, 1.074949, 19804.82729), (6, 3.320513, 6283.00854),
+        (6, 2.87641, 6283.14316), (6, 2.451526, 12352.8526), (5, 5.39199, 419.48464),
+        (5, 0.382176, 31441.67757), (5, 4.065039, 6208.29425), (5, 2.360628, 10973.55569)
+    ),
+    (
+        (628331966747, 0, 0), (206059, 2.678235, 6283.07585), (4303, 2.635127, 12566.1517),
+        (425, 1.59047, 3.52312), (119, 5.795575, 26.29832), (109, 2.96618, 1577.34354),
+        (93, 2.592128, 18849.22755), (72, 1.138462, 529.69097), (68, 1.874723, 398.149),
+        (67, 4.409182, 5507.55324), (59, 2.88797, 5223.69392), (56, 2.174717, 155.4204)
+    ),
+    (
+        (52919, 0, 0), (8720, 1.072097, 6283.07585)
+    )
+)
+
+# 日地距离的主要项（用于光行差），单位1e-8天文单位
+_EARTH_R = (
+    (
+        (100013989, 0, 0), (1670700, 3.0984635, 6283.07585), (13956, 3.05525, 12566.1517),
+        (3084, 5.1985, 77713.7715), (1628, 1.1739, 5753.3849), (1576, 2.8469, 7860.4194)
+    ),
+    (
+        (103019, 1.10749, 6283.07585), (1721, 1.0644, 12566.1517)
+    )
+)
+
+# 朔望月长度（天）
+SYNODIC_MONTH = 29.530588861
+
+# 朔日的周期项改正（Meeus第49章），每项为(系数, E的幂次, M'、M、F、Ω的倍数)
+_NEW_MOON_TERMS = (
+    (-0.40720, 0, (1, 0, 0, 0)), (0.17241, 1, (0, 1, 0, 0)), (0.01608, 0, (2, 0, 0, 0)),
+    (0.01039, 0, (0, 0, 2, 0)), (0.00739, 1, (1, -1, 0, 0)), (-0.00514, 1, (1, 1, 0, 0)),
+    (0.00208, 2, (0, 2, 0, 0)), (-0.00111, 0, (1, 0, -2, 0)), (-0.00057, 0, (1, 0, 2, 0)),
+    (0.00056, 1, (2, 1, 0, 0)), (-0.00042, 0, (3, 0, 0, 0)), (0.00042, 1, (0, 1, 2, 0)),
+    (0.00038, 1, (0, 1, -2, 0)), (-0.00024, 1, (2, -1, 0, 0)), (-0.00017, 0, (0, 0, 0, 1)),
+    (-0.00007, 0, (1, 2, 0, 0)), (0.00004, 0, (2, 0, -2, 0)), (0.00004, 0, (0, 3, 0, 0)),
+    (0.00003, 0, (1, 1, -2, 0)), (0.00003, 0, (2, 0, 2, 0)), (-0.00003, 0, (1, 1, 2, 0)),
+    (0.00003, 0, (1, -1, 2, 0)), (-0.00002, 0, (1, -1, -2, 0)), (-0.00002, 0, (3, 1, 0, 0)),
+    (0.00002, 0, (4, 0, 0, 0))
+)
+
+# 行星摄动项：(系数, 初相, k的系数)
+_NEW_MOON_PLANETARY = (
+    (0.000165, 251.88, 0.016321), (0.000164, 251.83, 26.651886), (0.000126, 349.42, 36.412478),
+    (0.00011, 84.66, 18.206239), (0.000062, 141.74, 53.303771), (0.00006, 207.14, 2.453732),
+    (0.000056, 154.84, 7.30686), (0.000047, 34.52, 27.261239), (0.000042, 207.19, 0.121824),
+    (0.00004, 291.34, 1.844379), (0.000037, 161.72, 24.198154), (0.000035, 239.56, 25.513099),
+    (0.000023, 331.55, 3.592518)
+)
+
+# 十二节气（月令起点）对应的太阳视黄经，按公历年内的先后顺序：小寒、立春、惊蛰……大雪
+JIE_LONGITUDES = (285, 315, 345, 15, 45, 75, 105, 135, 165, 195, 225, 255)
+JIE_NAMES = ('小寒', '立春', '惊蛰', '清明', '立夏', '芒种', '小暑', '立秋', '白露', '寒露', '立冬', '大雪')
+
+# 北京时间与世界时的时差（天）
+BEIJING_OFFSET = 8 / 24
+
+# VSOP87的黄经岁差比IAU 2006岁差每儒略世纪快约0.3004角秒，换算到现行岁差模型时扣除
+PRECESSION_CORRECTION = 0.3004
+
+# IAU 1980章动序列中振幅不小于0.0015角秒的项（Meeus第22章），
+# 每项为(D、M、M'、F、Ω的倍数, 黄经章动系数, 其T项, 交角章动系数, 其T项)，单位0.0001角秒
+_NUTATION_TERMS = (
+    ((0, 0, 0, 0, 1), -171996, -174.2, 92025, 8.9), ((-2, 0, 0, 2, 2), -13187, -1.6, 5736, -3.1),
+    ((0, 0, 0, 2, 2), -2274, -0.2, 977, -0.5), ((0, 0, 0, 0, 2), 2062, 0.2, -895, 0.5),
+    ((0, 1, 0, 0, 0), 1426, -3.4, 54, -0.1), ((0, 0, 1, 0, 0), 712, 0.1, -7, 0),
+    ((-2, 1, 0, 2, 2), -517, 1.2, 224, -0.6), ((0, 0, 0, 2, 1), -386, -0.4, 200, 0),
+    ((0, 0, 1, 2, 2), -301, 0, 129, -0.1), ((-2, -1, 0, 2, 2), 217, -0.5, -95, 0.3),
+    ((-2, 0, 1, 0, 0), -158, 0, 0, 0), ((-2, 0, 0, 2, 1), 129, 0.1, -70, 0),
+    ((0, 0, -1, 2, 2), 123, 0, -53, 0), ((2, 0, 0, 0, 0), 63, 0, 0, 0),
+    ((0, 0, 1, 0, 1), 63, 0.1, -33, 0), ((2, 0, -1, 2, 2), -59, 0, 26, 0),
+    ((0, 0, -1, 0, 1), -58, -0.1, 32, 0), ((0, 0, 1, 2, 1), -51, 0, 27, 0),
+    ((-2, 0, 2, 0, 0), 48, 0, 0, 0), ((0, 0, -2, 2, 1), 46, 0, -24, 0),
+    ((2, 0, 0, 2, 2), -38, 0, 16, 0), ((0, 0, 2, 2, 2), -31, 0, 13, 0),
+    ((0, 0, 2, 0, 0), 29, 0, 0, 0), ((-2, 0, 1, 2, 2), 29, 0, -12, 0),
+    ((0, 0, 0, 2, 0), 26, 0, 0, 0), ((-2, 0, 0, 2, 0), -22, 0, 0, 0),
+    ((0, 0, -1, 2, 1), 21, 0, -10, 0), ((0, 2, 0, 0, 0), 17, -0.1, 0, 0),
+    ((2, 0, -1, 0, 1), 16, 0, -8, 0), ((-2, 2, 0, 2, 2), -16, 0.1, 7, 0),
+    ((0, 1, 0, 0, 1), -15, 0, 9, 0)
+)
+
+# 2005-2025年初的ΔT实测值（秒，IERS）；2005年前的多项式与实测相差不到1秒，之后的多项式外推偏大
+DELTA_T_OBSERVED_START = 2005
+DELTA_T_OBSERVED = (
+    64.69, 64.85, 65.15, 65.46, 65.78, 66.07, 66.32, 66.60, 66.91, 67.28, 67.64,
+    68.10, 68.59, 68.97, 69.22, 69.36, 69.36, 69.29, 69.20, 69.18, 69.14
+)
+
+
+def _series(terms, tau: float) -> float:
+    """计算VSOP87级数：Σ τ^i Σ A cos(B + Cτ)"""
+    total = 0.0
+    for power, group in enumerate(terms):
+        total += sum(a * math.cos(b + c * tau) for a, b, c in group) * tau ** power
+    return total
+
+
+def delta_t(year: float) -> float:
+    """力学时与世界时之差ΔT（秒），2005年前采用Espenak-Meeus多项式，2005-2025年采用实测值"""
+    if 1860 <= year < 1900:
+        t = year - 1860
+        return 7.62 + 0.5737 * t - 0.251754 * t ** 2 + 0.01680668 * t ** 3 \
+            - 0.0004473624 * t ** 4 + t ** 5 / 233174
+    if 1900 <= year < 1920:
+        t = year - 1900
+        return -2.79 + 1.494119 * t - 0.0598939 * t ** 2 + 0.0061966 * t ** 3 - 0.000197 * t ** 4
+    if 1920 <= year < 1941:
+        t = year - 1920
+        return 21.20 + 0.84493 * t - 0.0761 * t ** 2 + 0.0020936 * t ** 3
+    if 1941 <= year < 1961:
+        t = year - 1950
+        return 29.07 + 0.407 * t - t ** 2 / 233 + t ** 3 / 2547
+    if 1961 <= year < 1986:
+        t = year - 1975
+        return 45.45 + 1.067 * t - t ** 2 / 260 - t ** 3 / 718
+    if 1986 <= year < 2005:
+        t = year - 2000
+        return 63.86 + 0.3345 * t - 0.060374 * t ** 2 + 0.0017275 * t ** 3 \
+            + 0.000651814 * t ** 4 + 0.00002373599 * t ** 5
+    last_year = DELTA_T_OBSERVED_START + len(DELTA_T_OBSERVED) - 1
+    if DELTA_T_OBSERVED_START <= year < last_year:
+        # 实测值之间线性插值
+        offset = year - DELTA_T_OBSERVED_START
+        index = int(offset)
+        return DELTA_T_OBSERVED[index] + (offset - index) * (DELTA_T_OBSERVED[index + 1] - DELTA_T_OBSERVED[index])
+    long_term = -20 + 32 * ((year - 1820) / 100) ** 2
+    if last_year <= year < 2150:
+        # 从最后一个实测值逐渐过渡到长期抛物线，2150年起与其重合
+        gap = -20 + 32 * ((last_year - 1820) / 100) ** 2 - DELTA_T_OBSERVED[-1]
+        return long_term - gap * (2150 - year) / (2150 - last_year)
+    return long_term
+
+
+def apparent_solar_longitude(jde: float) -> float:
+    """太阳视黄经（度），jde为力学时儒略日
+
+    地心黄经经FK5修正、岁差换算（IAU 2006）、章动和光行差改正，1900-2100年间与IERS/ERFA星历
+    相差约0.05角秒，对应节气时刻误差在3秒以内。
+    """
+    tau = (jde - J2000) / 365250
+    t = tau * 10
+    longitude = math.degrees(_series(_EARTH_L, tau) / 1e8) + 180
+    radius = _series(_EARTH_R, tau) / 1e8
+
+    # FK5修正，岁差换算到IAU 2006
+    longitude -= (0.09033 + PRECESSION_CORRECTION * t) / 3600
+    nutation, _ = _nutation(t)
+    # 光行差
+    aberration = -20.4898 / radius
+    return (longitude + (nutation + aberration) / 3600) % 360
+
+
+def _nutation(t: float) -> Tuple[float, float]:
+    """黄经章动和交角章动（角秒，IAU 1980章动序列），t为J2000起算的儒略世纪数"""
+    # 月日平距角D、太阳平近点角M、月亮平近点角M'、月亮纬度参数F、月亮升交点平黄经Ω（度）
+    arguments = (
+        297.85036 + 445267.111480 * t - 0.0019142 * t ** 2 + t ** 3 / 189474,
+        357.52772 + 35999.050340 * t - 0.0001603 * t ** 2 - t ** 3 / 300000,
+        134.96298 + 477198.867398 * t + 0.0086972 * t ** 2 + t ** 3 / 56250,
+        93.27191 + 483202.017538 * t - 0.0036825 * t ** 2 + t ** 3 / 327270,
+        125.04452 - 1934.136261 * t + 0.0020708 * t ** 2 + t ** 3 / 450000
+    )
+    longitude = obliquity = 0.0
+    for multiples, psi, psi_t, eps, eps_t in _NUTATION_TERMS:
+        angle = math.radians(sum(m * a for m, a in zip(multiples, arguments)))
+        longitude += (psi + psi_t * t) * math.sin(angle)
+        obliquity += (eps + eps_t * t) * math.cos(angle)
+    return longitude / 10000, obliquity / 10000
+
+
+def equation_of_time(jde: float) -> float:
+    """时差（分钟）：真太阳时减平太阳时，jde为力学时儒略日
+
+    按Meeus《天文算法》第28章，由太阳平黄经与视赤经之差求得，精度优于1秒。
+    """
+    tau = (jde - J2000) / 365250
+    t = tau * 10
+    mean_longitude = 280.4664567 + 360007.6982779 * tau + 0.03032028 * tau ** 2 \
+        + tau ** 3 / 49931 - tau ** 4 / 15300 - tau ** 5 / 2000000
+    nutation, obliquity_nutation = _nutation(t)
+    obliquity = math.radians(
+        23.4392911 - (46.8150 * t + 0.00059 * t ** 2 - 0.001813 * t ** 3 - obliquity_nutation) / 3600
+    )
+    longitude = math.radians(apparent_solar_longitude(jde))
+    right_ascension = math.degrees(math.atan2(math.cos(obliquity) * math.sin(longitude), math.cos(longitude)))
+    equation = mean_longitude - 0.0057183 - right_ascension + nutation / 3600 * math.cos(obliquity)
+    # 归一化到±180度后换算为分钟（1度 = 4分钟）
+    return ((equation + 180) % 360 - 180) * 4
+
+
+def equation_of_time_array(jde: np.ndarray) -> np.ndarray:
+    """时差（分钟）的向量化近似，jde为力学时儒略日数组
+
+    按Meeus《天文算法》第28章的Smart公式，由太阳平黄经、平近点角和地球轨道偏心率直接求得，
+    与equation_of_time相差在数秒以内，用于批量排盘。
+    """
+    t = (np.asarray(jde, dtype=np.float64) - J2000) / 36525
+    mean_longitude = np.radians(280.46646 + 36000.76983 * t + 0.0003032 * t ** 2)
+    mean_anomaly = np.radians(357.52911 + 35999.05029 * t - 0.0001537 * t ** 2)
+    eccentricity = 0.016708634 - 0.000042037 * t - 0.0000001267 * t ** 2
+    obliquity = np.radians(23.4392911 - (46.8150 * t + 0.00059 * t ** 2 - 0.001813 * t ** 3) / 3600)
+    y = np.tan(obliquity / 2) ** 2
+    sin_m = np.sin(mean_anomaly)
+    equation = y * np.sin(2 * mean_longitude) - 2 * eccentricity * sin_m \
+        + 4 * eccentricity * y * sin_m * np.cos(2 * mean_longitude) \
+        - 0.5 * y ** 2 * np.sin(4 * mean_longitude) - 1.25 * eccentricity ** 2 * np.sin(2 * mean_anomaly)
+    # 弧度换算为分钟（1弧度 = 229.18分钟）
+    return np.degrees(equation) * 4
+
+
+def julian_day(dt: datetime) -> float:
+    """公历日期时间对应的儒略日"""
+    return (dt - datetime(2000, 1, 1, 12)).total_seconds() / 86400 + J2000
+
+
+def from_julian_day(jd: float) -> datetime:
+    """儒略日对应的公历日期时间"""
+    return datetime(2000, 1, 1, 12) + timedelta(days=jd - J2000)
+
+
+def solar_term_jde(year: int, longitude: float) -> float:
+    """太阳视黄经到达longitude的时刻（力学时儒略日），取year年内的那一次"""
+    # 以平均速度估算初值：春分（0度）约在3月20日，落到下一年时取上一周期
+    jde = julian_day(datetime(year, 3, 20)) + (longitude % 360) / 360 * 365.2422
+    if jde >= julian_day(datetime(year + 1, 1, 1)):
+        jde -= 365.2422
+    for _ in range(10):
+        diff = (longitude - apparent_solar_longitude(jde) + 180) % 360 - 180
+        jde += 58.13 * math.sin(math.radians(diff))
+        if abs(diff) < 1e-6:
+            break
+    return jde
+
+
+def solar_term_time(year: int, longitude: float) -> datetime:
+    """year年内太阳视黄经到达longitude的北京时间"""
+    return to_beijing_time(solar_term_jde(year, longitude))
+
+
+def to_beijing_time(jde: float) -> datetime:
+    """力学时儒略日转换为北京时间"""
+    year = 2000 + (jde - J2000) / 365.25
+    return from_julian_day(jde - delta_t(year) / 86400 + BEIJING_OFFSET)
+
+
+def new_moon_jde(k: int) -> float:
+    """第k个朔的时刻（力学时儒略日），k=0为2000年1月6日的朔，精度约数秒"""
+    t = k / 1236.85
+    jde = 2451550.09766 + SYNODIC_MONTH * k + 0.00015437 * t ** 2 - 0.00000015 * t ** 3 + 0.00000000073 * t ** 4
+    e = 1 - 0.002516 * t - 0.0000074 * t ** 2
+    sun_anomaly = math.radians(2.5534 + 29.1053567 * k - 0.0000014 * t ** 2 - 0.00000011 * t ** 3)
+    moon_anomaly = math.radians(201.5643 + 385.81693528 * k + 0.0107582 * t ** 2 + 0.00001238 * t ** 3
+                                - 0.000000058 * t ** 4)
+    latitude_arg = math.radians(160.7108 + 390.67050284 * k - 0.0016118 * t ** 2 - 0.00000227 * t ** 3
+                                + 0.000000011 * t ** 4)
+    node = math.radians(124.7746 - 1.56375588 * k + 0.0020672 * t ** 2 + 0.00000215 * t ** 3)
+
+    arguments = (moon_anomaly, sun_anomaly, latitude_arg, node)
+    for coefficient, e_power, multiples in _NEW_MOON_TERMS:
+        angle = sum(m * a for m, a in zip(multiples, arguments))
+        jde += coefficient * e ** e_power * math.sin(angle)
+
+    jde += 0.000325 * math.sin(math.radians(299.77 + 0.107408 * k - 0.009173 * t ** 2))
+    for coefficient, phase, rate in _NEW_MOON_PLANETARY:
+        jde += coefficient * math.sin(math.radians(phase + rate * k))
+    return jde
+
+
+def new_moon_index(year: float) -> int:
+    """year（小数年份）附近的朔序号"""
+    return math.floor((year - 2000) * 12.3685)
+
+
+@lru_cache(maxsize=512)
+def jie_times(year: int) -> Tuple[datetime, ...]:
+    """year年十二节气的北京时间（小寒至大雪），按年缓存"""
+    return tuple(solar_term_time(year, longitude) for longitude in JIE_LONGITUDES)
+
+
+def jie_table(start_year: int, end_year: int) -> List[Tuple[int, Tuple[datetime, ...]]]:
+    """start_year至end_year（含）的节气表"""
+    return [(year, jie_times(year)) for year in range(start_year, end_year + 1)]
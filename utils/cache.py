@@ -0,0 +1,511 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from config.settings import Settings
+from utils.logger import logger
+
+
+def estimate_size(value: Any) -> int:
+    """估算缓存值占用的字节数"""
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'))
+    except (TypeError, ValueError):
+        return sys.getsizeof(value)
+
+
+class MemoryCache:
+    """有界内存缓存（TTL过期 + LRU淘汰）
+
+    同时限制条目数与总字节数，超出任一上限时淘汰最久未使用的条目。
+    过期条目在stale_ttl宽限期内继续保留，可通过get_stale读取。
+    所有操作均加锁，可在多个Streamlit会话线程间共享。
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024,
+                 stale_ttl: float = 0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (value, expires_at, size)
+        self._data: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._stale_hits = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """读取缓存，过期或不存在时返回default"""
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key: str) -> Optional[Tuple[Any, float]]:
+        """读取未过期的缓存条目，返回(value, expires_at)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+
+            value, expires_at, _ = entry
+            now = time.time()
+            if expires_at <= now:
+                # 宽限期内保留过期条目，供get_stale读取
+                if expires_at + self.stale_ttl <= now:
+                    self._remove(key)
+                    self._expirations += 1
+                self._misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value, expires_at
+
+    def get_stale(self, key: str) -> Optional[Tuple[Any, float]]:
+        """读取缓存条目（包括宽限期内的过期条目），返回(value, expires_at)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at, _ = entry
+            if expires_at + self.stale_ttl <= time.time():
+                return None
+
+            self._data.move_to_end(key)
+            self._stale_hits += 1
+            return value, expires_at
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """写入缓存"""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            # 单个条目超过容量上限时不缓存
+            return
+
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        if expires_at + self.stale_ttl <= time.time():
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self._total_bytes += size
+            self._evict()
+
+    def delete(self, key: str) -> bool:
+        """删除缓存条目"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+                return True
+            return False
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._total_bytes = 0
+
+    def keys(self) -> List[str]:
+        """获取未过期的缓存键"""
+        now = time.time()
+        with self._lock:
+            return [key for key, (_, expires_at, _) in self._data.items() if expires_at > now]
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "backend": "memory",
+                "entries": len(self._data),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "stale_hits": self._stale_hits,
+                "evictions": self._evictions,
+                "expirations": self._expirations
+            }
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[1] > time.time()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def _remove(self, key: str) -> None:
+        """移除条目并更新字节计数（调用方需持有锁）"""
+        _, _, size = self._data.pop(key)
+        self._total_bytes -= size
+
+    def _evict(self) -> None:
+        """按LRU顺序淘汰条目直到满足容量限制（调用方需持有锁）"""
+        now = time.time()
+        while self._data and (len(self._data) > self.max_entries or self._total_bytes > self.max_bytes):
+            key, (_, expires_at, _) = next(iter(self._data.items()))
+            self._remove(key)
+            if expires_at + self.stale_ttl <= now:
+                self._expirations += 1
+            else:
+                self._evictions += 1
+
+
+class SQLiteCache:
+    """基于SQLite（WAL模式）的磁盘缓存
+
+    同一主机上的多个工作进程共享同一个数据库文件，进程重启后缓存依然有效。
+    缓存值以JSON序列化并经zlib压缩后存储。过期条目在stale_ttl宽限期后才会被清理。
+    """
+
+    # 每写入多少次执行一次容量清理
+    PRUNE_INTERVAL = 100
+    # 访问时间的刷新粒度（秒），避免每次读取都产生写操作
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path: str, namespace: str = "default", ttl: float = 3600,
+                 max_entries: int = 100000, max_bytes: int = 512 * 1024 * 1024, stale_ttl: float = 0):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._hits = 0
+        self._misses = 0
+        self._stale_hits = 0
+        self._evictions = 0
+
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (namespace, accessed_at)"
+        )
+        conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _dumps(value: Any) -> bytes:
+        return zlib.compress(json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'))
+
+    @staticmethod
+    def _loads(payload: bytes) -> Any:
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """读取缓存，过期或不存在时返回default"""
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key: str) -> Optional[Tuple[Any, float]]:
+        """读取未过期的缓存条目，返回(value, expires_at)"""
+        return self._read(key, stale=False)
+
+    def get_stale(self, key: str) -> Optional[Tuple[Any, float]]:
+        """读取缓存条目（包括宽限期内的过期条目），返回(value, expires_at)"""
+        return self._read(key, stale=True)
+
+    def _read(self, key: str, stale: bool) -> Optional[Tuple[Any, float]]:
+        """读取缓存条目，stale为True时宽限期内的过期条目也返回"""
+        now = time.time()
+        counter = '_stale_hits' if stale else '_hits'
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, expires_at, accessed_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+
+            grace = self.stale_ttl if stale else 0
+            if row is None or row[1] + grace <= now:
+                if not stale:
+                    self._count('_misses')
+                return None
+
+            if now - row[2] > self.TOUCH_INTERVAL:
+                conn.execute(
+                    "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    (now, self.namespace, key)
+                )
+                conn.commit()
+
+            value = self._loads(row[0])
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            # 磁盘缓存异常不影响主流程，按未命中处理
+            logger.warning(f"磁盘缓存读取失败: {str(e)}")
+            if not stale:
+                self._count('_misses')
+            return None
+
+        self._count(counter)
+        return value, row[1]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """写入缓存"""
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        if expires_at + self.stale_ttl <= now:
+            return
+        try:
+            payload = self._dumps(value)
+            if len(payload) > self.max_bytes:
+                return
+
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, key, sqlite3.Binary(payload), len(payload), expires_at, now)
+            )
+            conn.commit()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning(f"磁盘缓存写入失败: {str(e)}")
+            return
+
+        with self._lock:
+            self._writes += 1
+            should_prune = self._writes % self.PRUNE_INTERVAL == 0
+        if should_prune:
+            self.prune()
+
+    def delete(self, key: str) -> bool:
+        """删除缓存条目"""
+        conn = self._connect()
+        cursor = conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+            (self.namespace, key)
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+
+    def clear(self) -> None:
+        """清空当前命名空间的缓存"""
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+        conn.commit()
+
+    def prune(self) -> None:
+        """清理过期条目，并按最近访问时间淘汰超出容量的条目"""
+        try:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, time.time() - self.stale_ttl)
+            )
+
+            count, total_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE namespace = ?",
+                (self.namespace,)
+            ).fetchone()
+
+            evicted = 0
+            if count > self.max_entries or total_bytes > self.max_bytes:
+                rows = conn.execute(
+                    "SELECT key, size FROM cache_entries WHERE namespace = ? ORDER BY accessed_at",
+                    (self.namespace,)
+                )
+                stale_keys = []
+                for key, size in rows:
+                    if count <= self.max_entries and total_bytes <= self.max_bytes:
+                        break
+                    stale_keys.append((self.namespace, key))
+                    count -= 1
+                    total_bytes -= size
+                conn.executemany("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", stale_keys)
+                evicted = len(stale_keys)
+
+            conn.commit()
+            if evicted:
+                with self._lock:
+                    self._evictions += evicted
+        except sqlite3.Error as e:
+            logger.warning(f"磁盘缓存清理失败: {str(e)}")
+
+    def keys(self) -> List[str]:
+        """获取未过期的缓存键"""
+        rows = self._connect().execute(
+            "SELECT key FROM cache_entries WHERE namespace = ? AND expires_at > ?",
+            (self.namespace, time.time())
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息（计数器为当前进程内的统计）"""
+        count, total_bytes = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE namespace = ?",
+            (self.namespace,)
+        ).fetchone()
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "backend": "sqlite",
+                "path": self.path,
+                "namespace": self.namespace,
+                "entries": count,
+                "bytes": total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "stale_hits": self._stale_hits,
+                "evictions": self._evictions
+            }
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def __contains__(self, key: str) -> bool:
+        row = self._connect().execute(
+            "SELECT 1 FROM cache_entries WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (self.namespace, key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+
+class TieredCache:
+    """两级缓存：进程内存作为一级缓存，磁盘缓存作为二级缓存"""
+
+    def __init__(self, memory: MemoryCache, disk: SQLiteCache):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """读取缓存，过期或不存在时返回default"""
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key: str) -> Optional[Tuple[Any, float]]:
+        """先查内存，再查磁盘，磁盘命中时回填内存"""
+        entry = self.memory.get_entry(key)
+        if entry is not None:
+            return entry
+
+        entry = self.disk.get_entry(key)
+        if entry is not None:
+            value, expires_at = entry
+            self.memory.set(key, value, ttl=expires_at - time.time())
+        return entry
+
+    def get_stale(self, key: str) -> Optional[Tuple[Any, float]]:
+        """读取缓存条目（包括宽限期内的过期条目），磁盘命中时回填内存"""
+        entry = self.memory.get_stale(key)
+        if entry is not None:
+            return entry
+
+        entry = self.disk.get_stale(key)
+        if entry is not None:
+            value, expires_at = entry
+            self.memory.set(key, value, ttl=expires_at - time.time())
+        return entry
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """同时写入内存和磁盘"""
+        self.memory.set(key, value, ttl)
+        self.disk.set(key, value, ttl)
+
+    def delete(self, key: str) -> bool:
+        """删除缓存条目"""
+        in_memory = self.memory.delete(key)
+        return self.disk.delete(key) or in_memory
+
+    def clear(self) -> None:
+        """清空缓存"""
+        self.memory.clear()
+        self.disk.clear()
+
+    def keys(self) -> List[str]:
+        """获取未过期的缓存键"""
+        return self.disk.keys()
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        return {
+            "backend": "tiered",
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats()
+        }
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.memory or key in self.disk
+
+    def __len__(self) -> int:
+        return len(self.disk)
+
+
+def create_cache(namespace: str, ttl: float, max_entries: int, max_bytes: int,
+                 backend: Optional[str] = None, stale_ttl: float = 0):
+    """根据配置创建缓存实例
+
+    backend为"memory"时仅使用进程内存；为"sqlite"时在内存缓存之外
+    增加同主机多进程共享的磁盘缓存。stale_ttl为过期条目的保留宽限期。
+    """
+    settings = Settings()
+    backend = (backend or settings.CACHE_BACKEND).lower()
+    memory = MemoryCache(ttl=ttl, max_entries=max_entries, max_bytes=max_bytes, stale_ttl=stale_ttl)
+
+    if backend == "memory":
+        return memory
+    if backend == "sqlite":
+        disk = SQLiteCache(
+            path=settings.CACHE_DB_PATH,
+            namespace=namespace,
+            ttl=ttl,
+            max_entries=settings.CACHE_DISK_MAX_ENTRIES,
+            max_bytes=settings.CACHE_DISK_MAX_BYTES,
+            stale_ttl=stale_ttl
+        )
+        return TieredCache(memory, disk)
+
+    raise ValueError(f"不支持的缓存后端: {backend}")
@@ -0,0 +1,196 @@
+import mmap
+import os
+import struct
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from config.settings import Settings
+from utils import astronomy
+from utils.logger import logger
+
+# 文件格式：文件头 + 段目录 + 各段数据（小端定宽整数数组，按8字节对齐）
+MAGIC = b'AIBZCAL1'
+VERSION = 1
+HEADER = struct.Struct('<8sIiiI')  # 魔数、版本、起始年、结束年、段数
+SECTION = struct.Struct('<8sQII')  # 段名、偏移、行数、列数
+
+# 各段的元素类型
+#   terms:  (年数, 24) 各年24节气的北京时间，自1970-01-01 00:00（北京时间）起的秒数，
+#           按公历年内顺序从小寒（285度）起每15度一个，偶数列为节、奇数列为中气
+#   months: (月数+1, 4) 农历月：月初日期（date.toordinal()）、农历年、月份、是否闰月；
+#           最后一行只有月初日期，作为末月的结束边界
+SECTION_DTYPES = {
+    'terms': np.dtype('<i8'),
+    'months': np.dtype('<i4'),
+}
+
+# 节气秒数的起点（北京时间）
+EPOCH = datetime(1970, 1, 1)
+
+# 24节气的太阳视黄经（按公历年内顺序）
+TERM_LONGITUDES = tuple((285 + 15 * i) % 360 for i in range(24))
+
+
+def to_epoch_seconds(dt: datetime) -> int:
+    """北京时间转换为自EPOCH起的秒数"""
+    return int((dt - EPOCH).total_seconds())
+
+
+def from_epoch_seconds(seconds: int) -> datetime:
+    """自EPOCH起的秒数转换为北京时间"""
+    return EPOCH + timedelta(seconds=int(seconds))
+
+
+def build_term_table(start_year: int, end_year: int) -> np.ndarray:
+    """计算start_year至end_year各年24节气的时刻"""
+    return np.array([
+        [to_epoch_seconds(astronomy.solar_term_time(year, longitude)) for longitude in TERM_LONGITUDES]
+        for year in range(start_year, end_year + 1)
+    ], dtype=SECTION_DTYPES['terms'])
+
+
+def build_lunar_months(start_year: int, end_year: int) -> np.ndarray:
+    """计算覆盖start_year至end_year的农历月
+
+    以含冬至的月为十一月；相邻两个十一月之间有13个月时，
+    其中第一个不含中气的月为闰月（沿用上一个月的月份）。日期按北京时间划分。
+    """
+    def day_of(jde: float) -> int:
+        return astronomy.to_beijing_time(jde).date().toordinal()
+
+    # 冬至及中气的日期
+    solstices = {year: astronomy.solar_term_time(year, 270).date().toordinal()
+                 for year in range(start_year - 1, end_year + 2)}
+    zhongqi_days = sorted(
+        astronomy.solar_term_time(year, longitude).date().toordinal()
+        for year in range(start_year - 1, end_year + 2)
+        for longitude in range(0, 360, 30)
+    )
+
+    # 覆盖范围内所有朔日
+    first_k = astronomy.new_moon_index(start_year - 1) - 2
+    last_k = astronomy.new_moon_index(end_year + 2) + 2
+    new_moons = [day_of(astronomy.new_moon_jde(k)) for k in range(first_k, last_k + 1)]
+
+    def month_start_index(day: int) -> int:
+        """包含day的农历月在new_moons中的下标"""
+        return max(i for i, start in enumerate(new_moons) if start <= day)
+
+    def has_zhongqi(start: int, end: int) -> bool:
+        return any(start <= day < end for day in zhongqi_days)
+
+    rows = []
+    for year in range(start_year - 1, end_year + 1):
+        first = month_start_index(solstices[year])
+        last = month_start_index(solstices[year + 1])
+        leap_pending = last - first == 13
+        month, lunar_year = 11, year
+        for i in range(first, last):
+            is_leap = leap_pending and i > first and not has_zhongqi(new_moons[i], new_moons[i + 1])
+            if is_leap:
+                leap_pending = False
+            elif i > first:
+                month = month % 12 + 1
+                if month == 1:
+                    lunar_year = year + 1
+            rows.append((new_moons[i], lunar_year, month, int(is_leap)))
+    # 结束边界
+    rows.append((new_moons[last], 0, 0, 0))
+    return np.array(rows, dtype=SECTION_DTYPES['months'])
+
+
+def write_tables(path: str, start_year: int, end_year: int, sections: Dict[str, np.ndarray]):
+    """写入历法表文件（先写临时文件再原子替换）"""
+    directory_size = HEADER.size + SECTION.size * len(sections)
+    offset = (directory_size + 7) // 8 * 8
+    entries, blobs = [], []
+    for name, array in sections.items():
+        data = np.ascontiguousarray(array, dtype=SECTION_DTYPES[name])
+        rows, cols = data.shape
+        entries.append(SECTION.pack(name.encode('ascii'), offset, rows, cols))
+        blob = data.tobytes()
+        blobs.append((offset, blob))
+        offset = (offset + len(blob) + 7) // 8 * 8
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, start_year, end_year, len(sections)))
+        f.write(b''.join(entries))
+        for blob_offset, blob in blobs:
+            f.write(b'\0' * (blob_offset - f.tell()))
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+
+class CalendarTables:
+    """内存映射的历法表
+
+    数组直接引用映射的文件页（不复制），同一主机的多个工作进程共享
+    操作系统页缓存中的同一份数据，加载只需解析文件头。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.start_year, self.end_year, section_count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"历法表文件格式不正确: {path}")
+
+        self._sections: Dict[str, np.ndarray] = {}
+        for index in range(section_count):
+            name, offset, rows, cols = SECTION.unpack_from(self._mmap, HEADER.size + SECTION.size * index)
+            name = name.rstrip(b'\0').decode('ascii')
+            dtype = SECTION_DTYPES[name]
+            self._sections[name] = np.frombuffer(
+                self._mmap, dtype=dtype, count=rows * cols, offset=offset
+            ).reshape(rows, cols)
+
+        self.terms = self._sections['terms']
+        self.months = self._sections['months']
+
+    def covers(self, year: int) -> bool:
+        """是否包含year年的节气"""
+        return self.start_year <= year <= self.end_year
+
+    def term_seconds(self, year: int) -> np.ndarray:
+        """year年24节气的时刻（自EPOCH起的秒数）"""
+        return self.terms[year - self.start_year]
+
+    def jie_times(self, year: int) -> Tuple[datetime, ...]:
+        """year年十二节的北京时间（小寒至大雪）"""
+        return tuple(from_epoch_seconds(seconds) for seconds in self.term_seconds(year)[0::2])
+
+
+_tables_lock = threading.Lock()
+_tables: Dict[str, Optional[CalendarTables]] = {}
+
+
+def load_calendar_tables(path: Optional[str] = None) -> Optional[CalendarTables]:
+    """加载历法表（进程内只映射一次），文件不存在或格式不正确时返回None"""
+    path = path or Settings.CALENDAR_TABLES_PATH
+    with _tables_lock:
+        if path not in _tables:
+            try:
+                _tables[path] = CalendarTables(path)
+                logger.info(f"历法表已加载: {path}")
+            except (OSError, ValueError) as e:
+                # 缺少历法表时回退到实时计算
+                logger.warning(f"历法表加载失败，节气改为实时计算: {str(e)}")
+                _tables[path] = None
+        return _tables[path]
+
+
+@lru_cache(maxsize=512)
+def jie_times(year: int) -> Tuple[datetime, ...]:
+    """year年十二节的北京时间，优先查历法表，表外年份实时计算"""
+    tables = load_calendar_tables()
+    if tables is not None and tables.covers(year):
+        return tables.jie_times(year)
+    return astronomy.jie_times(year)
@@ -0,0 +1,152 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from config.settings import Settings
+from utils.logger import logger
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数
+
+    按DeepSeek分词器的经验比例估算：中文字符约0.6个token，其余字符约0.3个token。
+    """
+    cjk_chars = len(_CJK_PATTERN.findall(text))
+    other_chars = len(text) - cjk_chars
+    return int(round(cjk_chars * 0.6 + other_chars * 0.3))
+
+
+class DataProjector:
+    """按预测类型裁剪运势数据，并以紧凑格式序列化
+
+    规则从JSON配置文件加载：exclude移除指定字段，include只保留指定字段，
+    drop_empty移除空值，dedupe_strings将重复出现的长文本替换为对首次出现位置的引用。
+    """
+
+    def __init__(self, config_path: Optional[str] = None):
+        settings = Settings()
+        self.config_path = config_path or settings.PROMPT_PROJECTION_FILE
+        self.rules = self._load_rules(self.config_path)
+
+    @staticmethod
+    def _load_rules(config_path: str) -> Dict[str, Dict[str, Any]]:
+        """加载投影规则，文件不存在或格式错误时不做裁剪"""
+        try:
+            with open(config_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"投影规则文件不存在: {config_path}")
+        except json.JSONDecodeError as e:
+            logger.warning(f"投影规则文件格式错误: {str(e)}")
+        return {}
+
+    def get_rule(self, prediction_type: str) -> Dict[str, Any]:
+        """合并通用规则和预测类型规则"""
+        common = self.rules.get('_common', {})
+        specific = self.rules.get(prediction_type, {})
+        return {
+            "include": specific.get('include', common.get('include', [])),
+            "exclude": common.get('exclude', []) + specific.get('exclude', []),
+            "drop_empty": specific.get('drop_empty', common.get('drop_empty', True)),
+            "dedupe_strings": specific.get('dedupe_strings', common.get('dedupe_strings', True)),
+            "dedupe_min_length": specific.get('dedupe_min_length', common.get('dedupe_min_length', 20))
+        }
+
+    def project(self, data: Dict[str, Any], prediction_type: str) -> Dict[str, Any]:
+        """按预测类型裁剪运势数据"""
+        rule = self.get_rule(prediction_type)
+
+        projected = data
+        if rule["include"]:
+            projected = self._include_paths(projected, [p.split('.') for p in rule["include"]])
+        for path in rule["exclude"]:
+            projected = self._exclude_path(projected, path.split('.'))
+        if rule["drop_empty"]:
+            projected = self._drop_empty(projected)
+        if rule["dedupe_strings"]:
+            projected = self._dedupe_strings(projected, rule["dedupe_min_length"])
+        return projected if isinstance(projected, dict) else {}
+
+    @staticmethod
+    def serialize(data: Dict[str, Any]) -> str:
+        """紧凑JSON序列化（无缩进、无多余空白）"""
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    def report(self, data: Dict[str, Any], prediction_type: str) -> Dict[str, Any]:
+        """对比裁剪前（缩进格式）与裁剪后（紧凑格式）的字符数和token数"""
+        before = json.dumps(data, ensure_ascii=False, indent=2)
+        after = self.serialize(self.project(data, prediction_type))
+        before_tokens = estimate_tokens(before)
+        after_tokens = estimate_tokens(after)
+        return {
+            "prediction_type": prediction_type,
+            "before_chars": len(before),
+            "after_chars": len(after),
+            "before_tokens": before_tokens,
+            "after_tokens": after_tokens,
+            "saved_ratio": round(1 - after_tokens / before_tokens, 4) if before_tokens else 0.0
+        }
+
+    @classmethod
+    def _include_paths(cls, data: Any, paths: List[List[str]]) -> Any:
+        if not isinstance(data, dict):
+            return data
+        if any(not path for path in paths):
+            return data
+
+        result = {}
+        for key, value in data.items():
+            sub_paths = [path[1:] for path in paths if path[0] == key]
+            if sub_paths:
+                result[key] = cls._include_paths(value, sub_paths)
+        return result
+
+    @classmethod
+    def _exclude_path(cls, data: Any, path: List[str]) -> Any:
+        if not isinstance(data, dict) or not path or path[0] not in data:
+            return data
+        if len(path) == 1:
+            return {k: v for k, v in data.items() if k != path[0]}
+        return {**data, path[0]: cls._exclude_path(data[path[0]], path[1:])}
+
+    @classmethod
+    def _drop_empty(cls, data: Any) -> Any:
+        if isinstance(data, dict):
+            cleaned = {k: cls._drop_empty(v) for k, v in data.items()}
+            return {k: v for k, v in cleaned.items() if v not in (None, '', [], {})}
+        if isinstance(data, list):
+            return [cls._drop_empty(item) for item in data]
+        return data
+
+    @staticmethod
+    def _dedupe_strings(data: Any, min_length: int) -> Any:
+        """将重复出现的长文本替换为对首次出现字段的引用"""
+        seen: Dict[str, str] = {}
+
+        def walk(value: Any, path: Tuple[str, ...]) -> Any:
+            if isinstance(value, dict):
+                return {k: walk(v, path + (str(k),)) for k, v in value.items()}
+            if isinstance(value, list):
+                return [walk(item, path + (str(i),)) for i, item in enumerate(value)]
+            if isinstance(value, str) and len(value) >= min_length:
+                if value in seen:
+                    return f"(同{seen[value]})"
+                seen[value] = '.'.join(path)
+            return value
+
+        return walk(data, ())
+
+
+if __name__ == "__main__":
+    # 用法: python -m utils.data_projection fortune_data.json
+    import sys
+
+    with open(sys.argv[1], 'r', encoding='utf-8') as f:
+        sample = json.load(f)
+    sample = sample.get('data', sample) if isinstance(sample, dict) and 'errcode' in sample else sample
+
+    projector = DataProjector()
+    for name in ('comprehensive', 'career', 'relationship'):
+        print(json.dumps(projector.report(sample, name), ensure_ascii=False))
@@ -1,7 +1,8 @@
 import re
 from datetime import datetime
 from typing import Dict, Any, List, Optional
-from models.user_info import UserInfo
+from models.user_info import CALENDAR_TYPES, UserInfo
+from utils.lunar_calendar import lunar_date_from_fields, lunar_to_solar
 
 class DataValidator:
     """数据验证工具类"""
@@ -49,11 +50,20 @@ class DataValidator:
             if birth_minute < 0 or birth_minute > 59:
                 errors.append('出生分钟必须在0-59之间')
             
-            # 验证日期是否真实存在
-            try:
-                datetime(birth_year, birth_month, birth_day, birth_hour, birth_minute)
-            except ValueError:
-                errors.append('请输入有效的出生日期时间')
+            # 验证日期是否真实存在（农历日期按历法表核对月份大小和闰月）
+            calendar_type = user_info.get('calendar_type') or 'solar'
+            if calendar_type not in CALENDAR_TYPES:
+                errors.append('请选择正确的历法类型')
+            elif calendar_type == 'lunar':
+                try:
+                    lunar_to_solar(*lunar_date_from_fields(user_info))
+                except ValueError as e:
+                    errors.append(f'请输入有效的农历出生日期：{str(e)}')
+            else:
+                try:
+                    datetime(birth_year, birth_month, birth_day, birth_hour, birth_minute)
+                except ValueError:
+                    errors.append('请输入有效的出生日期时间')
                 
         except (ValueError, TypeError):
             errors.append('出生日期时间格式不正确')
@@ -0,0 +1,39 @@
+import time
+from typing import Optional
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求超出整体时间预算"""
+
+
+class Deadline:
+    """请求的整体时间预算
+
+    在入口处创建并沿调用链传递，各阶段根据剩余时间设置自己的超时，
+    预算耗尽时尽早放弃，避免慢请求长期占用工作线程。
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        """剩余时间（秒），不小于0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """当前阶段可用的超时时间，不超过cap；预算已耗尽时抛出DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"请求超时：已超出{self.budget:g}秒的时间预算")
+        return remaining if cap is None else min(cap, remaining)
+
+    def check(self, stage: str = "") -> None:
+        """检查预算是否耗尽，耗尽时抛出DeadlineExceeded"""
+        if self.expired:
+            stage_desc = f"（{stage}）" if stage else ""
+            raise DeadlineExceeded(f"请求超时{stage_desc}：已超出{self.budget:g}秒的时间预算")
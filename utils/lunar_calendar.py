@@ -0,0 +1,136 @@
+import threading
+from datetime import date
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from utils.calendar_tables import build_lunar_months, load_calendar_tables
+from utils.logger import logger
+
+# 农历月、日的中文名称
+MONTH_NAMES = ('正', '二', '三', '四', '五', '六', '七', '八', '九', '十', '冬', '腊')
+DAY_NAMES = (
+    '初一', '初二', '初三', '初四', '初五', '初六', '初七', '初八', '初九', '初十',
+    '十一', '十二', '十三', '十四', '十五', '十六', '十七', '十八', '十九', '二十',
+    '廿一', '廿二', '廿三', '廿四', '廿五', '廿六', '廿七', '廿八', '廿九', '三十'
+)
+
+# 朔望月平均长度（天），用于由公历日期直接估算所在的农历月
+MEAN_MONTH_DAYS = 29.530588861
+
+# 历法表缺失时实时计算的年份范围
+FALLBACK_YEARS = (1900, 2100)
+
+
+class LunarDate(NamedTuple):
+    """农历日期"""
+    year: int
+    month: int
+    day: int
+    is_leap: bool = False
+
+    def __str__(self) -> str:
+        leap = '闰' if self.is_leap else ''
+        return f"农历{self.year}年{leap}{MONTH_NAMES[self.month - 1]}月{DAY_NAMES[self.day - 1]}"
+
+
+class LunarCalendar:
+    """查表实现的农历与公历互换（含闰月）
+
+    基于历法表中的农历月（月初日期、农历年、月份、是否闰月），
+    农历→公历按(年, 月, 是否闰月)直接索引月初日期；公历→农历按朔望月平均长度估算行号，
+    最多校正一两行，两个方向都是O(1)。
+    """
+
+    def __init__(self, months: np.ndarray):
+        rows = months.tolist()
+        # 月初日期（date.toordinal()），最后一行为末月的结束边界
+        self._starts: List[int] = [row[0] for row in rows]
+        self._months: List[Tuple[int, int, bool]] = [(row[1], row[2], bool(row[3])) for row in rows[:-1]]
+        self._index: Dict[Tuple[int, int, bool], int] = {month: i for i, month in enumerate(self._months)}
+        self._leap_months: Dict[int, int] = {year: month for year, month, is_leap in self._months if is_leap}
+        # 覆盖的农历年：首尾不完整的年份不计入
+        self.start_year = self._months[0][0] + (self._months[0][1] != 1)
+        self.end_year = self._months[-1][0] - (self._months[-1][1] != 12)
+
+    def leap_month(self, year: int) -> int:
+        """农历year年的闰月月份，无闰月时返回0"""
+        return self._leap_months.get(year, 0)
+
+    def month_days(self, year: int, month: int, is_leap: bool = False) -> int:
+        """农历某月的天数（29或30）"""
+        i = self._month_row(year, month, is_leap)
+        return self._starts[i + 1] - self._starts[i]
+
+    def to_solar(self, year: int, month: int, day: int, is_leap: bool = False) -> date:
+        """农历日期转换为公历日期"""
+        i = self._month_row(year, month, is_leap)
+        days = self._starts[i + 1] - self._starts[i]
+        if not 1 <= day <= days:
+            raise ValueError(f"农历{year}年{'闰' if is_leap else ''}{MONTH_NAMES[month - 1]}月只有{days}天")
+        return date.fromordinal(self._starts[i] + day - 1)
+
+    def to_lunar(self, day: date) -> LunarDate:
+        """公历日期转换为农历日期"""
+        ordinal = day.toordinal()
+        if not self._starts[0] <= ordinal < self._starts[-1]:
+            raise ValueError(f"日期超出农历换算范围: {day.isoformat()}")
+        i = min(int((ordinal - self._starts[0]) / MEAN_MONTH_DAYS), len(self._months) - 1)
+        while self._starts[i] > ordinal:
+            i -= 1
+        while self._starts[i + 1] <= ordinal:
+            i += 1
+        year, month, is_leap = self._months[i]
+        return LunarDate(year, month, ordinal - self._starts[i] + 1, is_leap)
+
+    def _month_row(self, year: int, month: int, is_leap: bool) -> int:
+        if not self.start_year <= year <= self.end_year:
+            raise ValueError(f"农历年份必须在{self.start_year}-{self.end_year}之间")
+        if not 1 <= month <= 12:
+            raise ValueError('农历月份必须在1-12之间')
+        i = self._index.get((year, month, bool(is_leap)))
+        if i is None:
+            raise ValueError(f"农历{year}年没有闰{MONTH_NAMES[month - 1]}月")
+        return i
+
+
+_calendar_lock = threading.Lock()
+_calendar: Optional[LunarCalendar] = None
+
+
+def get_lunar_calendar() -> LunarCalendar:
+    """获取农历换算器（进程内只构建一次），历法表缺失时改为实时计算农历月"""
+    global _calendar
+    with _calendar_lock:
+        if _calendar is None:
+            tables = load_calendar_tables()
+            if tables is not None:
+                months = tables.months
+            else:
+                logger.warning(f"历法表不可用，实时计算{FALLBACK_YEARS[0]}-{FALLBACK_YEARS[1]}年农历月")
+                months = build_lunar_months(*FALLBACK_YEARS)
+            _calendar = LunarCalendar(months)
+        return _calendar
+
+
+def lunar_date_from_fields(fields: Dict[str, Any]) -> LunarDate:
+    """从用户输入（birth_year、birth_month、birth_day、is_leap_month）中取出农历出生日期"""
+    try:
+        return LunarDate(
+            int(fields.get('birth_year')),
+            int(fields.get('birth_month')),
+            int(fields.get('birth_day')),
+            str(fields.get('is_leap_month', False)).lower() in ('true', '1')
+        )
+    except (TypeError, ValueError):
+        raise ValueError('农历出生日期格式不正确')
+
+
+def lunar_to_solar(year: int, month: int, day: int, is_leap: bool = False) -> date:
+    """农历日期转换为公历日期"""
+    return get_lunar_calendar().to_solar(year, month, day, is_leap)
+
+
+def solar_to_lunar(day: date) -> LunarDate:
+    """公历日期转换为农历日期"""
+    return get_lunar_calendar().to_lunar(day)
@@ -0,0 +1,235 @@
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+import httpx
+import requests
+
+from utils.logger import logger
+
+# 可重试的HTTP状态码（限流和服务端错误）
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """指数退避加全抖动：在[0, min(cap, base * 2^attempt)]内随机取等待时间"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_retryable(error: Exception) -> bool:
+    """判断请求错误是否值得重试（超时、连接错误、限流和5xx）"""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                          httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)):
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(error, (requests.exceptions.HTTPError, httpx.HTTPStatusError)) and response is not None:
+        return response.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，请求被快速拒绝"""
+
+
+class RetryBudget:
+    """进程级重试预算
+
+    在滑动时间窗口内，重试次数不超过请求数的ratio倍（至少允许min_retries次），
+    上游整体故障时避免重试放大流量。
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 3, window: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+        self._rejected = 0
+
+    def _trim(self, now: float):
+        for timestamps in (self._requests, self._retries):
+            while timestamps and now - timestamps[0] > self.window:
+                timestamps.popleft()
+
+    def record_request(self):
+        """记录一次新请求（不含重试）"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_acquire_retry(self) -> bool:
+        """申请一次重试，预算不足时返回False"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            if len(self._retries) >= max(self.min_retries, self.ratio * len(self._requests)):
+                self._rejected += 1
+                return False
+            self._retries.append(now)
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        """获取预算使用情况"""
+        with self._lock:
+            self._trim(time.monotonic())
+            return {
+                "window_requests": len(self._requests),
+                "window_retries": len(self._retries),
+                "rejected_retries": self._rejected
+            }
+
+
+class CircuitBreaker:
+    """熔断器
+
+    closed：正常放行，滑动窗口内错误率达到阈值后打开；
+    open：快速拒绝请求，open_duration秒后进入half_open；
+    half_open：放行少量探测请求，成功则关闭，失败则重新打开。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_rate_threshold: float = 0.5, min_requests: int = 10,
+                 window: float = 30.0, open_duration: float = 30.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.min_requests = min_requests
+        self.window = window
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+        self._state = self.CLOSED
+        self._outcomes = deque()
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh_state(time.monotonic())
+            return self._state
+
+    def _refresh_state(self, now: float):
+        if self._state == self.OPEN and now - self._opened_at >= self.open_duration:
+            self._state = self.HALF_OPEN
+            self._half_open_calls = 0
+            logger.info(f"熔断器{self.name}进入半开状态，开始探测")
+
+    def _open(self, now: float):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        logger.warning(f"熔断器{self.name}打开，{self.open_duration}秒内快速失败")
+
+    def allow_request(self) -> bool:
+        """判断是否放行请求"""
+        with self._lock:
+            self._refresh_state(time.monotonic())
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._half_open_calls < self.half_open_max_calls:
+                self._half_open_calls += 1
+                return True
+            self._rejected += 1
+            return False
+
+    def before_call(self):
+        """请求前检查，熔断时抛出CircuitOpenError"""
+        if not self.allow_request():
+            raise CircuitOpenError(f"{self.name}服务暂时不可用（熔断中），请稍后重试")
+
+    def record_success(self):
+        """记录一次成功请求"""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                self._outcomes.clear()
+                logger.info(f"熔断器{self.name}探测成功，恢复正常")
+            self._append(now, True)
+
+    def record_failure(self):
+        """记录一次失败请求"""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._open(now)
+                return
+            if self._state == self.OPEN:
+                return
+            self._append(now, False)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if len(self._outcomes) >= self.min_requests and \
+                    failures / len(self._outcomes) >= self.failure_rate_threshold:
+                self._open(now)
+
+    def record_ignored(self):
+        """请求结束但不反映上游健康状况（如4xx客户端错误）：不改变状态，只释放半开探测名额"""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._half_open_calls > 0:
+                self._half_open_calls -= 1
+
+    def _append(self, now: float, ok: bool):
+        self._outcomes.append((now, ok))
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+
+    def stats(self) -> Dict[str, Any]:
+        """获取熔断器状态"""
+        with self._lock:
+            now = time.monotonic()
+            self._refresh_state(now)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            return {
+                "name": self.name,
+                "state": self._state,
+                "window_requests": len(self._outcomes),
+                "window_failures": failures,
+                "rejected_requests": self._rejected,
+                "retry_after": round(max(0.0, self.open_duration - (now - self._opened_at)), 1)
+                if self._state == self.OPEN else 0.0
+            }
+
+
+_registry_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+_budgets: Dict[str, RetryBudget] = {}
+
+
+def get_circuit_breaker(name: str, settings: Optional[Any] = None) -> CircuitBreaker:
+    """获取进程内共享的熔断器（同一上游的同步、异步客户端共用）"""
+    with _registry_lock:
+        if name not in _breakers:
+            kwargs = {}
+            if settings is not None:
+                kwargs = {
+                    "failure_rate_threshold": settings.CIRCUIT_FAILURE_RATE,
+                    "min_requests": settings.CIRCUIT_MIN_REQUESTS,
+                    "window": settings.CIRCUIT_WINDOW,
+                    "open_duration": settings.CIRCUIT_OPEN_SECONDS,
+                    "half_open_max_calls": settings.CIRCUIT_HALF_OPEN_MAX_CALLS
+                }
+            _breakers[name] = CircuitBreaker(name, **kwargs)
+        return _breakers[name]
+
+
+def get_retry_budget(name: str, settings: Optional[Any] = None) -> RetryBudget:
+    """获取进程内共享的重试预算"""
+    with _registry_lock:
+        if name not in _budgets:
+            kwargs = {}
+            if settings is not None:
+                kwargs = {
+                    "ratio": settings.RETRY_BUDGET_RATIO,
+                    "min_retries": settings.RETRY_BUDGET_MIN_RETRIES,
+                    "window": settings.RETRY_BUDGET_WINDOW
+                }
+            _budgets[name] = RetryBudget(**kwargs)
+        return _budgets[name]
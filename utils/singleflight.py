@@ -0,0 +1,116 @@
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.deadline import Deadline, DeadlineExceeded
+
+
+def _wait_exceeded(deadline: Deadline) -> DeadlineExceeded:
+    return DeadlineExceeded(f"请求超时（等待相同请求的结果）：已超出{deadline.budget:g}秒的时间预算")
+
+
+class SingleFlight:
+    """合并并发的相同请求
+
+    同一个key同时只会执行一次fn，其余并发调用方等待首个调用的结果，
+    共享其返回值或异常。等待方传入deadline时最多等待剩余时间。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+        self._executions = 0
+        self._coalesced = 0
+
+    def do(self, key: str, fn: Callable[..., Any], *args, deadline: Optional[Deadline] = None, **kwargs) -> Any:
+        """执行fn，若相同key的调用正在进行则等待其结果
+        
+        deadline只限制等待其他调用结果的时间（超出时抛出DeadlineExceeded），不传给fn。
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = Future()
+                self._calls[key] = future
+                is_leader = True
+                self._executions += 1
+            else:
+                is_leader = False
+                self._coalesced += 1
+
+        if not is_leader:
+            if deadline is None:
+                return future.result()
+            try:
+                return future.result(timeout=deadline.timeout())
+            except FutureTimeoutError:
+                if future.done():
+                    # 首个调用本身抛出的超时异常原样共享
+                    raise
+                raise _wait_exceeded(deadline) from None
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """获取请求合并统计"""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executions": self._executions,
+                "coalesced": self._coalesced
+            }
+
+
+class AsyncSingleFlight:
+    """合并并发的相同异步请求
+
+    同一事件循环内相同key的协程只执行一次，其余调用方等待同一个任务。
+    传入deadline时最多等待剩余时间，超时不影响共享任务继续执行。
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._executions = 0
+        self._coalesced = 0
+
+    async def do(self, key: str, fn: Callable[..., Awaitable[Any]], *args, deadline: Optional[Deadline] = None,
+                 **kwargs) -> Any:
+        """执行协程函数fn，若相同key的任务正在进行则等待其结果（deadline不传给fn）"""
+        task_key = (id(asyncio.get_running_loop()), key)
+        task = self._tasks.get(task_key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._tasks[task_key] = task
+            self._executions += 1
+            task.add_done_callback(lambda _: self._tasks.pop(task_key, None))
+        else:
+            self._coalesced += 1
+
+        # shield避免单个调用方取消或超时时连带取消共享任务
+        if deadline is None:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), deadline.timeout())
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            raise _wait_exceeded(deadline) from None
+
+    def stats(self) -> Dict[str, int]:
+        """获取请求合并统计"""
+        return {
+            "in_flight": len(self._tasks),
+            "executions": self._executions,
+            "coalesced": self._coalesced
+        }
@@ -0,0 +1,90 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from config.settings import Settings
+from utils import astronomy
+from utils.logger import logger
+
+# 北京时间的标准经线（东经120度），经度每差1度，地方平太阳时差4分钟
+STANDARD_MERIDIAN = 120.0
+
+# 城市名常见的行政区划后缀，查不到原名时去掉后缀再查
+CITY_SUFFIXES = ('市', '县', '区', '旗')
+
+# 城市查不到时使用省会的经纬度（港澳台范围过大，不设默认）
+PROVINCE_CAPITALS = {
+    '北京市': '北京', '天津市': '天津', '上海市': '上海', '重庆市': '重庆',
+    '河北省': '石家庄', '山东省': '济南', '浙江省': '杭州', '四川省': '成都',
+    '河南省': '郑州', '辽宁省': '沈阳', '江苏省': '南京', '安徽省': '合肥',
+    '吉林省': '长春', '福建省': '福州', '山西省': '太原', '湖北省': '武汉',
+    '黑龙江省': '哈尔滨', '江西省': '南昌', '内蒙古': '呼和浩特', '湖南省': '长沙',
+    '新疆维吾尔自治区': '乌鲁木齐', '广东省': '广州', '贵州省': '贵阳', '云南省': '昆明',
+    '西藏自治区': '拉萨', '广西壮族自治区': '南宁', '甘肃省': '兰州', '青海省': '西宁',
+    '宁夏回族自治区': '银川', '海南省': '海口', '陕西省': '西安'
+}
+
+
+class CityIndex:
+    """省市经纬度索引
+
+    覆盖province.json中的全部省市（县城取县政府驻地），经纬度精确到0.01度，
+    对应的真太阳时误差在1分钟以内。
+    """
+
+    def __init__(self, coordinates: Dict[str, Dict[str, list]]):
+        self._coordinates = coordinates
+
+    def lookup(self, province: str, city: str) -> Optional[Tuple[float, float]]:
+        """查询城市的（经度, 纬度），城市不在索引中时退回省会，仍查不到返回None"""
+        cities = self._coordinates.get(province)
+        if not cities:
+            return None
+        for name in (city, city.rstrip(''.join(CITY_SUFFIXES)), PROVINCE_CAPITALS.get(province)):
+            if name and name in cities:
+                longitude, latitude = cities[name]
+                return longitude, latitude
+        return None
+
+    def __len__(self) -> int:
+        return sum(len(cities) for cities in self._coordinates.values())
+
+
+_index_lock = threading.Lock()
+_indexes: Dict[str, Optional[CityIndex]] = {}
+
+
+def load_city_index(path: Optional[str] = None) -> Optional[CityIndex]:
+    """加载省市经纬度索引（进程内只读取一次），文件不存在或格式不正确时返回None"""
+    path = path or Settings.CITY_COORDINATES_PATH
+    with _index_lock:
+        if path not in _indexes:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    _indexes[path] = CityIndex(json.load(f))
+                logger.info(f"省市经纬度索引已加载: {path}")
+            except (OSError, ValueError) as e:
+                # 缺少索引时不做真太阳时校正
+                logger.warning(f"省市经纬度索引加载失败，不做真太阳时校正: {str(e)}")
+                _indexes[path] = None
+        return _indexes[path]
+
+
+def solar_time_offset(beijing_time: datetime, longitude: float) -> float:
+    """真太阳时与北京时间之差（分钟）= 经度时差 + 时差（均时差）"""
+    ut = beijing_time - timedelta(days=astronomy.BEIJING_OFFSET)
+    jde = astronomy.julian_day(ut) + astronomy.delta_t(ut.year) / 86400
+    return (longitude - STANDARD_MERIDIAN) * 4 + astronomy.equation_of_time(jde)
+
+
+def true_solar_time(beijing_time: datetime, longitude: float) -> datetime:
+    """北京时间换算为经度longitude处的真太阳时"""
+    return beijing_time + timedelta(minutes=solar_time_offset(beijing_time, longitude))
+
+
+def format_offset(minutes: float) -> str:
+    """时差的显示格式，如 -14分24秒"""
+    seconds = round(minutes * 60)
+    sign = '-' if seconds < 0 else ''
+    return f"{sign}{abs(seconds) // 60}分{abs(seconds) % 60}秒"